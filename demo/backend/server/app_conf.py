@@ -19,6 +19,49 @@ logger.info(f"using model size {MODEL_SIZE}")
 
 FFMPEG_NUM_THREADS = int(os.getenv("FFMPEG_NUM_THREADS", "1"))
 
+# Per-session budgets (in MiB) of the image feature cache on the compute device and
+# in CPU memory. With the default of 0, only the most recent frame's feature is kept.
+FEATURE_CACHE_MAX_MB = int(os.getenv("FEATURE_CACHE_MAX_MB", "0"))
+FEATURE_CACHE_MAX_CPU_MB = int(os.getenv("FEATURE_CACHE_MAX_CPU_MB", "0"))
+
+# Number of upcoming frames whose image features are computed in the background during
+# propagation (0 disables prefetching), and the batch size to compute them with.
+PREFETCH_FRAMES = int(os.getenv("PREFETCH_FRAMES", "0"))
+PREFETCH_BATCH_SIZE = int(os.getenv("PREFETCH_BATCH_SIZE", "1"))
+
+# Directory of a persistent store of the image features of gallery videos, which are
+# segmented over and over (the store is disabled if it's not set).
+FEATURE_STORE_PATH = os.getenv("FEATURE_STORE_PATH")
+
+# If > 0, a propagation stops once the masks of all objects have matched their results
+# from the previous propagation for this many consecutive frames (so that re-propagating
+# after a correction only runs on the frames it affects).
+PROPAGATION_EARLY_STOP_FRAMES = int(os.getenv("PROPAGATION_EARLY_STOP_FRAMES", "0"))
+
+# suspend the tracking of objects that have been absent for this many frames (0: never)
+PROPAGATION_SUSPEND_ABSENT_FRAMES = int(
+    os.getenv("PROPAGATION_SUSPEND_ABSENT_FRAMES", "0")
+)
+
+# batch the tracking steps of the sessions propagating at the same time (waiting for up
+# to PROPAGATION_BATCH_WAIT_MS for the other sessions to submit their next steps)
+PROPAGATION_BATCH_WAIT_MS = float(os.getenv("PROPAGATION_BATCH_WAIT_MS", "10"))
+PROPAGATION_MAX_BATCH_SESSIONS = int(os.getenv("PROPAGATION_MAX_BATCH_SESSIONS", "0"))
+
+# how long a request that changes a session (e.g. adding points) waits for a propagation
+# of that session to stop after canceling it, before failing
+PROPAGATION_STOP_TIMEOUT_S = float(os.getenv("PROPAGATION_STOP_TIMEOUT_S", "30"))
+
+# CPU inference settings (used when running on CPU, e.g. with SAM2_DEMO_FORCE_CPU_DEVICE=1):
+# the intra-op and inter-op threads (0: PyTorch's default), bfloat16 autocast ("auto":
+# only if the CPU natively supports it), channels-last convolution weights, and dynamic
+# int8 quantization of the linear layers (which replaces bfloat16 autocast)
+CPU_NUM_THREADS = int(os.getenv("CPU_NUM_THREADS", "0"))
+CPU_NUM_INTEROP_THREADS = int(os.getenv("CPU_NUM_INTEROP_THREADS", "1"))
+CPU_BF16_AUTOCAST = os.getenv("CPU_BF16_AUTOCAST", "auto")
+CPU_CHANNELS_LAST = os.getenv("CPU_CHANNELS_LAST", "1") == "1"
+CPU_QUANTIZE_INT8 = os.getenv("CPU_QUANTIZE_INT8", "0") == "1"
+
 # Path for all data used in API
 DATA_PATH = Path(os.getenv("DATA_PATH", "/data"))
 
@@ -6,14 +6,33 @@
 import contextlib
 import logging
 import os
+import time
 import uuid
 from pathlib import Path
-from threading import Lock
+from threading import Condition, Lock
 from typing import Any, Dict, Generator, List
 
-import numpy as np
 import torch
-from app_conf import APP_ROOT, MODEL_SIZE
+from app_conf import (
+    APP_ROOT,
+    CPU_BF16_AUTOCAST,
+    CPU_CHANNELS_LAST,
+    CPU_NUM_INTEROP_THREADS,
+    CPU_NUM_THREADS,
+    CPU_QUANTIZE_INT8,
+    FEATURE_CACHE_MAX_CPU_MB,
+    FEATURE_CACHE_MAX_MB,
+    FEATURE_STORE_PATH,
+    GALLERY_PATH,
+    MODEL_SIZE,
+    PREFETCH_BATCH_SIZE,
+    PREFETCH_FRAMES,
+    PROPAGATION_BATCH_WAIT_MS,
+    PROPAGATION_EARLY_STOP_FRAMES,
+    PROPAGATION_MAX_BATCH_SESSIONS,
+    PROPAGATION_STOP_TIMEOUT_S,
+    PROPAGATION_SUSPEND_ABSENT_FRAMES,
+)
 from inference.data_types import (
     AddMaskRequest,
     AddPointsRequest,
@@ -33,8 +52,16 @@ from inference.data_types import (
     StartSessionRequest,
     StartSessionResponse,
 )
-from pycocotools.mask import decode as decode_masks, encode as encode_masks
+from pycocotools.mask import decode as decode_masks
 from sam2.build_sam import build_sam2_video_predictor
+from sam2.utils.amg import mask_to_coco_rle_pytorch
+from sam2.utils.batch_scheduler import CrossSessionBatchScheduler
+from sam2.utils.cpu_inference import (
+    cpu_autocast_context,
+    is_cpu_bf16_supported,
+    optimize_model_for_cpu,
+    set_cpu_num_threads,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -84,16 +111,46 @@ class InferenceAPI:
                 "give numerically different outputs and sometimes degraded performance on MPS. "
                 "See e.g. https://github.com/pytorch/pytorch/issues/84936 for a discussion."
             )
+        elif device.type == "cpu":
+            set_cpu_num_threads(CPU_NUM_THREADS, CPU_NUM_INTEROP_THREADS)
 
         self.device = device
         self.predictor = build_sam2_video_predictor(
             model_cfg, checkpoint, device=device
         )
+        self.cpu_bf16_autocast = False
+        if device.type == "cpu":
+            optimize_model_for_cpu(
+                self.predictor,
+                channels_last=CPU_CHANNELS_LAST,
+                quantize_int8=CPU_QUANTIZE_INT8,
+            )
+            # (the int8 quantized linear layers only run with float32 inputs)
+            if CPU_BF16_AUTOCAST == "auto":
+                self.cpu_bf16_autocast = is_cpu_bf16_supported()
+            else:
+                self.cpu_bf16_autocast = CPU_BF16_AUTOCAST == "1"
+            self.cpu_bf16_autocast &= not CPU_QUANTIZE_INT8
+            logger.info(
+                f"CPU inference with {CPU_CHANNELS_LAST=}, {CPU_QUANTIZE_INT8=} and "
+                f"bfloat16 autocast {'on' if self.cpu_bf16_autocast else 'off'}"
+            )
         self.inference_lock = Lock()
+        # notified when the propagation of a session has stopped
+        self.propagation_stopped = Condition(self.inference_lock)
+        # run the tracking steps of concurrent propagations in batched forward passes
+        self.predictor.step_scheduler = CrossSessionBatchScheduler(
+            self.predictor,
+            self.inference_lock,
+            max_wait_ms=PROPAGATION_BATCH_WAIT_MS,
+            max_batch_sessions=PROPAGATION_MAX_BATCH_SESSIONS or None,
+        )
 
     def autocast_context(self):
         if self.device.type == "cuda":
             return torch.autocast("cuda", dtype=torch.bfloat16)
+        elif self.device.type == "cpu":
+            return cpu_autocast_context(self.cpu_bf16_autocast)
         else:
             return contextlib.nullcontext()
 
@@ -103,25 +160,39 @@ class InferenceAPI:
             # for MPS devices, we offload the video frames to CPU by default to avoid
             # memory fragmentation in MPS (which sometimes crashes the entire process)
             offload_video_to_cpu = self.device.type == "mps"
+            # persist the image features of gallery videos (but not of uploaded videos)
+            feature_store_dir = None
+            if FEATURE_STORE_PATH is not None and Path(request.path).is_relative_to(
+                GALLERY_PATH
+            ):
+                feature_store_dir = FEATURE_STORE_PATH
             inference_state = self.predictor.init_state(
                 request.path,
                 offload_video_to_cpu=offload_video_to_cpu,
+                feature_cache_max_bytes=FEATURE_CACHE_MAX_MB * 1024**2,
+                feature_cache_max_cpu_bytes=FEATURE_CACHE_MAX_CPU_MB * 1024**2,
+                feature_store_dir=feature_store_dir,
             )
             self.session_states[session_id] = {
                 "canceled": False,
+                "propagating": False,
                 "state": inference_state,
             }
             return StartSessionResponse(session_id=session_id)
 
     def close_session(self, request: CloseSessionRequest) -> CloseSessionResponse:
-        is_successful = self.__clear_session_state(request.session_id)
-        return CloseSessionResponse(success=is_successful)
+        with self.inference_lock:
+            session = self.session_states.get(request.session_id, None)
+            if session is not None:
+                self.__stop_propagation(request.session_id, session)
+            is_successful = self.__clear_session_state(request.session_id)
+            return CloseSessionResponse(success=is_successful)
 
     def add_points(
         self, request: AddPointsRequest, test: str = ""
     ) -> PropagateDataResponse:
         with self.autocast_context(), self.inference_lock:
-            session = self.__get_session(request.session_id)
+            session = self.__get_idle_session(request.session_id)
             inference_state = session["state"]
 
             frame_idx = request.frame_index
@@ -141,7 +212,7 @@ class InferenceAPI:
                 normalize_coords=False,
             )
 
-            masks_binary = (masks > self.score_thresh)[:, 0].cpu().numpy()
+            masks_binary = (masks > self.score_thresh)[:, 0]
 
             rle_mask_list = self.__get_rle_mask_list(
                 object_ids=object_ids, masks=masks_binary
@@ -172,7 +243,7 @@ class InferenceAPI:
             logger.info(
                 f"add mask on frame {frame_idx} in session {session_id}: {obj_id=}, {mask.shape=}"
             )
-            session = self.__get_session(session_id)
+            session = self.__get_idle_session(session_id)
             inference_state = session["state"]
 
             frame_idx, obj_ids, video_res_masks = self.model.add_new_mask(
@@ -181,7 +252,7 @@ class InferenceAPI:
                 obj_id=obj_id,
                 mask=torch.tensor(mask > 0),
             )
-            masks_binary = (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
+            masks_binary = (video_res_masks > self.score_thresh)[:, 0]
 
             rle_mask_list = self.__get_rle_mask_list(
                 object_ids=obj_ids, masks=masks_binary
@@ -206,14 +277,14 @@ class InferenceAPI:
             logger.info(
                 f"clear inputs on frame {frame_idx} in session {session_id}: {obj_id=}"
             )
-            session = self.__get_session(session_id)
+            session = self.__get_idle_session(session_id)
             inference_state = session["state"]
             frame_idx, obj_ids, video_res_masks = (
                 self.predictor.clear_all_prompts_in_frame(
                     inference_state, frame_idx, obj_id
                 )
             )
-            masks_binary = (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
+            masks_binary = (video_res_masks > self.score_thresh)[:, 0]
 
             rle_mask_list = self.__get_rle_mask_list(
                 object_ids=obj_ids, masks=masks_binary
@@ -233,7 +304,7 @@ class InferenceAPI:
         with self.autocast_context(), self.inference_lock:
             session_id = request.session_id
             logger.info(f"clear all inputs across the video in session {session_id}")
-            session = self.__get_session(session_id)
+            session = self.__get_idle_session(session_id)
             inference_state = session["state"]
             self.predictor.reset_state(inference_state)
             return ClearPointsInVideoResponse(success=True)
@@ -246,7 +317,7 @@ class InferenceAPI:
             session_id = request.session_id
             obj_id = request.object_id
             logger.info(f"remove object in session {session_id}: {obj_id=}")
-            session = self.__get_session(session_id)
+            session = self.__get_idle_session(session_id)
             inference_state = session["state"]
             new_obj_ids, updated_frames = self.predictor.remove_object(
                 inference_state, obj_id
@@ -254,7 +325,7 @@ class InferenceAPI:
 
             results = []
             for frame_index, video_res_masks in updated_frames:
-                masks = (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
+                masks = (video_res_masks > self.score_thresh)[:, 0]
                 rle_mask_list = self.__get_rle_mask_list(
                     object_ids=new_obj_ids, masks=masks
                 )
@@ -282,72 +353,83 @@ class InferenceAPI:
         # Note that as this method is a generator, we also need to use autocast_context
         # in caller to this method to ensure that it's called under the correct context
         # (we've added `autocast_context` to `gen_track_with_mask_stream` in app.py).
-        with self.autocast_context(), self.inference_lock:
+        # The inference lock is only held while computing the outputs of each frame (and
+        # released by the step scheduler while waiting to batch the tracking steps with
+        # the other sessions), so that concurrent propagations can run together. Requests
+        # that change this session in the meantime cancel the propagation and wait for it
+        # to stop (see `__get_idle_session`).
+        with self.autocast_context():
             logger.info(
                 f"propagate in video in session {session_id}: "
                 f"{propagation_direction=}, {start_frame_idx=}, {max_frame_num_to_track=}"
             )
 
+            propagate_outputs = None
             try:
-                session = self.__get_session(session_id)
-                session["canceled"] = False
-
-                inference_state = session["state"]
-                if propagation_direction not in ["both", "forward", "backward"]:
-                    raise ValueError(
-                        f"invalid propagation direction: {propagation_direction}"
-                    )
-
-                # First doing the forward propagation
-                if propagation_direction in ["both", "forward"]:
-                    for outputs in self.predictor.propagate_in_video(
-                        inference_state=inference_state,
-                        start_frame_idx=start_frame_idx,
-                        max_frame_num_to_track=max_frame_num_to_track,
-                        reverse=False,
-                    ):
-                        if session["canceled"]:
-                            return None
-
-                        frame_idx, obj_ids, video_res_masks = outputs
-                        masks_binary = (
-                            (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
-                        )
-
-                        rle_mask_list = self.__get_rle_mask_list(
-                            object_ids=obj_ids, masks=masks_binary
+                with self.inference_lock:
+                    # stop any previous propagation of this session
+                    session = self.__get_idle_session(session_id)
+                    session["canceled"] = False
+
+                    inference_state = session["state"]
+                    if propagation_direction not in ["both", "forward", "backward"]:
+                        raise ValueError(
+                            f"invalid propagation direction: {propagation_direction}"
                         )
 
-                        yield PropagateDataResponse(
-                            frame_index=frame_idx,
-                            results=rle_mask_list,
-                        )
-
-                # Then doing the backward propagation (reverse in time)
-                if propagation_direction in ["both", "backward"]:
-                    for outputs in self.predictor.propagate_in_video(
+                    propagate_kwargs = dict(
                         inference_state=inference_state,
                         start_frame_idx=start_frame_idx,
                         max_frame_num_to_track=max_frame_num_to_track,
-                        reverse=True,
-                    ):
-                        if session["canceled"]:
-                            return None
-
-                        frame_idx, obj_ids, video_res_masks = outputs
-                        masks_binary = (
-                            (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
+                        prefetch_frames=PREFETCH_FRAMES,
+                        prefetch_batch_size=PREFETCH_BATCH_SIZE,
+                        early_stop_frames=PROPAGATION_EARLY_STOP_FRAMES,
+                        suspend_absent_frames=PROPAGATION_SUSPEND_ABSENT_FRAMES,
+                        lazy_output=True,
+                    )
+                    if propagation_direction == "both":
+                        # propagate forward and backward (reverse in time) at the same time
+                        propagate_outputs = (
+                            self.predictor.propagate_in_video_bidirectional(
+                                **propagate_kwargs
+                            )
                         )
-
-                        rle_mask_list = self.__get_rle_mask_list(
-                            object_ids=obj_ids, masks=masks_binary
+                    else:
+                        propagate_outputs = self.predictor.propagate_in_video(
+                            reverse=propagation_direction == "backward",
+                            **propagate_kwargs,
                         )
+                    # the other requests on this session wait for the propagation to stop
+                    session["propagating"] = True
+
+                with self.predictor.step_scheduler.activate():
+                    while True:
+                        with self.inference_lock:
+                            if session["canceled"]:
+                                return None
+                            outputs = next(propagate_outputs, None)
+                            if outputs is None:
+                                break
+
+                            frame_idx, obj_ids, video_res_masks = outputs
+                            # only upsample the mask scores around each object
+                            masks_binary = video_res_masks.to_binary(self.score_thresh)
+
+                            rle_mask_list = self.__get_rle_mask_list(
+                                object_ids=obj_ids, masks=masks_binary
+                            )
 
                         yield PropagateDataResponse(
                             frame_index=frame_idx,
                             results=rle_mask_list,
                         )
             finally:
+                if propagate_outputs is not None:
+                    # stop the propagation (e.g. its prefetching) under the lock
+                    with self.inference_lock:
+                        propagate_outputs.close()
+                        session["propagating"] = False
+                        self.propagation_stopped.notify_all()
                 # Log upon completion (so that e.g. we can see if two propagations happen in parallel).
                 # Using `finally` here to log even when the tracking is aborted with GeneratorExit.
                 logger.info(
@@ -362,24 +444,25 @@ class InferenceAPI:
         return CancelPorpagateResponse(success=True)
 
     def __get_rle_mask_list(
-        self, object_ids: List[int], masks: np.ndarray
+        self, object_ids: List[int], masks: torch.Tensor
     ) -> List[PropagateDataValue]:
         """
         Return a list of data values, i.e. list of object/mask combos.
         """
+        # encode the masks of all objects on their device, so that only the compressed
+        # RLE counts are copied to the host
+        mask_rles = mask_to_coco_rle_pytorch(masks)
         return [
-            self.__get_mask_for_object(object_id=object_id, mask=mask)
-            for object_id, mask in zip(object_ids, masks)
+            self.__get_mask_for_object(object_id=object_id, mask_rle=mask_rle)
+            for object_id, mask_rle in zip(object_ids, mask_rles)
         ]
 
     def __get_mask_for_object(
-        self, object_id: int, mask: np.ndarray
+        self, object_id: int, mask_rle: Dict[str, Any]
     ) -> PropagateDataValue:
         """
         Create a data value for an object/mask combo.
         """
-        mask_rle = encode_masks(np.array(mask, dtype=np.uint8, order="F"))
-        mask_rle["counts"] = mask_rle["counts"].decode()
         return PropagateDataValue(
             object_id=object_id,
             mask=Mask(
@@ -396,14 +479,39 @@ class InferenceAPI:
             )
         return session
 
+    def __get_idle_session(self, session_id: str):
+        """
+        Get a session whose state can be changed (to be called with the inference lock
+        held), i.e. canceling its propagation in progress and waiting for it to stop.
+        """
+        session = self.__get_session(session_id)
+        self.__stop_propagation(session_id, session)
+        return session
+
+    def __stop_propagation(self, session_id: str, session: Dict[str, Any]):
+        deadline = time.monotonic() + PROPAGATION_STOP_TIMEOUT_S
+        while session["propagating"]:
+            session["canceled"] = True
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise RuntimeError(
+                    f"Cannot change session {session_id} while it's propagating"
+                )
+            # (this releases the inference lock so the propagation can stop)
+            self.propagation_stopped.wait(timeout=timeout)
+
     def __get_session_stats(self):
         """Get a statistics string for live sessions and their GPU usage."""
         # print both the session ids and their video frame numbers
-        live_session_strs = [
-            f"'{session_id}' ({session['state']['num_frames']} frames, "
-            f"{len(session['state']['obj_ids'])} objects)"
-            for session_id, session in self.session_states.items()
-        ]
+        live_session_strs = []
+        for session_id, session in self.session_states.items():
+            cache_stats = self.predictor.get_feature_cache_stats(session["state"])
+            live_session_strs.append(
+                f"'{session_id}' ({session['state']['num_frames']} frames, "
+                f"{len(session['state']['obj_ids'])} objects, feature cache: "
+                f"{cache_stats['num_frames']} frames, "
+                f"{cache_stats['hit_rate']:.0%} hit rate)"
+            )
         session_stats_str = (
             "Test String Here - -"
             f"live sessions: [{', '.join(live_session_strs)}], GPU memory: "
@@ -53,6 +53,7 @@ class SAM2AutomaticMaskGenerator:
         output_mode: str = "binary_mask",
         use_m2m: bool = False,
         multimask_output: bool = True,
+        crops_per_batch: int = 8,
         **kwargs,
     ) -> None:
         """
@@ -101,6 +102,9 @@ class SAM2AutomaticMaskGenerator:
             memory.
           use_m2m (bool): Whether to add a one step refinement using previous mask predictions.
           multimask_output (bool): Whether to output multimask at each point of the grid.
+          crops_per_batch (int): Sets the number of image crops (including the
+            full image) embedded simultaneously by the image encoder. Higher
+            numbers may be faster but use more GPU memory.
         """
 
         assert (points_per_side is None) != (
@@ -144,6 +148,7 @@ class SAM2AutomaticMaskGenerator:
         self.crop_nms_thresh = crop_nms_thresh
         self.crop_overlap_ratio = crop_overlap_ratio
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
+        self.crops_per_batch = crops_per_batch
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
         self.use_m2m = use_m2m
@@ -227,11 +232,21 @@ class SAM2AutomaticMaskGenerator:
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        # Iterate over image crops
+        # Iterate over image crops, calculating the embeddings of a batch of crops at once
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        for batch_crop_boxes, batch_layer_idxs in batch_iterator(
+            self.crops_per_batch, crop_boxes, layer_idxs
+        ):
+            cropped_ims = [
+                image[y0:y1, x0:x1, :] for x0, y0, x1, y1 in batch_crop_boxes
+            ]
+            self.predictor.set_image_batch(cropped_ims)
+            for img_idx, (crop_box, layer_idx) in enumerate(
+                zip(batch_crop_boxes, batch_layer_idxs)
+            ):
+                crop_data = self._process_crop(img_idx, crop_box, layer_idx, orig_size)
+                data.cat(crop_data)
+            self.predictor.reset_predictor()
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -250,16 +265,13 @@ class SAM2AutomaticMaskGenerator:
 
     def _process_crop(
         self,
-        image: np.ndarray,
+        img_idx: int,
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
     ) -> MaskData:
-        # Crop the image and calculate embeddings
-        x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
-        cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        # The cropped image is the `img_idx`-th one in the image batch of the predictor
+        cropped_im_size = self.predictor._orig_hw[img_idx]
 
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
@@ -269,11 +281,15 @@ class SAM2AutomaticMaskGenerator:
         data = MaskData()
         for (points,) in batch_iterator(self.points_per_batch, points_for_image):
             batch_data = self._process_batch(
-                points, cropped_im_size, crop_box, orig_size, normalize=True
+                points,
+                cropped_im_size,
+                crop_box,
+                orig_size,
+                normalize=True,
+                img_idx=img_idx,
             )
             data.cat(batch_data)
             del batch_data
-        self.predictor.reset_predictor()
 
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
@@ -298,6 +314,7 @@ class SAM2AutomaticMaskGenerator:
         crop_box: List[int],
         orig_size: Tuple[int, ...],
         normalize=False,
+        img_idx: int = -1,
     ) -> MaskData:
         orig_h, orig_w = orig_size
 
@@ -316,6 +333,7 @@ class SAM2AutomaticMaskGenerator:
             in_labels[:, None],
             multimask_output=self.multimask_output,
             return_logits=True,
+            img_idx=img_idx,
         )
 
         # Serialize predictions and store in MaskData
@@ -349,7 +367,11 @@ class SAM2AutomaticMaskGenerator:
                 in_points.shape[0], dtype=torch.int, device=in_points.device
             )
             masks, ious = self.refine_with_m2m(
-                in_points, labels, data["low_res_masks"], self.points_per_batch
+                in_points,
+                labels,
+                data["low_res_masks"],
+                self.points_per_batch,
+                img_idx=img_idx,
             )
             data["masks"] = masks.squeeze(1)
             data["iou_preds"] = ious.squeeze(1)
@@ -434,7 +456,9 @@ class SAM2AutomaticMaskGenerator:
 
         return mask_data
 
-    def refine_with_m2m(self, points, point_labels, low_res_masks, points_per_batch):
+    def refine_with_m2m(
+        self, points, point_labels, low_res_masks, points_per_batch, img_idx=-1
+    ):
         new_masks = []
         new_iou_preds = []
 
@@ -447,6 +471,7 @@ class SAM2AutomaticMaskGenerator:
                 mask_input=low_res_mask[:, None, :],
                 multimask_output=False,
                 return_logits=True,
+                img_idx=img_idx,
             )
             new_masks.append(best_masks)
             new_iou_preds.append(best_iou_preds)
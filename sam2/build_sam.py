@@ -89,9 +89,7 @@ def build_sam2(
     # Read config and init model
     cfg = compose(config_name=config_file, overrides=hydra_overrides_extra)
     OmegaConf.resolve(cfg)
-    model = instantiate(cfg.model, _recursive_=True)
-    _load_checkpoint(model, ckpt_path)
-    model = model.to(device)
+    model = _instantiate_model(cfg, ckpt_path, device)
     if mode == "eval":
         model.eval()
     return model
@@ -105,16 +103,27 @@ def build_sam2_video_predictor(
     hydra_overrides_extra=[],
     apply_postprocessing=True,
     vos_optimized=False,
+    aot_cache_dir=None,
+    aot_autocast_dtype=None,
     **kwargs,
 ):
     hydra_overrides = [
         "++model._target_=sam2.sam2_video_predictor.SAM2VideoPredictor",
     ]
-    if vos_optimized:
+    if vos_optimized and aot_cache_dir is not None:
+        # run the components compiled ahead of time (see `sam2.utils.aot_compile`)
+        # instead of compiling them on every start
+        hydra_overrides = [
+            "++model._target_=sam2.sam2_video_predictor.SAM2VideoPredictorVOS",
+            "++model.compile_all_components=false",
+        ]
+    elif vos_optimized:
         hydra_overrides = [
             "++model._target_=sam2.sam2_video_predictor.SAM2VideoPredictorVOS",
             "++model.compile_image_encoder=True",  # Let sam2_base handle this
         ]
+    elif aot_cache_dir is not None:
+        raise ValueError("aot_cache_dir is only supported with vos_optimized=True")
 
     if apply_postprocessing:
         hydra_overrides_extra = hydra_overrides_extra.copy()
@@ -133,14 +142,55 @@ def build_sam2_video_predictor(
     # Read config and init model
     cfg = compose(config_name=config_file, overrides=hydra_overrides)
     OmegaConf.resolve(cfg)
-    model = instantiate(cfg.model, _recursive_=True)
-    _load_checkpoint(model, ckpt_path)
-    model = model.to(device)
+    model = _instantiate_model(cfg, ckpt_path, device)
     if mode == "eval":
         model.eval()
+    if aot_cache_dir is not None:
+        from sam2.utils.aot_compile import load_or_compile_aot_backend
+
+        # (the packages are compiled for the autocast the predictor is run with)
+        model.backend = load_or_compile_aot_backend(
+            model,
+            aot_cache_dir,
+            config=OmegaConf.to_yaml(cfg.model),
+            autocast_dtype=aot_autocast_dtype,
+        )
     return model
 
 
+def build_sam2_cascade_video_predictor(
+    small_config_file,
+    small_ckpt_path,
+    large_config_file,
+    large_ckpt_path,
+    device="cuda",
+    iou_thresh=0.8,
+    object_score_margin=2.0,
+    num_backfill_frames=1,
+    **kwargs,
+):
+    """
+    Build a `SAM2CascadeVideoPredictor` tracking with a small model and re-running a large
+    model on the objects it isn't confident about (the other arguments are passed to
+    `build_sam2_video_predictor` for both models).
+    """
+    from sam2.sam2_cascade_video_predictor import SAM2CascadeVideoPredictor
+
+    small_predictor = build_sam2_video_predictor(
+        small_config_file, small_ckpt_path, device=device, **kwargs
+    )
+    large_predictor = build_sam2_video_predictor(
+        large_config_file, large_ckpt_path, device=device, **kwargs
+    )
+    return SAM2CascadeVideoPredictor(
+        small_predictor,
+        large_predictor,
+        iou_thresh=iou_thresh,
+        object_score_margin=object_score_margin,
+        num_backfill_frames=num_backfill_frames,
+    )
+
+
 def _hf_download(model_id):
     from huggingface_hub import hf_hub_download
 
@@ -161,10 +211,42 @@ def build_sam2_video_predictor_hf(model_id, **kwargs):
     )
 
 
-def _load_checkpoint(model, ckpt_path):
+def _instantiate_model(cfg, ckpt_path, device):
+    """
+    Instantiate the model of a config on `device` with the weights of a checkpoint. The
+    model is built on the meta device (skipping the random initialization of its weights)
+    and then assigned the checkpoint weights, so that they're only materialized once.
+    """
+    if ckpt_path is None:
+        model = instantiate(cfg.model, _recursive_=True)
+        return model.to(device)
+    with torch.device("meta"):
+        model = instantiate(cfg.model, _recursive_=True)
+    _load_checkpoint(model, ckpt_path, device=device)
+    return model.to(device)
+
+
+def _load_checkpoint(model, ckpt_path, device="cpu"):
+    """
+    Load the weights of a checkpoint into a model (by assigning them, so that it can be
+    on the meta device), either a PyTorch checkpoint with the weights under "model",
+    which is memory-mapped instead of being read as a whole, or a safetensors file (see
+    `tools/convert_checkpoint_to_safetensors.py`), whose weights are loaded on `device`.
+    """
     if ckpt_path is not None:
-        sd = torch.load(ckpt_path, map_location="cpu", weights_only=True)["model"]
-        missing_keys, unexpected_keys = model.load_state_dict(sd)
+        if ckpt_path.endswith(".safetensors"):
+            try:
+                from safetensors.torch import load_file
+            except ImportError as e:
+                print("Please install safetensors")
+                raise e
+
+            sd = load_file(ckpt_path, device=str(device))
+        else:
+            sd = torch.load(
+                ckpt_path, map_location="cpu", mmap=True, weights_only=True
+            )["model"]
+        missing_keys, unexpected_keys = model.load_state_dict(sd, assign=True)
         if missing_keys:
             logging.error(missing_keys)
             raise RuntimeError()
@@ -225,9 +225,8 @@ class Hiera(nn.Module):
             torch.zeros(1, embed_dim, self.window_spec[0], self.window_spec[0])
         )
 
-        dpr = [
-            x.item() for x in torch.linspace(0, drop_path_rate, depth)
-        ]  # stochastic depth decay rule
+        # stochastic depth decay rule (on the CPU, even when building on the meta device)
+        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth, device="cpu")]
 
         cur_stage = 1
         self.blocks = nn.ModuleList()
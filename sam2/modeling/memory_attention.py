@@ -4,7 +4,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import torch
 from torch import nn, Tensor
@@ -63,20 +63,40 @@ class MemoryAttentionLayer(nn.Module):
         tgt = tgt + self.dropout1(tgt2)
         return tgt
 
-    def _forward_ca(self, tgt, memory, query_pos, pos, num_k_exclude_rope=0):
+    def _forward_ca(
+        self,
+        tgt,
+        memory,
+        query_pos,
+        pos,
+        num_k_exclude_rope=0,
+        memory_mask=None,
+        memory_kv=None,
+    ):
         kwds = {}
         if num_k_exclude_rope > 0:
             assert isinstance(self.cross_attn_image, RoPEAttention)
             kwds = {"num_k_exclude_rope": num_k_exclude_rope}
+        if memory_mask is not None:
+            kwds["attn_mask"] = memory_mask
 
         # Cross-Attention
         tgt2 = self.norm2(tgt)
-        tgt2 = self.cross_attn_image(
-            q=tgt2 + query_pos if self.pos_enc_at_cross_attn_queries else tgt2,
-            k=memory + pos if self.pos_enc_at_cross_attn_keys else memory,
-            v=memory,
-            **kwds,
-        )
+        q = tgt2 + query_pos if self.pos_enc_at_cross_attn_queries else tgt2
+        if memory_kv is not None:
+            # the memory is already projected into keys and values (see
+            # `MemoryAttention.project_memory`)
+            assert isinstance(self.cross_attn_image, RoPEAttention)
+            k, v = memory_kv
+            kwds.pop("num_k_exclude_rope", None)
+            tgt2 = self.cross_attn_image(q=q, k=k, v=v, kv_projected=True, **kwds)
+        else:
+            tgt2 = self.cross_attn_image(
+                q=q,
+                k=memory + pos if self.pos_enc_at_cross_attn_keys else memory,
+                v=memory,
+                **kwds,
+            )
         tgt = tgt + self.dropout2(tgt2)
         return tgt
 
@@ -87,11 +107,15 @@ class MemoryAttentionLayer(nn.Module):
         pos: Optional[Tensor] = None,
         query_pos: Optional[Tensor] = None,
         num_k_exclude_rope: int = 0,
+        memory_mask: Optional[Tensor] = None,
+        memory_kv: Optional[Tuple[Tensor, Tensor]] = None,
     ) -> torch.Tensor:
 
         # Self-Attn, Cross-Attn
         tgt = self._forward_sa(tgt, query_pos)
-        tgt = self._forward_ca(tgt, memory, query_pos, pos, num_k_exclude_rope)
+        tgt = self._forward_ca(
+            tgt, memory, query_pos, pos, num_k_exclude_rope, memory_mask, memory_kv
+        )
         # MLP
         tgt2 = self.norm3(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt2))))
@@ -123,6 +147,10 @@ class MemoryAttention(nn.Module):
         curr_pos: Optional[Tensor] = None,  # pos_enc for self-attention inputs
         memory_pos: Optional[Tensor] = None,  # pos_enc for cross-attention inputs
         num_obj_ptr_tokens: int = 0,  # number of object pointer *tokens*
+        memory_mask: Optional[Tensor] = None,  # [B, N] mask of valid memory tokens
+        # the memory already projected into the keys and values of each layer (see
+        # `project_memory`), in which case `memory` and `memory_pos` aren't used
+        memory_kv: Optional[List[Tuple[Tensor, Tensor]]] = None,
     ):
         if isinstance(curr, list):
             assert isinstance(curr_pos, list)
@@ -132,8 +160,13 @@ class MemoryAttention(nn.Module):
                 curr_pos[0],
             )
 
+        if memory_kv is not None:
+            assert len(memory_kv) == self.num_layers
+            memory_batch_size = memory_kv[0][0].shape[0]
+        else:
+            memory_batch_size = memory.shape[1]
         assert (
-            curr.shape[1] == memory.shape[1]
+            curr.shape[1] == memory_batch_size
         ), "Batch size must be the same for curr and memory"
 
         output = curr
@@ -144,19 +177,27 @@ class MemoryAttention(nn.Module):
             # Convert to batch first
             output = output.transpose(0, 1)
             curr_pos = curr_pos.transpose(0, 1)
-            memory = memory.transpose(0, 1)
-            memory_pos = memory_pos.transpose(0, 1)
+            if memory_kv is None:
+                memory = memory.transpose(0, 1)
+                memory_pos = memory_pos.transpose(0, 1)
 
-        for layer in self.layers:
+        if memory_mask is not None:
+            # broadcast the key padding mask over the attention heads and the queries
+            memory_mask = memory_mask[:, None, None, :]
+
+        for i, layer in enumerate(self.layers):
             kwds = {}
             if isinstance(layer.cross_attn_image, RoPEAttention):
                 kwds = {"num_k_exclude_rope": num_obj_ptr_tokens}
+            if memory_kv is not None:
+                kwds["memory_kv"] = memory_kv[i]
 
             output = layer(
                 tgt=output,
                 memory=memory,
                 pos=memory_pos,
                 query_pos=curr_pos,
+                memory_mask=memory_mask,
                 **kwds,
             )
         normed_output = self.norm(output)
@@ -167,3 +208,123 @@ class MemoryAttention(nn.Module):
             curr_pos = curr_pos.transpose(0, 1)
 
         return normed_output
+
+    def project_memory(
+        self, memory: Tensor, memory_pos: Optional[Tensor] = None, rope: bool = True
+    ) -> List[Tuple[Tensor, Tensor]]:
+        """
+        Project memory tokens of [N, B, C] shape (e.g. the spatial memory of a frame, or
+        the object pointers with `rope=False`) into the cross-attention keys and values
+        of each layer, in the format of `memory_kv` in `forward`, i.e. a list of `(k, v)`
+        of [B, num_heads, N, C_per_head] shape per layer. The keys and values of several
+        parts of the memory (projected separately) can be concatenated along dim 2.
+        """
+        memory_kv = []
+        for layer in self.layers:
+            assert isinstance(layer.cross_attn_image, RoPEAttention)
+            use_pos = layer.pos_enc_at_cross_attn_keys and memory_pos is not None
+            k, v = layer.cross_attn_image.project_kv(
+                k=(memory + memory_pos if use_pos else memory).transpose(0, 1),
+                v=memory.transpose(0, 1),
+                rope=rope,
+            )
+            memory_kv.append((k, v))
+        return memory_kv
+
+    def project_memory_pos(
+        self, memory_pos: Tensor, rope: bool = True
+    ) -> List[Optional[Tensor]]:
+        """
+        Project an additional positional encoding of memory tokens of [N, B, C] shape
+        into its contribution to the cross-attention keys of each layer (None for layers
+        without positional encoding in the keys), to be added to the keys projected
+        without it by `project_memory`.
+        """
+        memory_k_pos = []
+        for layer in self.layers:
+            if not layer.pos_enc_at_cross_attn_keys:
+                memory_k_pos.append(None)
+                continue
+            k_pos, _ = layer.cross_attn_image.project_kv(
+                k=memory_pos.transpose(0, 1), rope=rope, bias=False
+            )
+            memory_k_pos.append(k_pos)
+        return memory_k_pos
+
+
+class MemoryKVCache:
+    """
+    A cache of the spatial memory of each frame projected into the cross-attention keys
+    and values of each layer of `MemoryAttention` (with rotary-encoded keys), so that the
+    memory of a frame is only projected once while it stays in the memory bank (e.g. in
+    a propagation, only the memory of the previous frame is new on each frame).
+
+    The cached keys leave out the temporal positional encoding of the memory (which
+    changes with the distance between the memory frame and the current frame). As the
+    key projection is affine and the rotary encoding is linear, its contribution to the
+    keys (also cached, per temporal position) is added back to the cached keys, which
+    gives the same keys as projecting the memory with it (up to rounding).
+
+    The entries are keyed by the stored memory features of each frame (i.e. they're
+    invalidated when they're re-encoded), and an entry that hasn't been used on the last
+    `max_idle_frames` frames is evicted (as its frame has left the memory bank).
+    """
+
+    def __init__(self, max_idle_frames=2):
+        self.max_idle_frames = max_idle_frames
+        # id(maskmem_features) -> (maskmem_features, last used step, memory_kv)
+        self._entries = {}
+        # (temporal position, num tokens, device, dtype) -> memory_k_pos
+        self._pos_entries = {}
+        self._frame_idx = None
+        self._step = 0
+
+    def start_frame(self, frame_idx):
+        """Mark the start of the memory attention on a frame (to evict idle entries)."""
+        if frame_idx == self._frame_idx:
+            return
+        self._frame_idx = frame_idx
+        self._step += 1
+        self._entries = {
+            key: entry
+            for key, entry in self._entries.items()
+            if self._step - entry[1] <= self.max_idle_frames
+        }
+
+    def get_memory_kv(self, maskmem_features, device, project_fn):
+        """
+        Get the cached keys and values (on `device`) of a frame with the stored
+        `maskmem_features`, or compute them with `project_fn()` (as in
+        `MemoryAttention.project_memory`).
+        """
+        key = (id(maskmem_features), device, _get_autocast_dtype(device))
+        entry = self._entries.get(key)
+        if entry is None or entry[0] is not maskmem_features:
+            entry = (maskmem_features, self._step, project_fn())
+        else:
+            entry = (maskmem_features, self._step, entry[2])
+        self._entries[key] = entry
+        return entry[2]
+
+    def get_memory_k_pos(self, t_pos, num_tokens, device, project_fn):
+        """
+        Get the cached contribution of the temporal positional encoding `t_pos` to the
+        keys of a frame, or compute it with `project_fn()` (as in
+        `MemoryAttention.project_memory_pos`).
+        """
+        key = (t_pos, num_tokens, device, _get_autocast_dtype(device))
+        if key not in self._pos_entries:
+            self._pos_entries[key] = project_fn()
+        return self._pos_entries[key]
+
+    def clear(self):
+        self._entries = {}
+        self._pos_entries = {}
+        self._frame_idx = None
+
+
+def _get_autocast_dtype(device):
+    """The autocast dtype on `device` (or None without autocast), as part of cache keys."""
+    if torch.is_autocast_enabled(device.type):
+        return torch.get_autocast_dtype(device.type)
+    return None
@@ -237,3 +237,33 @@ def apply_rotary_enc(
             freqs_cis = freqs_cis.unsqueeze(2).expand(-1, -1, r, -1, -1).flatten(2, 3)
     xk_out = torch.view_as_real(xk_ * freqs_cis).flatten(3)
     return xq_out.type_as(xq).to(xq.device), xk_out.type_as(xk).to(xk.device)
+
+
+def apply_rotary_enc_real(
+    xq: torch.Tensor,
+    xk: torch.Tensor,
+    freqs_real: torch.Tensor,
+    repeat_freqs_k: bool = False,
+):
+    """
+    The same as `apply_rotary_enc`, using only real-valued operations (e.g. for ONNX
+    export, which doesn't support complex numbers), with `freqs_real` the real view of
+    `freqs_cis` (see `torch.view_as_real`).
+    """
+    # the rotation of each pair of channels (x0, x1) by the angle of freqs_cis
+    cos, sin = freqs_real[..., 0], freqs_real[..., 1]
+
+    def _rotate(x, cos, sin):
+        x0, x1 = x.float().reshape(*x.shape[:-1], -1, 2).unbind(-1)
+        x_out = torch.stack([x0 * cos - x1 * sin, x0 * sin + x1 * cos], dim=-1)
+        return x_out.flatten(-2).type_as(x)
+
+    xq_out = _rotate(xq, cos, sin)
+    if xk.shape[-2] == 0:
+        # no keys to rotate, due to dropout
+        return xq_out, xk
+    # repeat freqs along seq_len dim to match k seq_len
+    if repeat_freqs_k:
+        r = xk.shape[-2] // xq.shape[-2]
+        cos, sin = cos.repeat(r, 1), sin.repeat(r, 1)
+    return xq_out, _rotate(xk, cos, sin)
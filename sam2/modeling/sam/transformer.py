@@ -6,13 +6,17 @@
 
 import math
 from functools import partial
-from typing import Tuple, Type
+from typing import Optional, Tuple, Type
 
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
 
-from sam2.modeling.position_encoding import apply_rotary_enc, compute_axial_cis
+from sam2.modeling.position_encoding import (
+    apply_rotary_enc,
+    apply_rotary_enc_real,
+    compute_axial_cis,
+)
 from sam2.modeling.sam2_utils import MLP
 
 
@@ -227,7 +231,9 @@ class Attention(nn.Module):
         x = x.transpose(1, 2)
         return x.reshape(b, n_tokens, n_heads * c_per_head)  # B x N_tokens x C
 
-    def forward(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
+    def forward(
+        self, q: Tensor, k: Tensor, v: Tensor, attn_mask: Optional[Tensor] = None
+    ) -> Tensor:
         # Input projections
         q = self.q_proj(q)
         k = self.k_proj(k)
@@ -240,7 +246,9 @@ class Attention(nn.Module):
 
         dropout_p = self.dropout_p if self.training else 0.0
         # Attention
-        out = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+        out = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask, dropout_p=dropout_p
+        )
 
         out = self._recombine_heads(out)
         out = self.out_proj(out)
@@ -266,44 +274,117 @@ class RoPEAttention(Attention):
         self.compute_cis = partial(
             compute_axial_cis, dim=self.internal_dim // self.num_heads, theta=rope_theta
         )
-        freqs_cis = self.compute_cis(end_x=feat_sizes[0], end_y=feat_sizes[1])
+        # (computed on the CPU even when the model is built on the meta device, as they
+        # aren't loaded from the checkpoint, see `build_sam`)
+        with torch.device("cpu"):
+            freqs_cis = self.compute_cis(end_x=feat_sizes[0], end_y=feat_sizes[1])
         self.freqs_cis = (
             freqs_cis.to("cuda") if torch.cuda.is_available() else freqs_cis
         )
+        # the (cos, sin) of the rotations for `use_real_rope` below, precomputed so that
+        # traced graphs (e.g. for export) don't contain any complex operations
+        self.freqs_real = torch.view_as_real(self.freqs_cis)
         self.rope_k_repeat = rope_k_repeat
+        # whether to apply the rotary encoding with real-valued operations only (e.g. for
+        # ONNX export, which doesn't support complex numbers)
+        self.use_real_rope = False
+
+    def set_feat_sizes(self, feat_sizes):
+        """Recompute the rotary encoding for frames of `feat_sizes` ([w, h]) tokens."""
+        with torch.device("cpu"):
+            freqs_cis = self.compute_cis(end_x=feat_sizes[0], end_y=feat_sizes[1])
+        self.freqs_cis = freqs_cis.to(self.freqs_cis.device)
+        self.freqs_real = torch.view_as_real(self.freqs_cis)
+
+    def _get_freqs_cis(self, num_tokens, device):
+        """
+        The rotary encoding of the tokens of a (square) frame of `num_tokens` tokens (as
+        the (cos, sin) of the rotations if `use_real_rope`).
+        """
+        if self.freqs_cis.shape[0] != num_tokens:
+            w = h = math.sqrt(num_tokens)
+            self.set_feat_sizes((w, h))
+        self.freqs_cis = self.freqs_cis.to(device)
+        self.freqs_real = self.freqs_real.to(device)
+        return self.freqs_real if self.use_real_rope else self.freqs_cis
+
+    def _apply_rope(self, x: Tensor) -> Tensor:
+        """Apply the rotary encoding to the tokens of a single frame (in separate heads)."""
+        freqs_cis = self._get_freqs_cis(x.shape[-2], x.device)
+        # (`apply_rotary_enc` only rotates its first input if there are no keys)
+        x, _ = self._apply_rotary_enc(x, x[:, :, :0], freqs_cis=freqs_cis)
+        return x
+
+    def _apply_rotary_enc(self, xq, xk, freqs_cis, repeat_freqs_k=False):
+        if self.use_real_rope:
+            return apply_rotary_enc_real(xq, xk, freqs_cis, repeat_freqs_k)
+        return apply_rotary_enc(xq, xk, freqs_cis, repeat_freqs_k)
+
+    def project_kv(
+        self, k: Tensor, v: Optional[Tensor] = None, rope=True, bias=True
+    ) -> Tuple[Tensor, Optional[Tensor]]:
+        """
+        Project the keys `k` (and the values `v` if given) into the attention heads ahead
+        of `forward` with `kv_projected=True` (e.g. to reuse them on several calls), where
+        the keys (of a single frame) are rotary-encoded if `rope`. With `bias=False`, the
+        bias of the key projection is left out, which gives the part of the keys coming
+        from an additive term of `k` (e.g. a positional encoding) as the projection and
+        the rotary encoding are linear.
+        """
+        k_out = self.k_proj(k)
+        if not bias:
+            k_out = k_out - self.k_proj(torch.zeros_like(k[:, :1]))
+        k_out = self._separate_heads(k_out, self.num_heads)
+        if rope:
+            k_out = self._apply_rope(k_out)
+        v_out = None
+        if v is not None:
+            v_out = self._separate_heads(self.v_proj(v), self.num_heads)
+        return k_out, v_out
 
     def forward(
-        self, q: Tensor, k: Tensor, v: Tensor, num_k_exclude_rope: int = 0
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        num_k_exclude_rope: int = 0,
+        attn_mask: Optional[Tensor] = None,
+        kv_projected: bool = False,
     ) -> Tensor:
-        # Input projections
-        q = self.q_proj(q)
-        k = self.k_proj(k)
-        v = self.v_proj(v)
-
-        # Separate into heads
-        q = self._separate_heads(q, self.num_heads)
-        k = self._separate_heads(k, self.num_heads)
-        v = self._separate_heads(v, self.num_heads)
-
-        # Apply rotary position encoding
-        w = h = math.sqrt(q.shape[-2])
-        self.freqs_cis = self.freqs_cis.to(q.device)
-        if self.freqs_cis.shape[0] != q.shape[-2]:
-            self.freqs_cis = self.compute_cis(end_x=w, end_y=h).to(q.device)
-        if q.shape[-2] != k.shape[-2]:
-            assert self.rope_k_repeat
-
-        num_k_rope = k.size(-2) - num_k_exclude_rope
-        q, k[:, :, :num_k_rope] = apply_rotary_enc(
-            q,
-            k[:, :, :num_k_rope],
-            freqs_cis=self.freqs_cis,
-            repeat_freqs_k=self.rope_k_repeat,
-        )
+        if kv_projected:
+            # the keys and values are already projected into the attention heads (and
+            # the keys are already rotary-encoded), see `project_kv`
+            q = self._separate_heads(self.q_proj(q), self.num_heads)
+            q = self._apply_rope(q)
+        else:
+            # Input projections
+            q = self.q_proj(q)
+            k = self.k_proj(k)
+            v = self.v_proj(v)
+
+            # Separate into heads
+            q = self._separate_heads(q, self.num_heads)
+            k = self._separate_heads(k, self.num_heads)
+            v = self._separate_heads(v, self.num_heads)
+
+            # Apply rotary position encoding
+            freqs_cis = self._get_freqs_cis(q.shape[-2], q.device)
+            if q.shape[-2] != k.shape[-2]:
+                assert self.rope_k_repeat
+
+            num_k_rope = k.size(-2) - num_k_exclude_rope
+            q, k[:, :, :num_k_rope] = self._apply_rotary_enc(
+                q,
+                k[:, :, :num_k_rope],
+                freqs_cis=freqs_cis,
+                repeat_freqs_k=self.rope_k_repeat,
+            )
 
         dropout_p = self.dropout_p if self.training else 0.0
         # Attention
-        out = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+        out = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask, dropout_p=dropout_p
+        )
 
         out = self._recombine_heads(out)
         out = self.out_proj(out)
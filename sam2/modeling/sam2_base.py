@@ -4,6 +4,8 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import contextlib
+
 import torch
 import torch.distributed
 import torch.nn.functional as F
@@ -12,8 +14,13 @@ from torch.nn.init import trunc_normal_
 
 from sam2.modeling.sam.mask_decoder import MaskDecoder
 from sam2.modeling.sam.prompt_encoder import PromptEncoder
-from sam2.modeling.sam.transformer import TwoWayTransformer
-from sam2.modeling.sam2_utils import get_1d_sine_pe, MLP, select_closest_cond_frames
+from sam2.modeling.sam.transformer import RoPEAttention, TwoWayTransformer
+from sam2.modeling.sam2_utils import (
+    dequantize_per_channel_int8,
+    get_1d_sine_pe,
+    MLP,
+    select_closest_cond_frames,
+)
 
 # a large negative value as a placeholder score for missing objects
 NO_OBJ_SCORE = -1024.0
@@ -178,7 +185,19 @@ class SAM2Base(torch.nn.Module):
             self.no_obj_embed_spatial = torch.nn.Parameter(torch.zeros(1, self.mem_dim))
             trunc_normal_(self.no_obj_embed_spatial, std=0.02)
 
+        # an optional `sam2.utils.profiler.StageProfiler` to record the wall time of the
+        # tracking stages (it can be set or switched on and off at any time)
+        self.profiler = None
+        # an optional execution backend (e.g. `sam2.utils.onnx_backend.OnnxRuntimeBackend`)
+        # to run the image encoder, the SAM prompt encoder and mask decoder, the memory
+        # attention and the memory encoder in inference instead of their PyTorch modules
+        # (set before `set_image_size`, which checks it)
+        self.backend = None
+
         self._build_sam_heads()
+        # size the rotary encoding tables of the memory attention for `image_size` upfront
+        # (instead of on the first frame), so that they're constants in compiled graphs
+        self.set_image_size(image_size)
         self.max_cond_frames_in_attn = max_cond_frames_in_attn
 
         # Model compilation
@@ -198,6 +217,13 @@ class SAM2Base(torch.nn.Module):
     def device(self):
         return next(self.parameters()).device
 
+    def _profile_stage(self, name, **args):
+        """Record a stage of the tracking with `self.profiler` (if there's an enabled one)."""
+        profiler = self.profiler
+        if profiler is None or not profiler.enabled:
+            return contextlib.nullcontext()
+        return profiler.stage(name, **args)
+
     def forward(self, *args, **kwargs):
         raise NotImplementedError(
             "Please use the corresponding methods in SAM2VideoPredictor for inference or SAM2Train for training/fine-tuning"
@@ -254,6 +280,37 @@ class SAM2Base(torch.nn.Module):
         else:
             self.obj_ptr_tpos_proj = torch.nn.Identity()
 
+    def set_image_size(self, image_size):
+        """
+        Set the input resolution of the model, e.g. to run it at 512 or 768 instead of the
+        1024 it's trained at. The image encoder takes any multiple of 32 (its positional
+        embeddings are interpolated to the input size), and the feature sizes of the SAM
+        heads and the rotary encoding tables of the memory attention follow it. This speeds
+        up the image encoder (about 4x at 512) at some accuracy cost.
+
+        It applies to all the images and videos processed afterwards, so the inference
+        states of a video predictor should be initialized after setting it. It can't be
+        changed on a model with an execution `backend`, whose graphs are exported at a
+        fixed resolution (the model should be exported at the new resolution instead).
+        """
+        if self.backend is not None:
+            raise RuntimeError(
+                "Cannot change the image size of a model with an execution backend, "
+                f"whose graphs were exported at image size {self.image_size}."
+            )
+        if image_size % 32 != 0:
+            raise ValueError(f"image_size must be a multiple of 32, got {image_size}")
+        self.image_size = image_size
+        self.sam_image_embedding_size = image_size // self.backbone_stride
+        embedding_size = (self.sam_image_embedding_size, self.sam_image_embedding_size)
+        self.sam_prompt_encoder.input_image_size = (image_size, image_size)
+        self.sam_prompt_encoder.image_embedding_size = embedding_size
+        self.sam_prompt_encoder.mask_input_size = tuple(4 * x for x in embedding_size)
+        for module in self.memory_attention.modules():
+            if isinstance(module, RoPEAttention):
+                module.set_feat_sizes(embedding_size)
+        return self
+
     def _forward_sam_heads(
         self,
         backbone_features,
@@ -337,24 +394,19 @@ class SAM2Base(torch.nn.Module):
             # a learned `no_mask_embed` to indicate no mask input in this case).
             sam_mask_prompt = None
 
-        sparse_embeddings, dense_embeddings = self.sam_prompt_encoder(
-            points=(sam_point_coords, sam_point_labels),
-            boxes=None,
-            masks=sam_mask_prompt,
-        )
         (
             low_res_multimasks,
             ious,
             sam_output_tokens,
             object_score_logits,
-        ) = self.sam_mask_decoder(
+        ) = self._predict_sam_masks(
             image_embeddings=backbone_features,
-            image_pe=self.sam_prompt_encoder.get_dense_pe(),
-            sparse_prompt_embeddings=sparse_embeddings,
-            dense_prompt_embeddings=dense_embeddings,
+            high_res_features=high_res_features,
+            point_coords=sam_point_coords,
+            point_labels=sam_point_labels,
+            mask_inputs=sam_mask_prompt,
             multimask_output=multimask_output,
             repeat_image=False,  # the image is already batched
-            high_res_features=high_res_features,
         )
         if self.pred_obj_scores:
             is_obj_appearing = object_score_logits > 0
@@ -464,8 +516,57 @@ class SAM2Base(torch.nn.Module):
             object_score_logits,
         )
 
+    def _predict_sam_masks(
+        self,
+        image_embeddings,
+        high_res_features,
+        point_coords,
+        point_labels,
+        mask_inputs,
+        multimask_output,
+        repeat_image,
+    ):
+        """
+        Encode the point prompts (with boxes as points, or None) and the mask prompts (at
+        the prompt encoder's `mask_input_size`, or None) with the SAM prompt encoder, and
+        decode them into masks with the SAM mask decoder (see `MaskDecoder.forward` for
+        the outputs), or run them in the execution backend if it's set.
+        """
+        if self.backend is not None:
+            masks, iou_pred, mask_tokens_out, object_score_logits = (
+                self.backend.predict_masks(
+                    image_embeddings=image_embeddings,
+                    high_res_features=high_res_features,
+                    point_coords=point_coords,
+                    point_labels=point_labels,
+                    mask_inputs=mask_inputs,
+                    repeat_image=repeat_image,
+                )
+            )
+            return self.sam_mask_decoder.select_masks(
+                masks, iou_pred, mask_tokens_out, object_score_logits, multimask_output
+            )
+
+        sparse_embeddings, dense_embeddings = self.sam_prompt_encoder(
+            points=None if point_coords is None else (point_coords, point_labels),
+            boxes=None,
+            masks=mask_inputs,
+        )
+        return self.sam_mask_decoder(
+            image_embeddings=image_embeddings,
+            image_pe=self.sam_prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=multimask_output,
+            repeat_image=repeat_image,
+            high_res_features=high_res_features,
+        )
+
     def forward_image(self, img_batch: torch.Tensor):
         """Get the image feature on the input batch."""
+        if self.backend is not None:
+            # (the backend's image encoder includes the projections below)
+            return self.backend.forward_image(img_batch)
         backbone_out = self.image_encoder(img_batch)
         if self.use_high_res_features_in_sam:
             # precompute projected level 0 and level 1 features in SAM decoder
@@ -504,8 +605,19 @@ class SAM2Base(torch.nn.Module):
         output_dict,
         num_frames,
         track_in_reverse=False,  # tracking in reverse time order (for demo usage)
+        keyframe_stride=1,  # only every k-th frame is tracked (see `_get_memory_bank`)
+        memory_kv_cache=None,  # a `MemoryKVCache` of the projected memory (in eval)
     ):
-        """Fuse the current frame's visual feature map with previous memory."""
+        """
+        Fuse the current frame's visual feature map with previous memory.
+
+        `output_dict` is usually a single memory bank shared by all the B samples in the
+        batch. It can also be a list of B memory banks (one per sample, each holding the
+        outputs of a single object), in which case `frame_idx`, `num_frames`,
+        `track_in_reverse` and `memory_kv_cache` can also be per-sample lists. This allows
+        tracking objects with different memory histories (e.g. from different videos) in
+        one forward pass.
+        """
         B = current_vision_feats[-1].size(1)  # batch size on this frame
         C = self.hidden_dim
         H, W = feat_sizes[-1]  # top-level (lowest-resolution) feature size
@@ -516,138 +628,41 @@ class SAM2Base(torch.nn.Module):
             pix_feat = current_vision_feats[-1].permute(1, 2, 0).view(B, C, H, W)
             return pix_feat
 
-        num_obj_ptr_tokens = 0
-        tpos_sign_mul = -1 if track_in_reverse else 1
+        memory_mask = None
+        memory_kv = None
+        if self.training:
+            memory_kv_cache = None
         # Step 1: condition the visual features of the current frame on previous memories
-        if not is_init_cond_frame:
-            # Retrieve the memories encoded with the maskmem backbone
-            to_cat_memory, to_cat_memory_pos_embed = [], []
-            # Add conditioning frames's output first (all cond frames have t_pos=0 for
-            # when getting temporal positional embedding below)
-            assert len(output_dict["cond_frame_outputs"]) > 0
-            # Select a maximum number of temporally closest cond frames for cross attention
-            cond_outputs = output_dict["cond_frame_outputs"]
-            selected_cond_outputs, unselected_cond_outputs = select_closest_cond_frames(
-                frame_idx, cond_outputs, self.max_cond_frames_in_attn
-            )
-            t_pos_and_prevs = [(0, out) for out in selected_cond_outputs.values()]
-            # Add last (self.num_maskmem - 1) frames before current frame for non-conditioning memory
-            # the earliest one has t_pos=1 and the latest one has t_pos=self.num_maskmem-1
-            # We also allow taking the memory frame non-consecutively (with stride>1), in which case
-            # we take (self.num_maskmem - 2) frames among every stride-th frames plus the last frame.
-            stride = 1 if self.training else self.memory_temporal_stride_for_eval
-            for t_pos in range(1, self.num_maskmem):
-                t_rel = self.num_maskmem - t_pos  # how many frames before current frame
-                if t_rel == 1:
-                    # for t_rel == 1, we take the last frame (regardless of r)
-                    if not track_in_reverse:
-                        # the frame immediately before this frame (i.e. frame_idx - 1)
-                        prev_frame_idx = frame_idx - t_rel
-                    else:
-                        # the frame immediately after this frame (i.e. frame_idx + 1)
-                        prev_frame_idx = frame_idx + t_rel
-                else:
-                    # for t_rel >= 2, we take the memory frame from every r-th frames
-                    if not track_in_reverse:
-                        # first find the nearest frame among every r-th frames before this frame
-                        # for r=1, this would be (frame_idx - 2)
-                        prev_frame_idx = ((frame_idx - 2) // stride) * stride
-                        # then seek further among every r-th frames
-                        prev_frame_idx = prev_frame_idx - (t_rel - 2) * stride
-                    else:
-                        # first find the nearest frame among every r-th frames after this frame
-                        # for r=1, this would be (frame_idx + 2)
-                        prev_frame_idx = -(-(frame_idx + 2) // stride) * stride
-                        # then seek further among every r-th frames
-                        prev_frame_idx = prev_frame_idx + (t_rel - 2) * stride
-                out = output_dict["non_cond_frame_outputs"].get(prev_frame_idx, None)
-                if out is None:
-                    # If an unselected conditioning frame is among the last (self.num_maskmem - 1)
-                    # frames, we still attend to it as if it's a non-conditioning frame.
-                    out = unselected_cond_outputs.get(prev_frame_idx, None)
-                t_pos_and_prevs.append((t_pos, out))
-
-            for t_pos, prev in t_pos_and_prevs:
-                if prev is None:
-                    continue  # skip padding frames
-                # "maskmem_features" might have been offloaded to CPU in demo use cases,
-                # so we load it back to GPU (it's a no-op if it's already on GPU).
-                feats = prev["maskmem_features"].to(device, non_blocking=True)
-                to_cat_memory.append(feats.flatten(2).permute(2, 0, 1))
-                # Spatial positional encoding (it might have been offloaded to CPU in eval)
-                maskmem_enc = prev["maskmem_pos_enc"][-1].to(device)
-                maskmem_enc = maskmem_enc.flatten(2).permute(2, 0, 1)
-                # Temporal positional encoding
-                maskmem_enc = (
-                    maskmem_enc + self.maskmem_tpos_enc[self.num_maskmem - t_pos - 1]
-                )
-                to_cat_memory_pos_embed.append(maskmem_enc)
-
-            # Construct the list of past object pointers
-            if self.use_obj_ptrs_in_encoder:
-                max_obj_ptrs_in_encoder = min(num_frames, self.max_obj_ptrs_in_encoder)
-                # First add those object pointers from selected conditioning frames
-                # (optionally, only include object pointers in the past during evaluation)
-                if not self.training and self.only_obj_ptrs_in_the_past_for_eval:
-                    ptr_cond_outputs = {
-                        t: out
-                        for t, out in selected_cond_outputs.items()
-                        if (t >= frame_idx if track_in_reverse else t <= frame_idx)
-                    }
-                else:
-                    ptr_cond_outputs = selected_cond_outputs
-                pos_and_ptrs = [
-                    # Temporal pos encoding contains how far away each pointer is from current frame
-                    (
-                        (
-                            (frame_idx - t) * tpos_sign_mul
-                            if self.use_signed_tpos_enc_to_obj_ptrs
-                            else abs(frame_idx - t)
-                        ),
-                        out["obj_ptr"],
+        if isinstance(output_dict, (list, tuple)):
+            assert not is_init_cond_frame and len(output_dict) == B
+            with self._profile_stage("memory_bank"):
+                memory, memory_pos_embed, num_obj_ptr_tokens, memory_mask, memory_kv = (
+                    self._get_per_sample_memory_banks(
+                        frame_idx=frame_idx,
+                        output_dicts=output_dict,
+                        num_frames=num_frames,
+                        track_in_reverse=track_in_reverse,
+                        device=device,
+                        keyframe_stride=keyframe_stride,
+                        memory_kv_cache=memory_kv_cache,
                     )
-                    for t, out in ptr_cond_outputs.items()
-                ]
-                # Add up to (max_obj_ptrs_in_encoder - 1) non-conditioning frames before current frame
-                for t_diff in range(1, max_obj_ptrs_in_encoder):
-                    t = frame_idx + t_diff if track_in_reverse else frame_idx - t_diff
-                    if t < 0 or (num_frames is not None and t >= num_frames):
-                        break
-                    out = output_dict["non_cond_frame_outputs"].get(
-                        t, unselected_cond_outputs.get(t, None)
+                )
+        elif not is_init_cond_frame:
+            with self._profile_stage("memory_bank"):
+                memory, memory_pos_embed, num_obj_ptr_tokens, memory_kv_parts = (
+                    self._get_memory_bank(
+                        frame_idx=frame_idx,
+                        output_dict=output_dict,
+                        num_frames=num_frames,
+                        track_in_reverse=track_in_reverse,
+                        batch_size=B,
+                        device=device,
+                        keyframe_stride=keyframe_stride,
+                        memory_kv_cache=memory_kv_cache,
                     )
-                    if out is not None:
-                        pos_and_ptrs.append((t_diff, out["obj_ptr"]))
-                # If we have at least one object pointer, add them to the across attention
-                if len(pos_and_ptrs) > 0:
-                    pos_list, ptrs_list = zip(*pos_and_ptrs)
-                    # stack object pointers along dim=0 into [ptr_seq_len, B, C] shape
-                    obj_ptrs = torch.stack(ptrs_list, dim=0)
-                    # a temporal positional embedding based on how far each object pointer is from
-                    # the current frame (sine embedding normalized by the max pointer num).
-                    if self.add_tpos_enc_to_obj_ptrs:
-                        t_diff_max = max_obj_ptrs_in_encoder - 1
-                        tpos_dim = C if self.proj_tpos_enc_in_obj_ptrs else self.mem_dim
-                        obj_pos = torch.tensor(pos_list).to(
-                            device=device, non_blocking=True
-                        )
-                        obj_pos = get_1d_sine_pe(obj_pos / t_diff_max, dim=tpos_dim)
-                        obj_pos = self.obj_ptr_tpos_proj(obj_pos)
-                        obj_pos = obj_pos.unsqueeze(1).expand(-1, B, self.mem_dim)
-                    else:
-                        obj_pos = obj_ptrs.new_zeros(len(pos_list), B, self.mem_dim)
-                    if self.mem_dim < C:
-                        # split a pointer into (C // self.mem_dim) tokens for self.mem_dim < C
-                        obj_ptrs = obj_ptrs.reshape(
-                            -1, B, C // self.mem_dim, self.mem_dim
-                        )
-                        obj_ptrs = obj_ptrs.permute(0, 2, 1, 3).flatten(0, 1)
-                        obj_pos = obj_pos.repeat_interleave(C // self.mem_dim, dim=0)
-                    to_cat_memory.append(obj_ptrs)
-                    to_cat_memory_pos_embed.append(obj_pos)
-                    num_obj_ptr_tokens = obj_ptrs.shape[0]
-                else:
-                    num_obj_ptr_tokens = 0
+                )
+                if memory_kv_parts is not None:
+                    memory_kv, _ = self._cat_memory_kv([memory_kv_parts], device)
         else:
             # for initial conditioning frames, encode them without using any previous memory
             if self.directly_add_no_mem_embed:
@@ -657,23 +672,447 @@ class SAM2Base(torch.nn.Module):
                 return pix_feat_with_mem
 
             # Use a dummy token on the first frame (to avoid empty memory input to tranformer encoder)
-            to_cat_memory = [self.no_mem_embed.expand(1, B, self.mem_dim)]
-            to_cat_memory_pos_embed = [self.no_mem_pos_enc.expand(1, B, self.mem_dim)]
+            memory = self.no_mem_embed.expand(1, B, self.mem_dim)
+            memory_pos_embed = self.no_mem_pos_enc.expand(1, B, self.mem_dim)
+            num_obj_ptr_tokens = 0
+
+        # Step 2: Forward the memories through the transformer encoder
+        memory_attention = self.memory_attention
+        if self.backend is not None:
+            memory_attention = self.backend.memory_attention
+        with self._profile_stage("memory_attention"):
+            pix_feat_with_mem = memory_attention(
+                curr=current_vision_feats,
+                curr_pos=current_vision_pos_embeds,
+                memory=memory,
+                memory_pos=memory_pos_embed,
+                num_obj_ptr_tokens=num_obj_ptr_tokens,
+                memory_mask=memory_mask,
+                memory_kv=memory_kv,
+            )
+        # reshape the output (HW)BC => BCHW
+        pix_feat_with_mem = pix_feat_with_mem.permute(1, 2, 0).view(B, C, H, W)
+        return pix_feat_with_mem
+
+    def _get_memory_bank(
+        self,
+        frame_idx,
+        output_dict,
+        num_frames,
+        track_in_reverse,
+        batch_size,
+        device,
+        keyframe_stride=1,
+        memory_kv_cache=None,
+    ):
+        """
+        Collect the memories (and object pointers) from previous frames in `output_dict`
+        for the current frame. Returns the concatenated memory tokens and their positional
+        encoding in (N)BC format, and the number of object pointer tokens at their end.
+
+        With `memory_kv_cache`, the memories are instead projected into the keys and
+        values of the memory attention (see `MemoryAttention.project_memory`), with the
+        projection of the spatial memories taken from the cache when possible, and the
+        projected parts of the memory bank (to concatenate with `_cat_memory_kv`) are
+        returned in place of None as the last output (with None as the memory tokens and
+        their positional encoding).
+
+        With `keyframe_stride` k > 1 (when only every k-th frame is tracked), the memory
+        frames are selected in the same way among the keyframes (the multiples of k)
+        instead of all the frames, except that the last tracked frame is still used as
+        the most recent memory frame if it's right before the current frame.
+        """
+        B = batch_size
+        C = self.hidden_dim
+        num_obj_ptr_tokens = 0
+        tpos_sign_mul = -1 if track_in_reverse else 1
+        # Retrieve the memories encoded with the maskmem backbone
+        to_cat_memory, to_cat_memory_pos_embed = [], []
+        # Add conditioning frames's output first (all cond frames have t_pos=0 for
+        # when getting temporal positional embedding below)
+        assert len(output_dict["cond_frame_outputs"]) > 0
+        # Select a maximum number of temporally closest cond frames for cross attention
+        cond_outputs = output_dict["cond_frame_outputs"]
+        selected_cond_outputs, unselected_cond_outputs = select_closest_cond_frames(
+            frame_idx, cond_outputs, self.max_cond_frames_in_attn
+        )
+        t_pos_and_prevs = [(0, out) for out in selected_cond_outputs.values()]
+        # Add last (self.num_maskmem - 1) frames before current frame for non-conditioning memory
+        # the earliest one has t_pos=1 and the latest one has t_pos=self.num_maskmem-1
+        # We also allow taking the memory frame non-consecutively (with stride>1), in which case
+        # we take (self.num_maskmem - 2) frames among every stride-th frames plus the last frame.
+        stride = 1 if self.training else self.memory_temporal_stride_for_eval
+        # the index of the current frame among the keyframes, i.e. one after the keyframe
+        # before it (or one before the keyframe after it in reverse); for keyframe_stride=1,
+        # it's frame_idx itself
+        k = keyframe_stride
+        if not track_in_reverse:
+            keyframe_idx = (frame_idx - 1) // k + 1
+        else:
+            keyframe_idx = -(-(frame_idx + 1) // k) - 1
+        for t_pos in range(1, self.num_maskmem):
+            t_rel = self.num_maskmem - t_pos  # how many frames before current frame
+            if t_rel == 1:
+                # for t_rel == 1, we take the last frame (regardless of r)
+                if not track_in_reverse:
+                    # the keyframe immediately before this frame (i.e. frame_idx - 1
+                    # for keyframe_stride=1)
+                    prev_frame_idx = (keyframe_idx - t_rel) * k
+                    last_frame_idx = frame_idx - 1
+                else:
+                    # the keyframe immediately after this frame (i.e. frame_idx + 1
+                    # for keyframe_stride=1)
+                    prev_frame_idx = (keyframe_idx + t_rel) * k
+                    last_frame_idx = frame_idx + 1
+                # (or the frame right next to this frame if it has also been tracked)
+                if last_frame_idx in output_dict["non_cond_frame_outputs"]:
+                    prev_frame_idx = last_frame_idx
+            else:
+                # for t_rel >= 2, we take the memory frame from every r-th frames
+                if not track_in_reverse:
+                    # first find the nearest frame among every r-th frames before this frame
+                    # for r=1, this would be (frame_idx - 2)
+                    prev_frame_idx = ((keyframe_idx - 2) // stride) * stride
+                    # then seek further among every r-th frames
+                    prev_frame_idx = prev_frame_idx - (t_rel - 2) * stride
+                else:
+                    # first find the nearest frame among every r-th frames after this frame
+                    # for r=1, this would be (frame_idx + 2)
+                    prev_frame_idx = -(-(keyframe_idx + 2) // stride) * stride
+                    # then seek further among every r-th frames
+                    prev_frame_idx = prev_frame_idx + (t_rel - 2) * stride
+                prev_frame_idx = prev_frame_idx * k
+            out = output_dict["non_cond_frame_outputs"].get(prev_frame_idx, None)
+            if out is None:
+                # If an unselected conditioning frame is among the last (self.num_maskmem - 1)
+                # frames, we still attend to it as if it's a non-conditioning frame.
+                out = unselected_cond_outputs.get(prev_frame_idx, None)
+            t_pos_and_prevs.append((t_pos, out))
+
+        to_cat_memory_kv = []
+        if memory_kv_cache is not None:
+            memory_kv_cache.start_frame(frame_idx)
+        for t_pos, prev in t_pos_and_prevs:
+            if prev is None:
+                continue  # skip padding frames
+            if memory_kv_cache is not None:
+                to_cat_memory_kv.append(
+                    self._get_cached_memory_kv(prev, t_pos, device, memory_kv_cache)
+                )
+                continue
+            feats, maskmem_enc = self._get_spatial_memory(prev, device)
+            to_cat_memory.append(feats)
+            # Temporal positional encoding
+            maskmem_enc = (
+                maskmem_enc + self.maskmem_tpos_enc[self.num_maskmem - t_pos - 1]
+            )
+            to_cat_memory_pos_embed.append(maskmem_enc)
+
+        # Construct the list of past object pointers
+        if self.use_obj_ptrs_in_encoder:
+            max_obj_ptrs_in_encoder = self.max_obj_ptrs_in_encoder
+            if num_frames is not None:
+                max_obj_ptrs_in_encoder = min(num_frames, max_obj_ptrs_in_encoder)
+            # First add those object pointers from selected conditioning frames
+            # (optionally, only include object pointers in the past during evaluation)
+            if not self.training and self.only_obj_ptrs_in_the_past_for_eval:
+                ptr_cond_outputs = {
+                    t: out
+                    for t, out in selected_cond_outputs.items()
+                    if (t >= frame_idx if track_in_reverse else t <= frame_idx)
+                }
+            else:
+                ptr_cond_outputs = selected_cond_outputs
+            pos_and_ptrs = [
+                # Temporal pos encoding contains how far away each pointer is from current frame
+                (
+                    (
+                        (frame_idx - t) * tpos_sign_mul
+                        if self.use_signed_tpos_enc_to_obj_ptrs
+                        else abs(frame_idx - t)
+                    ),
+                    out["obj_ptr"],
+                )
+                for t, out in ptr_cond_outputs.items()
+            ]
+            # Add up to (max_obj_ptrs_in_encoder - 1) non-conditioning frames before current frame
+            for t_diff in range(1, max_obj_ptrs_in_encoder):
+                t = frame_idx + t_diff if track_in_reverse else frame_idx - t_diff
+                if t < 0 or (num_frames is not None and t >= num_frames):
+                    break
+                out = output_dict["non_cond_frame_outputs"].get(
+                    t, unselected_cond_outputs.get(t, None)
+                )
+                if out is not None:
+                    pos_and_ptrs.append((t_diff, out["obj_ptr"]))
+            # If we have at least one object pointer, add them to the across attention
+            if len(pos_and_ptrs) > 0:
+                pos_list, ptrs_list = zip(*pos_and_ptrs)
+                # stack object pointers along dim=0 into [ptr_seq_len, B, C] shape
+                obj_ptrs = torch.stack(ptrs_list, dim=0)
+                # a temporal positional embedding based on how far each object pointer is from
+                # the current frame (sine embedding normalized by the max pointer num).
+                if self.add_tpos_enc_to_obj_ptrs:
+                    t_diff_max = max_obj_ptrs_in_encoder - 1
+                    tpos_dim = C if self.proj_tpos_enc_in_obj_ptrs else self.mem_dim
+                    obj_pos = torch.tensor(pos_list).to(
+                        device=device, non_blocking=True
+                    )
+                    obj_pos = get_1d_sine_pe(obj_pos / t_diff_max, dim=tpos_dim)
+                    obj_pos = self.obj_ptr_tpos_proj(obj_pos)
+                    obj_pos = obj_pos.unsqueeze(1).expand(-1, B, self.mem_dim)
+                else:
+                    obj_pos = obj_ptrs.new_zeros(len(pos_list), B, self.mem_dim)
+                if self.mem_dim < C:
+                    # split a pointer into (C // self.mem_dim) tokens for self.mem_dim < C
+                    obj_ptrs = obj_ptrs.reshape(-1, B, C // self.mem_dim, self.mem_dim)
+                    obj_ptrs = obj_ptrs.permute(0, 2, 1, 3).flatten(0, 1)
+                    obj_pos = obj_pos.repeat_interleave(C // self.mem_dim, dim=0)
+                if memory_kv_cache is not None:
+                    # (the object pointers don't use the rotary encoding)
+                    to_cat_memory_kv.append(
+                        (
+                            self.memory_attention.project_memory(
+                                obj_ptrs, obj_pos, rope=False
+                            ),
+                            None,
+                        )
+                    )
+                else:
+                    to_cat_memory.append(obj_ptrs)
+                    to_cat_memory_pos_embed.append(obj_pos)
+                num_obj_ptr_tokens = obj_ptrs.shape[0]
+            else:
+                num_obj_ptr_tokens = 0
+
+        if memory_kv_cache is not None:
+            return None, None, num_obj_ptr_tokens, to_cat_memory_kv
 
-        # Step 2: Concatenate the memories and forward through the transformer encoder
         memory = torch.cat(to_cat_memory, dim=0)
         memory_pos_embed = torch.cat(to_cat_memory_pos_embed, dim=0)
+        if not torch.is_autocast_enabled(device.type):
+            # the memory features might be stored in bfloat16 (e.g. in the predictor), so
+            # without autocast (e.g. in float32 on CPU), we cast them to the same dtype as
+            # their positional encoding (as otherwise only happens when they're promoted
+            # in `torch.cat` with the object pointers, which a frame might not have)
+            memory = memory.to(memory_pos_embed.dtype)
+        return memory, memory_pos_embed, num_obj_ptr_tokens, None
+
+    def _get_spatial_memory(self, prev, device):
+        """
+        Load the spatial memory features of a frame's output `prev` and their spatial
+        positional encoding on `device`, in (HW)BC format.
+        """
+        # "maskmem_features" might have been offloaded to CPU in demo use cases,
+        # so we load it back to GPU (it's a no-op if it's already on GPU).
+        feats = prev["maskmem_features"].to(device, non_blocking=True)
+        if prev.get("maskmem_features_scale") is not None:
+            # int8 memory features are dequantized on the fly (see the predictor's
+            # `quantize_maskmem_features` option)
+            scale = prev["maskmem_features_scale"].to(device, non_blocking=True)
+            feats = dequantize_per_channel_int8(feats, scale, torch.bfloat16)
+        feats = feats.flatten(2).permute(2, 0, 1)
+        # Spatial positional encoding (it might have been offloaded to CPU in eval)
+        maskmem_enc = prev["maskmem_pos_enc"][-1].to(device)
+        maskmem_enc = maskmem_enc.flatten(2).permute(2, 0, 1)
+        return feats, maskmem_enc
+
+    def _get_cached_memory_kv(self, prev, t_pos, device, memory_kv_cache):
+        """
+        Get the keys and values of the memory attention on the spatial memory of a frame's
+        output `prev` at the temporal position `t_pos`, where the projection of its memory
+        features (with their spatial positional encoding) is cached in `memory_kv_cache`
+        and the contribution of the temporal positional encoding is added to the keys.
+        """
+
+        def _project_memory():
+            feats, maskmem_enc = self._get_spatial_memory(prev, device)
+            if not torch.is_autocast_enabled(device.type):
+                feats = feats.to(maskmem_enc.dtype)  # (see `_get_memory_bank`)
+            return self.memory_attention.project_memory(feats, maskmem_enc)
 
-        pix_feat_with_mem = self.memory_attention(
-            curr=current_vision_feats,
-            curr_pos=current_vision_pos_embeds,
-            memory=memory,
-            memory_pos=memory_pos_embed,
-            num_obj_ptr_tokens=num_obj_ptr_tokens,
+        memory_kv = memory_kv_cache.get_memory_kv(
+            prev["maskmem_features"], device, _project_memory
         )
-        # reshape the output (HW)BC => BCHW
-        pix_feat_with_mem = pix_feat_with_mem.permute(1, 2, 0).view(B, C, H, W)
-        return pix_feat_with_mem
+        num_tokens = memory_kv[0][1].size(2)
+
+        def _project_memory_pos():
+            tpos_enc = self.maskmem_tpos_enc[self.num_maskmem - t_pos - 1]
+            return self.memory_attention.project_memory_pos(
+                tpos_enc.expand(num_tokens, 1, self.mem_dim)
+            )
+
+        memory_k_pos = memory_kv_cache.get_memory_k_pos(
+            t_pos, num_tokens, device, _project_memory_pos
+        )
+        return memory_kv, memory_k_pos
+
+    @staticmethod
+    def _cat_memory_kv(memory_kv_parts, device):
+        """
+        Concatenate the parts of the projected memory banks of a batch (as a list of the
+        parts of each memory bank from `_get_memory_bank`, i.e. `(memory_kv, memory_k_pos)`
+        where the optional `memory_k_pos` is added to the keys while they're copied) into
+        the keys and values of each layer. Shorter memory banks are padded at their end,
+        as marked in the returned `memory_mask` (None if no padding is needed).
+        """
+        # (each part has a (k, v) of [B, num_heads, N, C_per_head] shape per layer)
+        num_tokens = [
+            sum(kv[0][1].size(2) for kv, _ in parts) for parts in memory_kv_parts
+        ]
+        max_tokens = max(num_tokens)
+        batch_sizes = [parts[0][0][0][1].size(0) for parts in memory_kv_parts]
+        first_memory_kv = memory_kv_parts[0][0][0]
+        memory_mask = None
+        if min(num_tokens) < max_tokens:
+            memory_mask = torch.zeros(
+                sum(batch_sizes), max_tokens, dtype=torch.bool, device=device
+            )
+        memory_kv = []
+        for i, (_, first_v) in enumerate(first_memory_kv):
+            _, num_heads, _, head_dim = first_v.shape
+            shape = (sum(batch_sizes), num_heads, max_tokens, head_dim)
+            new_buffer = torch.empty if memory_mask is None else torch.zeros
+            k = new_buffer(shape, dtype=first_v.dtype, device=device)
+            v = new_buffer(shape, dtype=first_v.dtype, device=device)
+            batch_start = 0
+            for parts, batch_size in zip(memory_kv_parts, batch_sizes):
+                batch_end = batch_start + batch_size
+                start = 0
+                for kv, k_pos in parts:
+                    k_part, v_part = kv[i]
+                    end = start + v_part.size(2)
+                    v[batch_start:batch_end, :, start:end] = v_part
+                    if k_pos is None or k_pos[i] is None:
+                        k[batch_start:batch_end, :, start:end] = k_part
+                    else:
+                        torch.add(
+                            k_part, k_pos[i], out=k[batch_start:batch_end, :, start:end]
+                        )
+                    start = end
+                batch_start = batch_end
+            memory_kv.append((k, v))
+        if memory_mask is not None:
+            batch_start = 0
+            for n, batch_size in zip(num_tokens, batch_sizes):
+                memory_mask[batch_start : batch_start + batch_size, :n] = True
+                batch_start += batch_size
+        return memory_kv, memory_mask
+
+    def _get_per_sample_memory_banks(
+        self,
+        frame_idx,
+        output_dicts,
+        num_frames,
+        track_in_reverse,
+        device,
+        keyframe_stride=1,
+        memory_kv_cache=None,
+    ):
+        """
+        Collect a separate memory bank for each sample from its own `output_dicts` entry
+        and batch them together. Memory banks of different lengths are padded (spatial
+        memories with whole frames, object pointers with single tokens) and the padded
+        positions are marked as invalid in the returned `memory_mask` of [B, N] shape (it's
+        None if no padding is needed, which gives the same results as a shared bank).
+        With `memory_kv_cache`, the memory banks are projected (see `_get_memory_bank`)
+        and returned as `memory_kv` (with None as the memory tokens and encoding).
+        """
+        B = len(output_dicts)
+
+        def _per_sample(x):
+            return x if isinstance(x, (list, tuple)) else [x] * B
+
+        banks = [
+            self._get_memory_bank(
+                frame_idx=t,
+                output_dict=out_dict,
+                num_frames=n,
+                track_in_reverse=reverse,
+                batch_size=1,
+                device=device,
+                keyframe_stride=keyframe_stride,
+                memory_kv_cache=cache,
+            )
+            for t, out_dict, n, reverse, cache in zip(
+                _per_sample(frame_idx),
+                output_dicts,
+                _per_sample(num_frames),
+                _per_sample(track_in_reverse),
+                _per_sample(memory_kv_cache),
+            )
+        ]
+        if banks[0][3] is not None:
+            # the projected memory banks are padded at their end (as the rotary encoding
+            # is already applied, the object pointers don't need to be aligned)
+            memory_kv, memory_mask = self._cat_memory_kv(
+                [parts for _, _, _, parts in banks], device
+            )
+            num_obj_ptr_tokens = max(num_ptr for _, _, num_ptr, _ in banks)
+            return None, None, num_obj_ptr_tokens, memory_mask, memory_kv
+
+        num_spatial = [mem.size(0) - num_ptr for mem, _, num_ptr, _ in banks]
+        num_ptr = [num_ptr for _, _, num_ptr, _ in banks]
+        max_spatial, max_ptr = max(num_spatial), max(num_ptr)
+        if all(n == max_spatial for n in num_spatial) and all(
+            n == max_ptr for n in num_ptr
+        ):
+            memory = torch.cat([mem for mem, _, _, _ in banks], dim=1)
+            memory_pos_embed = torch.cat([pos for _, pos, _, _ in banks], dim=1)
+            return memory, memory_pos_embed, max_ptr, None, None
+
+        # pad the spatial memories and the object pointers to the same lengths
+        def _pad(seq, length):
+            if seq.size(0) < length:
+                padding = seq.new_zeros(length - seq.size(0), *seq.shape[1:])
+                seq = torch.cat([seq, padding], dim=0)
+            return seq
+
+        to_cat_memory, to_cat_memory_pos_embed, to_cat_mask = [], [], []
+        for (mem, pos, n_ptr, _), n_spatial in zip(banks, num_spatial):
+            to_cat_memory.append(
+                torch.cat(
+                    [
+                        _pad(mem[:n_spatial], max_spatial),
+                        _pad(mem[n_spatial:], max_ptr),
+                    ],
+                    dim=0,
+                )
+            )
+            to_cat_memory_pos_embed.append(
+                torch.cat(
+                    [
+                        _pad(pos[:n_spatial], max_spatial),
+                        _pad(pos[n_spatial:], max_ptr),
+                    ],
+                    dim=0,
+                )
+            )
+            mask = torch.zeros(max_spatial + max_ptr, dtype=torch.bool, device=device)
+            mask[:n_spatial] = True
+            mask[max_spatial : max_spatial + n_ptr] = True
+            to_cat_mask.append(mask)
+        memory = torch.cat(to_cat_memory, dim=1)
+        memory_pos_embed = torch.cat(to_cat_memory_pos_embed, dim=1)
+        memory_mask = torch.stack(to_cat_mask, dim=0)
+        return memory, memory_pos_embed, max_ptr, memory_mask, None
+
+    def _get_memory_reach(self, num_frames=None):
+        """
+        The maximum distance (in frames) from the current frame to a non-conditioning
+        frame whose memory or object pointer can be read by `_get_memory_bank` in eval.
+        """
+        reach = 0
+        if self.num_maskmem > 1:
+            # the farthest memory frame has t_rel = num_maskmem - 1 (see `_get_memory_bank`)
+            stride = self.memory_temporal_stride_for_eval
+            reach = (self.num_maskmem - 2) * stride + 1
+        if self.use_obj_ptrs_in_encoder:
+            max_obj_ptrs_in_encoder = self.max_obj_ptrs_in_encoder
+            if num_frames is not None:
+                max_obj_ptrs_in_encoder = min(num_frames, max_obj_ptrs_in_encoder)
+            reach = max(reach, max_obj_ptrs_in_encoder - 1)
+        return reach
 
     def _encode_new_memory(
         self,
@@ -708,7 +1147,10 @@ class SAM2Base(torch.nn.Module):
             mask_for_mem = mask_for_mem * self.sigmoid_scale_for_mem_enc
         if self.sigmoid_bias_for_mem_enc != 0.0:
             mask_for_mem = mask_for_mem + self.sigmoid_bias_for_mem_enc
-        maskmem_out = self.memory_encoder(
+        memory_encoder = self.memory_encoder
+        if self.backend is not None:
+            memory_encoder = self.backend.memory_encoder
+        maskmem_out = memory_encoder(
             pix_feat, mask_for_mem, skip_mask_sigmoid=True  # sigmoid already applied
         )
         maskmem_features = maskmem_out["vision_features"]
@@ -738,6 +1180,8 @@ class SAM2Base(torch.nn.Module):
         num_frames,
         track_in_reverse,
         prev_sam_mask_logits,
+        keyframe_stride=1,
+        memory_kv_cache=None,
     ):
         current_out = {"point_inputs": point_inputs, "mask_inputs": mask_inputs}
         # High-resolution feature maps for the SAM head, reshape (HW)BC => BCHW
@@ -758,16 +1202,19 @@ class SAM2Base(torch.nn.Module):
             )
         else:
             # fused the visual feature with previous memory features in the memory bank
-            pix_feat = self._prepare_memory_conditioned_features(
-                frame_idx=frame_idx,
-                is_init_cond_frame=is_init_cond_frame,
-                current_vision_feats=current_vision_feats[-1:],
-                current_vision_pos_embeds=current_vision_pos_embeds[-1:],
-                feat_sizes=feat_sizes[-1:],
-                output_dict=output_dict,
-                num_frames=num_frames,
-                track_in_reverse=track_in_reverse,
-            )
+            with self._profile_stage("memory_conditioning"):
+                pix_feat = self._prepare_memory_conditioned_features(
+                    frame_idx=frame_idx,
+                    is_init_cond_frame=is_init_cond_frame,
+                    current_vision_feats=current_vision_feats[-1:],
+                    current_vision_pos_embeds=current_vision_pos_embeds[-1:],
+                    feat_sizes=feat_sizes[-1:],
+                    output_dict=output_dict,
+                    num_frames=num_frames,
+                    track_in_reverse=track_in_reverse,
+                    keyframe_stride=keyframe_stride,
+                    memory_kv_cache=memory_kv_cache,
+                )
             # apply SAM-style segmentation head
             # here we might feed previously predicted low-res SAM mask logits into the SAM mask decoder,
             # e.g. in demo where such logits come from earlier interaction instead of correction sampling
@@ -776,13 +1223,14 @@ class SAM2Base(torch.nn.Module):
                 assert point_inputs is not None and mask_inputs is None
                 mask_inputs = prev_sam_mask_logits
             multimask_output = self._use_multimask(is_init_cond_frame, point_inputs)
-            sam_outputs = self._forward_sam_heads(
-                backbone_features=pix_feat,
-                point_inputs=point_inputs,
-                mask_inputs=mask_inputs,
-                high_res_features=high_res_features,
-                multimask_output=multimask_output,
-            )
+            with self._profile_stage("sam_heads"):
+                sam_outputs = self._forward_sam_heads(
+                    backbone_features=pix_feat,
+                    point_inputs=point_inputs,
+                    mask_inputs=mask_inputs,
+                    high_res_features=high_res_features,
+                    multimask_output=multimask_output,
+                )
 
         return current_out, sam_outputs, high_res_features, pix_feat
 
@@ -798,13 +1246,14 @@ class SAM2Base(torch.nn.Module):
     ):
         if run_mem_encoder and self.num_maskmem > 0:
             high_res_masks_for_mem_enc = high_res_masks
-            maskmem_features, maskmem_pos_enc = self._encode_new_memory(
-                current_vision_feats=current_vision_feats,
-                feat_sizes=feat_sizes,
-                pred_masks_high_res=high_res_masks_for_mem_enc,
-                object_score_logits=object_score_logits,
-                is_mask_from_pts=(point_inputs is not None),
-            )
+            with self._profile_stage("memory_encoder"):
+                maskmem_features, maskmem_pos_enc = self._encode_new_memory(
+                    current_vision_feats=current_vision_feats,
+                    feat_sizes=feat_sizes,
+                    pred_masks_high_res=high_res_masks_for_mem_enc,
+                    object_score_logits=object_score_logits,
+                    is_mask_from_pts=(point_inputs is not None),
+                )
             current_out["maskmem_features"] = maskmem_features
             current_out["maskmem_pos_enc"] = maskmem_pos_enc
         else:
@@ -831,6 +1280,10 @@ class SAM2Base(torch.nn.Module):
         run_mem_encoder=True,
         # The previously predicted SAM mask logits (which can be fed together with new clicks in demo).
         prev_sam_mask_logits=None,
+        # Only every k-th frame is tracked, so memories are selected among the keyframes.
+        keyframe_stride=1,
+        # A `MemoryKVCache` to reuse the projected memory across frames (in inference).
+        memory_kv_cache=None,
     ):
         current_out, sam_outputs, _, _ = self._track_step(
             frame_idx,
@@ -844,12 +1297,14 @@ class SAM2Base(torch.nn.Module):
             num_frames,
             track_in_reverse,
             prev_sam_mask_logits,
+            keyframe_stride,
+            memory_kv_cache,
         )
 
         (
             _,
             _,
-            _,
+            ious,
             low_res_masks,
             high_res_masks,
             obj_ptr,
@@ -863,6 +1318,8 @@ class SAM2Base(torch.nn.Module):
             # Only add this in inference (to avoid unused param in activation checkpointing;
             # it's mainly used in the demo to encode spatial memories w/ consolidated masks)
             current_out["object_score_logits"] = object_score_logits
+            # the predicted IoU of the output mask (i.e. how confident the tracking is)
+            current_out["iou_score"] = ious.max(dim=-1, keepdim=True).values
 
         # Finally run the memory encoder on the predicted mask to encode
         # it into a new memory feature (that can be used in future frames)
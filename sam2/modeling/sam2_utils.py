@@ -321,3 +321,19 @@ def get_next_point(gt_masks, pred_masks, method):
         return sample_one_point_from_error_center(gt_masks, pred_masks)
     else:
         raise ValueError(f"unknown sampling method {method}")
+
+
+def quantize_per_channel_int8(x):
+    """
+    Symmetrically quantize a [B, C, H, W] tensor to int8 with one scale per sample
+    and channel. Returns the int8 tensor and the [B, C, 1, 1] float32 scales.
+    """
+    x = x.float()
+    scale = x.abs().amax(dim=(2, 3), keepdim=True).clamp(min=1e-8) / 127.0
+    x_int8 = torch.round(x / scale).clamp(-127, 127).to(torch.int8)
+    return x_int8, scale
+
+
+def dequantize_per_channel_int8(x_int8, scale, dtype=torch.float32):
+    """Inverse of `quantize_per_channel_int8`."""
+    return (x_int8.to(scale.dtype) * scale).to(dtype)
@@ -0,0 +1,353 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+import torch.nn.functional as F
+
+from sam2.sam2_video_predictor import SAM2VideoPredictor
+
+
+class SAM2CascadeVideoPredictor:
+    """
+    A video predictor that tracks the objects with a small SAM 2 model (e.g. the tiny
+    one), and only re-runs a large model (e.g. the base+ or large one) on the objects
+    that the small model isn't confident about on a frame.
+
+    On each frame, the output of the small model for an object is accepted unless:
+    - the object is predicted to appear (a positive object score) with a predicted IoU
+      of its mask below `iou_thresh`,
+    - or whether it appears is ambiguous (its object score logit is within
+      `object_score_margin` of 0).
+    Otherwise, the object is tracked by the large model on that frame. The large model
+    then replaces the output of the small model, and its mask is encoded into the memory
+    of the small model in place of the small model's own prediction.
+
+    The large model keeps its own memory bank, which is fed from the accepted outputs:
+    before tracking an object on a frame, the accepted masks of the object on the
+    `num_backfill_frames` previous frames (in the tracking direction) that aren't already
+    in its memory bank are encoded into it, as mask inputs (which needs the image
+    features of the large model on these frames). The large model's memory bank also
+    holds the prompts and the frames it tracked itself.
+
+    The prompts are added to both models (and the outputs on the prompted frames are
+    those of the small model). Use `get_cascade_stats` to get the share of object-frames
+    tracked by the large model.
+    """
+
+    def __init__(
+        self,
+        small_predictor: SAM2VideoPredictor,
+        large_predictor: SAM2VideoPredictor,
+        iou_thresh=0.8,
+        object_score_margin=2.0,
+        num_backfill_frames=1,
+    ):
+        self.small_predictor = small_predictor
+        self.large_predictor = large_predictor
+        self.iou_thresh = iou_thresh
+        self.object_score_margin = object_score_margin
+        self.num_backfill_frames = num_backfill_frames
+
+    @torch.inference_mode()
+    def init_state(
+        self,
+        video_path,
+        offload_video_to_cpu=False,
+        offload_state_to_cpu=False,
+        async_loading_frames=False,
+    ):
+        """Initialize an inference state, with an inference state for each model."""
+        small_state = self.small_predictor.init_state(
+            video_path,
+            offload_video_to_cpu=offload_video_to_cpu,
+            offload_state_to_cpu=offload_state_to_cpu,
+            async_loading_frames=async_loading_frames,
+        )
+        large = self.large_predictor
+        if large.image_size == small_state["image_size"] and (
+            large.device == small_state["device"]
+        ):
+            # share the video frames loaded for the small model
+            large_state = {
+                k: small_state[k]
+                for k in [
+                    "video_path",
+                    "images",
+                    "num_frames",
+                    "offload_video_to_cpu",
+                    "video_height",
+                    "video_width",
+                    "streaming",
+                ]
+            }
+            large._init_state_storage(
+                large_state,
+                offload_state_to_cpu=offload_state_to_cpu,
+                feature_cache_max_bytes=0,
+                feature_cache_max_cpu_bytes=0,
+                evict_unreachable_memory=False,
+                evicted_mask_dir=None,
+            )
+            large_state["feature_store"] = None
+        else:
+            large_state = large._init_video_state(
+                video_path,
+                offload_video_to_cpu=offload_video_to_cpu,
+                offload_state_to_cpu=offload_state_to_cpu,
+                async_loading_frames=async_loading_frames,
+                feature_cache_max_bytes=0,
+                feature_cache_max_cpu_bytes=0,
+                evict_unreachable_memory=False,
+                evicted_mask_dir=None,
+                feature_store_dir=None,
+            )
+        inference_state = {"small": small_state, "large": large_state}
+        for k in ["num_frames", "video_height", "video_width"]:
+            inference_state[k] = small_state[k]
+        # the number of (non-prompted) object-frames tracked by the small model, and how
+        # many of them were tracked by the large model or backfilled into its memory
+        inference_state["stats"] = {
+            "num_obj_frames": 0,
+            "num_verified_obj_frames": 0,
+            "num_backfilled_obj_frames": 0,
+        }
+        return inference_state
+
+    @torch.inference_mode()
+    def add_new_points_or_box(self, inference_state, frame_idx, obj_id, **kwargs):
+        """Add new points or a box to a frame (see `SAM2VideoPredictor`)."""
+        self.large_predictor.add_new_points_or_box(
+            inference_state["large"], frame_idx, obj_id, **kwargs
+        )
+        return self.small_predictor.add_new_points_or_box(
+            inference_state["small"], frame_idx, obj_id, **kwargs
+        )
+
+    @torch.inference_mode()
+    def add_new_mask(self, inference_state, frame_idx, obj_id, mask):
+        """Add a new mask to a frame (see `SAM2VideoPredictor`)."""
+        self.large_predictor.add_new_mask(
+            inference_state["large"], frame_idx, obj_id, mask
+        )
+        return self.small_predictor.add_new_mask(
+            inference_state["small"], frame_idx, obj_id, mask
+        )
+
+    @torch.inference_mode()
+    def reset_state(self, inference_state):
+        """
+        Remove all input points or masks in all frames throughout the video. The cascade
+        stats keep counting across resets (e.g. over the separate runs of each object in
+        `tools/vos_inference.py`).
+        """
+        self.small_predictor.reset_state(inference_state["small"])
+        self.large_predictor.reset_state(inference_state["large"])
+
+    def get_cascade_stats(self, inference_state):
+        """
+        The number of object-frames tracked so far, and the share of them that were
+        tracked by the large model ("verified_ratio") or backfilled into its memory.
+        """
+        stats = dict(inference_state["stats"])
+        num_obj_frames = max(stats["num_obj_frames"], 1)
+        stats["verified_ratio"] = stats["num_verified_obj_frames"] / num_obj_frames
+        stats["backfilled_ratio"] = stats["num_backfilled_obj_frames"] / num_obj_frames
+        return stats
+
+    def get_memory_bank_nbytes(self, inference_state):
+        """Get the total size in bytes of the memory features of both models."""
+        return self.small_predictor.get_memory_bank_nbytes(
+            inference_state["small"]
+        ) + self.large_predictor.get_memory_bank_nbytes(inference_state["large"])
+
+    def _apply_non_overlapping_constraints(self, pred_masks):
+        return self.small_predictor._apply_non_overlapping_constraints(pred_masks)
+
+    @torch.inference_mode()
+    def propagate_in_video(
+        self,
+        inference_state,
+        start_frame_idx=None,
+        max_frame_num_to_track=None,
+        reverse=False,
+        suspend_absent_frames=0,
+        suspended_check_interval=5,
+        lazy_output=False,
+    ):
+        """
+        Propagate the prompts across frames to track in the entire video (see
+        `SAM2VideoPredictor.propagate_in_video`), with the small model, re-running the
+        large model on the objects it isn't confident about. The suspension of absent
+        objects applies to the small model (the suspended objects aren't re-run).
+        """
+        small = self.small_predictor
+        small_state = inference_state["small"]
+        self.large_predictor.propagate_in_video_preflight(inference_state["large"])
+        for frame_idx, obj_ids, masks in small.propagate_in_video(
+            small_state,
+            start_frame_idx=start_frame_idx,
+            max_frame_num_to_track=max_frame_num_to_track,
+            reverse=reverse,
+            suspend_absent_frames=suspend_absent_frames,
+            suspended_check_interval=suspended_check_interval,
+            lazy_output=True,
+        ):
+            low_res_masks = self._verify_frame(
+                inference_state, frame_idx, reverse, masks.low_res_masks
+            )
+            yield small._get_propagation_output(
+                small_state, (frame_idx, obj_ids, low_res_masks), lazy_output
+            )
+
+    def _verify_frame(self, inference_state, frame_idx, reverse, low_res_masks):
+        """
+        Re-run the large model on the objects that the small model isn't confident about
+        on a frame it just tracked, and replace their outputs in the small model's state.
+        Returns the low-resolution mask scores of all objects with the accepted outputs.
+        """
+        small_state = inference_state["small"]
+        stats = inference_state["stats"]
+        # the objects tracked on this frame (i.e. not prompted or suspended)
+        obj_inds = [
+            obj_idx
+            for obj_idx, obj_output_dict in small_state["output_dict_per_obj"].items()
+            if frame_idx in obj_output_dict["non_cond_frame_outputs"]
+        ]
+        if len(obj_inds) == 0:
+            return low_res_masks
+        outs = [
+            small_state["output_dict_per_obj"][obj_idx]["non_cond_frame_outputs"][
+                frame_idx
+            ]
+            for obj_idx in obj_inds
+        ]
+        # (with a single device-to-host copy)
+        scores = torch.cat(
+            [
+                torch.cat([out["iou_score"], out["object_score_logits"]], 1)
+                for out in outs
+            ]
+        )
+        obj_inds_to_verify = [
+            obj_idx
+            for obj_idx, (iou_score, object_score) in zip(
+                obj_inds, scores.float().tolist()
+            )
+            if abs(object_score) < self.object_score_margin
+            or (object_score > 0 and iou_score < self.iou_thresh)
+        ]
+        stats["num_obj_frames"] += len(obj_inds)
+        stats["num_verified_obj_frames"] += len(obj_inds_to_verify)
+        if len(obj_inds_to_verify) == 0:
+            return low_res_masks
+
+        large = self.large_predictor
+        large_state = inference_state["large"]
+        self._backfill_large_memory(
+            inference_state, obj_inds_to_verify, frame_idx, reverse
+        )
+        with large._profile_stage("cascade_verify", frames=[frame_idx]):
+            large_outs, large_masks = large._run_batched_obj_inference(
+                large_state,
+                obj_inds=obj_inds_to_verify,
+                frame_idx=frame_idx,
+                reverse=reverse,
+            )
+        low_res_masks = list(low_res_masks.split(1))
+        for obj_idx, large_out, pred_masks in zip(
+            obj_inds_to_verify, large_outs, large_masks
+        ):
+            large_state["output_dict_per_obj"][obj_idx]["non_cond_frame_outputs"][
+                frame_idx
+            ] = large_out
+            large_state["frames_tracked_per_obj"][obj_idx][frame_idx] = {
+                "reverse": reverse
+            }
+            pred_masks = self._resize_low_res_masks(pred_masks, self.small_predictor)
+            self._accept_mask(
+                self.small_predictor,
+                small_state,
+                obj_idx,
+                frame_idx,
+                reverse,
+                pred_masks,
+            )
+            low_res_masks[obj_idx] = pred_masks
+        return torch.cat(low_res_masks, dim=0)
+
+    def _backfill_large_memory(self, inference_state, obj_inds, frame_idx, reverse):
+        """
+        Encode the accepted masks of objects on the frames before `frame_idx` (in the
+        tracking direction) into the memory bank of the large model, where it's missing.
+        """
+        small, large = self.small_predictor, self.large_predictor
+        small_state, large_state = inference_state["small"], inference_state["large"]
+        for i in range(self.num_backfill_frames, 0, -1):
+            t = frame_idx + i if reverse else frame_idx - i
+            if t < 0 or t >= small_state["num_frames"]:
+                continue
+            for obj_idx in obj_inds:
+                large_output_dict = large_state["output_dict_per_obj"][obj_idx]
+                if (
+                    t in large_output_dict["cond_frame_outputs"]
+                    or t in large_output_dict["non_cond_frame_outputs"]
+                ):
+                    continue
+                out = small_state["output_dict_per_obj"][obj_idx][
+                    "non_cond_frame_outputs"
+                ].get(t)
+                if out is None:
+                    continue  # not tracked on this frame
+                pred_masks = small._get_stored_pred_masks(out, large_state["device"])
+                pred_masks = self._resize_low_res_masks(pred_masks, large)
+                with large._profile_stage("cascade_backfill", frames=[t]):
+                    self._accept_mask(
+                        large, large_state, obj_idx, t, reverse, pred_masks
+                    )
+                inference_state["stats"]["num_backfilled_obj_frames"] += 1
+
+    @staticmethod
+    def _resize_low_res_masks(pred_masks, predictor):
+        """Resize low-resolution mask scores to those of `predictor` (if needed)."""
+        size = predictor.image_size // 4
+        if pred_masks.shape[-2:] == (size, size):
+            return pred_masks
+        return F.interpolate(
+            pred_masks, size=(size, size), mode="bilinear", align_corners=False
+        )
+
+    @staticmethod
+    def _accept_mask(predictor, inference_state, obj_idx, frame_idx, reverse, masks):
+        """
+        Set the low-resolution mask scores `masks` as the output of an object on a frame
+        in the state of `predictor`, with their memory encoded from the mask (as for a
+        mask input, see `SAM2Base._use_mask_as_output`).
+        """
+        mask_inputs = F.interpolate(
+            masks,
+            size=(predictor.image_size, predictor.image_size),
+            mode="bilinear",
+            align_corners=False,
+        )
+        mask_inputs = (mask_inputs > 0).float()
+        obj_output_dict = inference_state["output_dict_per_obj"][obj_idx]
+        current_out, _ = predictor._run_single_frame_inference(
+            inference_state=inference_state,
+            output_dict=obj_output_dict,
+            frame_idx=frame_idx,
+            batch_size=1,  # run on the slice of a single object
+            is_init_cond_frame=False,
+            point_inputs=None,
+            mask_inputs=mask_inputs,
+            reverse=reverse,
+            run_mem_encoder=True,
+        )
+        # keep the mask scores (rather than the binary mask) as the output
+        current_out.update(predictor._compress_pred_masks(inference_state, masks))
+        obj_output_dict["non_cond_frame_outputs"][frame_idx] = current_out
+        inference_state["frames_tracked_per_obj"][obj_idx][frame_idx] = {
+            "reverse": reverse
+        }
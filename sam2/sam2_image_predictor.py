@@ -59,11 +59,28 @@ class SAM2ImagePredictor:
         self.mask_threshold = mask_threshold
 
         # Spatial dim for backbone feature maps
-        self._bb_feat_sizes = [
-            (256, 256),
-            (128, 128),
-            (64, 64),
-        ]
+        self._bb_feat_sizes = self._get_bb_feat_sizes(self.model.image_size)
+
+    @staticmethod
+    def _get_bb_feat_sizes(image_size):
+        # the backbone feature maps are at strides 4, 8 and 16 of the image size
+        return [(image_size // stride, image_size // stride) for stride in [4, 8, 16]]
+
+    def set_image_size(self, image_size: int) -> None:
+        """
+        Run the model at a different input resolution (see `SAM2Base.set_image_size`),
+        e.g. 512 or 768 for a faster image encoder at some accuracy cost. The currently
+        set image (if any) is reset.
+        """
+        self.model.set_image_size(image_size)
+        self._transforms = SAM2Transforms(
+            resolution=image_size,
+            mask_threshold=self._transforms.mask_threshold,
+            max_hole_area=self._transforms.max_hole_area,
+            max_sprinkle_area=self._transforms.max_sprinkle_area,
+        )
+        self._bb_feat_sizes = self._get_bb_feat_sizes(image_size)
+        self.reset_predictor()
 
     @classmethod
     def from_pretrained(cls, model_id: str, **kwargs) -> "SAM2ImagePredictor":
@@ -403,12 +420,6 @@ class SAM2ImagePredictor:
             else:
                 concat_points = (box_coords, box_labels)
 
-        sparse_embeddings, dense_embeddings = self.model.sam_prompt_encoder(
-            points=concat_points,
-            boxes=None,
-            masks=mask_input,
-        )
-
         # Predict masks
         batched_mode = (
             concat_points is not None and concat_points[0].shape[0] > 1
@@ -417,14 +428,14 @@ class SAM2ImagePredictor:
             feat_level[img_idx].unsqueeze(0)
             for feat_level in self._features["high_res_feats"]
         ]
-        low_res_masks, iou_predictions, _, _ = self.model.sam_mask_decoder(
+        low_res_masks, iou_predictions, _, _ = self.model._predict_sam_masks(
             image_embeddings=self._features["image_embed"][img_idx].unsqueeze(0),
-            image_pe=self.model.sam_prompt_encoder.get_dense_pe(),
-            sparse_prompt_embeddings=sparse_embeddings,
-            dense_prompt_embeddings=dense_embeddings,
+            high_res_features=high_res_features,
+            point_coords=concat_points[0] if concat_points is not None else None,
+            point_labels=concat_points[1] if concat_points is not None else None,
+            mask_inputs=mask_input,
             multimask_output=multimask_output,
             repeat_image=batched_mode,
-            high_res_features=high_res_features,
         )
 
         # Upscale the masks to the original image resolution
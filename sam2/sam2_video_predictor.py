@@ -4,7 +4,12 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import hashlib
+import io
+import itertools
 import warnings
+import zipfile
+import zlib
 from collections import OrderedDict
 
 import torch
@@ -12,8 +17,23 @@ import torch.nn.functional as F
 
 from tqdm import tqdm
 
+from sam2.modeling.memory_attention import MemoryKVCache
 from sam2.modeling.sam2_base import NO_OBJ_SCORE, SAM2Base
-from sam2.utils.misc import concat_points, fill_holes_in_mask_scores, load_video_frames
+from sam2.modeling.sam2_utils import quantize_per_channel_int8
+from sam2.utils.feature_cache import BackboneFeatureCache, BackbonePrefetcher
+from sam2.utils.feature_store import (
+    BackboneFeatureStore,
+    compute_module_hash,
+    compute_video_hash,
+)
+from sam2.utils.mask_store import EvictedMaskStore
+from sam2.utils.misc import (
+    concat_points,
+    fill_holes_in_mask_scores,
+    load_video_frames,
+    StreamingFrameBuffer,
+)
+from sam2.utils.video_res_masks import LazyVideoResMasks
 
 
 class SAM2VideoPredictor(SAM2Base):
@@ -30,6 +50,26 @@ class SAM2VideoPredictor(SAM2Base):
         # if `add_all_frames_to_correct_as_cond` is True, we also append to the conditioning frame list any frame that receives a later correction click
         # if `add_all_frames_to_correct_as_cond` is False, we conditioning frame list to only use those initial conditioning frames
         add_all_frames_to_correct_as_cond=False,
+        # whether to track all the objects on a non-conditioning frame in a single batched forward
+        # pass in `propagate_in_video` (each object still attends only to its own memory bank)
+        batch_obj_tracking=True,
+        # whether to store the memory features ("maskmem_features") as int8 with per-channel
+        # scales instead of bfloat16, which halves the memory bank size at a small accuracy
+        # cost (they are dequantized on the fly when building the memory bank)
+        quantize_maskmem_features=False,
+        # how to store the per-frame mask scores ("pred_masks") of each object in the state:
+        # - "float32": the full mask scores at 1/4 of the image size
+        # - "float16": the full mask scores in float16
+        # - "bbox": a float16 crop around the object (with a margin of `pred_masks_bbox_margin`
+        #   pixels), with a single fill value (the mean score) for the background outside it
+        # they are expanded back to the full mask scores whenever they are read
+        pred_masks_storage="float32",
+        pred_masks_bbox_margin=8,
+        # whether to cache the memory of each frame projected into the memory attention's
+        # keys and values (see `MemoryKVCache`), so that each frame only projects the new
+        # memory in its memory bank (at the cost of holding the projected memory of about
+        # `num_maskmem` frames per object, several times larger than the memory features)
+        cache_memory_kv=False,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -37,6 +77,15 @@ class SAM2VideoPredictor(SAM2Base):
         self.non_overlap_masks = non_overlap_masks
         self.clear_non_cond_mem_around_input = clear_non_cond_mem_around_input
         self.add_all_frames_to_correct_as_cond = add_all_frames_to_correct_as_cond
+        self.batch_obj_tracking = batch_obj_tracking
+        self.quantize_maskmem_features = quantize_maskmem_features
+        assert pred_masks_storage in ["float32", "float16", "bbox"]
+        self.pred_masks_storage = pred_masks_storage
+        self.pred_masks_bbox_margin = pred_masks_bbox_margin
+        self.cache_memory_kv = cache_memory_kv
+        # an optional scheduler (e.g. `sam2.utils.batch_scheduler.CrossSessionBatchScheduler`)
+        # to run the tracking steps of several inference sessions in batched forward passes
+        self.step_scheduler = None
 
     @torch.inference_mode()
     def init_state(
@@ -45,8 +94,41 @@ class SAM2VideoPredictor(SAM2Base):
         offload_video_to_cpu=False,
         offload_state_to_cpu=False,
         async_loading_frames=False,
+        feature_cache_max_bytes=0,
+        feature_cache_max_cpu_bytes=0,
+        evict_unreachable_memory=False,
+        evicted_mask_dir=None,
+        feature_store_dir=None,
     ):
         """Initialize an inference state."""
+        inference_state = self._init_video_state(
+            video_path,
+            offload_video_to_cpu=offload_video_to_cpu,
+            offload_state_to_cpu=offload_state_to_cpu,
+            async_loading_frames=async_loading_frames,
+            feature_cache_max_bytes=feature_cache_max_bytes,
+            feature_cache_max_cpu_bytes=feature_cache_max_cpu_bytes,
+            evict_unreachable_memory=evict_unreachable_memory,
+            evicted_mask_dir=evicted_mask_dir,
+            feature_store_dir=feature_store_dir,
+        )
+        # Warm up the visual backbone and cache the image feature on frame 0
+        self._get_image_feature(inference_state, frame_idx=0, batch_size=1)
+        return inference_state
+
+    def _init_video_state(
+        self,
+        video_path,
+        offload_video_to_cpu,
+        offload_state_to_cpu,
+        async_loading_frames,
+        feature_cache_max_bytes,
+        feature_cache_max_cpu_bytes,
+        evict_unreachable_memory,
+        evicted_mask_dir,
+        feature_store_dir,
+    ):
+        """Load the video frames and initialize an inference state on them."""
         compute_device = self.device  # device of the model
         images, video_height, video_width = load_video_frames(
             video_path=video_path,
@@ -56,20 +138,56 @@ class SAM2VideoPredictor(SAM2Base):
             compute_device=compute_device,
         )
         inference_state = {}
+        # the video source (to reload the frames when restoring a saved session)
+        inference_state["video_path"] = video_path
         inference_state["images"] = images
         inference_state["num_frames"] = len(images)
         # whether to offload the video frames to CPU memory
         # turning on this option saves the GPU memory with only a very small overhead
         inference_state["offload_video_to_cpu"] = offload_video_to_cpu
+        # the original video height and width, used for resizing final output scores
+        inference_state["video_height"] = video_height
+        inference_state["video_width"] = video_width
+        # whether the frames are pushed one at a time (see `init_stream_state`)
+        inference_state["streaming"] = False
+        self._init_state_storage(
+            inference_state,
+            offload_state_to_cpu=offload_state_to_cpu,
+            feature_cache_max_bytes=feature_cache_max_bytes,
+            feature_cache_max_cpu_bytes=feature_cache_max_cpu_bytes,
+            evict_unreachable_memory=evict_unreachable_memory,
+            evicted_mask_dir=evicted_mask_dir,
+        )
+        # optionally, a persistent store of the visual features under `feature_store_dir`,
+        # shared by all the sessions on the same video with the same model and image size
+        inference_state["feature_store"] = None
+        if feature_store_dir is not None:
+            inference_state["feature_store"] = BackboneFeatureStore(
+                root_dir=feature_store_dir,
+                key=self._get_feature_store_key(video_path),
+                num_frames=inference_state["num_frames"],
+            )
+        return inference_state
+
+    def _init_state_storage(
+        self,
+        inference_state,
+        offload_state_to_cpu,
+        feature_cache_max_bytes,
+        feature_cache_max_cpu_bytes,
+        evict_unreachable_memory,
+        evicted_mask_dir,
+    ):
+        """Initialize the inputs, outputs and caches in an inference state."""
+        compute_device = self.device  # device of the model
         # whether to offload the inference state to CPU memory
         # turning on this option saves the GPU memory at the cost of a lower tracking fps
         # (e.g. in a test case of 768x768 model, fps dropped from 27 to 24 when tracking one object
         # and from 24 to 21 when tracking two objects)
         inference_state["offload_state_to_cpu"] = offload_state_to_cpu
-        # the original video height and width, used for resizing final output scores
-        inference_state["video_height"] = video_height
-        inference_state["video_width"] = video_width
         inference_state["device"] = compute_device
+        # the input resolution of the model for this session (see `set_image_size`)
+        inference_state["image_size"] = self.image_size
         if offload_state_to_cpu:
             inference_state["storage_device"] = torch.device("cpu")
         else:
@@ -77,10 +195,26 @@ class SAM2VideoPredictor(SAM2Base):
         # inputs on each frame
         inference_state["point_inputs_per_obj"] = {}
         inference_state["mask_inputs_per_obj"] = {}
-        # visual features on a small number of recently visited frames for quick interactions
-        inference_state["cached_features"] = {}
+        # visual features on recently visited frames for quick interactions, kept in an
+        # LRU cache with a byte budget of `feature_cache_max_bytes` on the compute device
+        # (the most recent frame is always kept) and optionally `feature_cache_max_cpu_bytes`
+        # in CPU memory for frames evicted from the compute device
+        inference_state["cached_features"] = BackboneFeatureCache(
+            max_bytes=feature_cache_max_bytes,
+            max_cpu_bytes=feature_cache_max_cpu_bytes,
+        )
         # values that don't change across frames (so we only need to hold one copy of them)
         inference_state["constants"] = {}
+        # whether to drop the non-conditioning frame outputs that can no longer be reached as
+        # memory during propagation, which keeps the session size flat for long videos
+        # (optionally, their mask scores are kept in a temporary file under `evicted_mask_dir`
+        # so that they can still be returned in later interactions)
+        inference_state["evict_unreachable_memory"] = evict_unreachable_memory
+        inference_state["evicted_masks"] = (
+            EvictedMaskStore(evicted_mask_dir)
+            if evict_unreachable_memory and evicted_mask_dir is not None
+            else None
+        )
         # mapping between client-side object id and model-side object index
         inference_state["obj_id_to_idx"] = OrderedDict()
         inference_state["obj_idx_to_id"] = OrderedDict()
@@ -94,10 +228,267 @@ class SAM2VideoPredictor(SAM2Base):
         # (we directly use their consolidated outputs during tracking)
         # metadata for each tracking frame (e.g. which direction it's tracked)
         inference_state["frames_tracked_per_obj"] = {}
-        # Warm up the visual backbone and cache the image feature on frame 0
-        self._get_image_feature(inference_state, frame_idx=0, batch_size=1)
+        # the absence counters of each object when suspending absent objects during
+        # propagation (it's None unless enabled, see `propagate_in_video`)
+        inference_state["obj_suspension"] = None
+        # whether the objects only use the outputs tracked in the same direction as memory
+        # (during a bidirectional propagation, see `propagate_in_video_bidirectional`)
+        inference_state["memory_per_direction"] = False
+        # the projected memory of the frames in the memory banks (None unless enabled)
+        inference_state["memory_kv_cache"] = (
+            MemoryKVCache() if self.cache_memory_kv else None
+        )
+
+    @torch.inference_mode()
+    def init_stream_state(
+        self,
+        offload_video_to_cpu=False,
+        offload_state_to_cpu=False,
+        max_buffered_frames=16,
+        feature_cache_max_bytes=0,
+        feature_cache_max_cpu_bytes=0,
+        evicted_mask_dir=None,
+    ):
+        """
+        Initialize an inference state for a video stream (e.g. a live camera feed), whose
+        frames are added one at a time with `push_frame` and tracked as they arrive instead
+        of being loaded upfront. Only the last `max_buffered_frames` frames are kept (and can
+        receive new inputs), and the memory that tracking can no longer reach is evicted,
+        so the session size doesn't grow with the stream length.
+        """
+        inference_state = {}
+        inference_state["images"] = StreamingFrameBuffer(
+            image_size=self.image_size,
+            max_frames=max_buffered_frames,
+            offload_video_to_cpu=offload_video_to_cpu,
+            compute_device=self.device,
+        )
+        inference_state["num_frames"] = 0
+        inference_state["offload_video_to_cpu"] = offload_video_to_cpu
+        # the original video height and width (filled when pushing the first frame)
+        inference_state["video_height"] = None
+        inference_state["video_width"] = None
+        inference_state["streaming"] = True
+        self._init_state_storage(
+            inference_state,
+            offload_state_to_cpu=offload_state_to_cpu,
+            feature_cache_max_bytes=feature_cache_max_bytes,
+            feature_cache_max_cpu_bytes=feature_cache_max_cpu_bytes,
+            evict_unreachable_memory=True,
+            evicted_mask_dir=evicted_mask_dir,
+        )
+        inference_state["feature_store"] = None
+        return inference_state
+
+    @torch.inference_mode()
+    def push_frame(self, inference_state, frame, lazy_output=False):
+        """
+        Add the next frame (an RGB PIL image or uint8 array) to a streaming session and
+        track all the objects on it. Returns the frame index, the object ids and the output
+        masks on this frame (or None if no object has been added yet). With
+        `lazy_output=True`, the masks are returned as `LazyVideoResMasks` (see
+        `propagate_in_video`).
+        """
+        images = inference_state["images"]
+        frame_idx = images.append(frame)
+        inference_state["num_frames"] = len(images)
+        inference_state["video_height"] = images.video_height
+        inference_state["video_width"] = images.video_width
+        # frames dropped from the buffer can no longer receive inputs
+        for obj_frames_tracked in inference_state["frames_tracked_per_obj"].values():
+            obj_frames_tracked.pop(frame_idx - images.max_frames, None)
+
+        obj_ids = inference_state["obj_ids"]
+        if self._get_obj_num(inference_state) == 0:
+            return frame_idx, obj_ids, None
+        self.propagate_in_video_preflight(inference_state)
+        start_frame_idx = min(
+            t
+            for obj_output_dict in inference_state["output_dict_per_obj"].values()
+            for t in obj_output_dict["cond_frame_outputs"]
+        )
+        output = self._propagate_frame(
+            inference_state, frame_idx, reverse=False, start_frame_idx=start_frame_idx
+        )
+        return self._get_propagation_output(inference_state, output, lazy_output)
+
+    def propagate_in_stream(self, inference_state, frames, lazy_output=False):
+        """
+        Push the frames from an iterable (e.g. a camera reader) into a streaming session and
+        yield the frame index, object ids and output masks after tracking each frame.
+        """
+        for frame in frames:
+            yield self.push_frame(inference_state, frame, lazy_output=lazy_output)
+
+    @torch.inference_mode()
+    def save_state(self, inference_state, path, compress=False):
+        """
+        Save the inputs, tracking outputs (including the memories and object pointers) and
+        settings of an inference session to a file, e.g. to hibernate an idle session or
+        to resume it in another process with `load_state`. The tensors are saved as compact
+        CPU copies (the `maskmem_pos_enc` shared across frames is saved only once). With
+        `compress=True`, the file is compressed with zlib, which can't be loaded lazily.
+        """
+        if inference_state["streaming"]:
+            raise RuntimeError("Saving a streaming session is not supported.")
+        evicted_masks = inference_state["evicted_masks"]
+        feature_store = inference_state["feature_store"]
+        saved_state = {
+            "video_path": inference_state["video_path"],
+            "num_frames": inference_state["num_frames"],
+            "video_height": inference_state["video_height"],
+            "video_width": inference_state["video_width"],
+            "image_size": inference_state["image_size"],
+            # the storage format of the saved mask scores and memories
+            "pred_masks_storage": self.pred_masks_storage,
+            "quantize_maskmem_features": self.quantize_maskmem_features,
+            "offload_video_to_cpu": inference_state["offload_video_to_cpu"],
+            "offload_state_to_cpu": inference_state["offload_state_to_cpu"],
+            "feature_cache_max_bytes": inference_state["cached_features"].max_bytes,
+            "feature_cache_max_cpu_bytes": inference_state[
+                "cached_features"
+            ].max_cpu_bytes,
+            "evict_unreachable_memory": inference_state["evict_unreachable_memory"],
+            "evicted_mask_dir": (
+                evicted_masks.root_dir if evicted_masks is not None else None
+            ),
+            "feature_store_dir": (
+                feature_store.root_dir if feature_store is not None else None
+            ),
+            "obj_ids": list(inference_state["obj_ids"]),
+            "constants": _compact_tensors(inference_state["constants"]),
+            "point_inputs_per_obj": _compact_tensors(
+                inference_state["point_inputs_per_obj"]
+            ),
+            "mask_inputs_per_obj": _compact_tensors(
+                inference_state["mask_inputs_per_obj"]
+            ),
+            "output_dict_per_obj": _compact_tensors(
+                inference_state["output_dict_per_obj"], skip_keys=("maskmem_pos_enc",)
+            ),
+            "temp_output_dict_per_obj": _compact_tensors(
+                inference_state["temp_output_dict_per_obj"],
+                skip_keys=("maskmem_pos_enc",),
+            ),
+            "frames_tracked_per_obj": _compact_tensors(
+                inference_state["frames_tracked_per_obj"]
+            ),
+            "evicted_masks": [],
+        }
+        if evicted_masks is not None:
+            saved_state["evicted_masks"] = [
+                (obj_id, t, evicted_masks.get(obj_id, t)) for obj_id, t in evicted_masks
+            ]
+
+        if compress:
+            buffer = io.BytesIO()
+            torch.save(saved_state, buffer)
+            with open(path, "wb") as f:
+                f.write(zlib.compress(buffer.getbuffer()))
+        else:
+            torch.save(saved_state, path)
+
+    @torch.inference_mode()
+    def load_state(self, path, async_loading_frames=False):
+        """
+        Restore an inference session saved with `save_state`. The video frames are reloaded
+        from the original video path, and no tracking is recomputed. Unless the file is
+        compressed, it's memory-mapped and the saved mask scores and memories are only read
+        from it when they're used (they are then moved to the compute device on demand).
+        """
+        if zipfile.is_zipfile(path):
+            saved_state = torch.load(
+                path, map_location="cpu", mmap=True, weights_only=True
+            )
+        else:
+            with open(path, "rb") as f:
+                buffer = io.BytesIO(zlib.decompress(f.read()))
+            saved_state = torch.load(buffer, map_location="cpu", weights_only=True)
+
+        # (the image size isn't recorded in sessions saved by older versions)
+        saved_image_size = saved_state.get("image_size", self.image_size)
+        if saved_image_size != self.image_size:
+            raise RuntimeError(
+                f"The saved session was tracked at image size {saved_image_size}, "
+                f"but the model runs at {self.image_size}."
+            )
+        # the saved outputs can only be read with the same storage settings (sessions
+        # saved by older versions use the default ones)
+        saved_pred_masks_storage = saved_state.get("pred_masks_storage", "float32")
+        if saved_pred_masks_storage != self.pred_masks_storage:
+            raise ValueError(
+                "The saved session stores its mask scores with pred_masks_storage="
+                f"{saved_pred_masks_storage!r}, but the predictor uses "
+                f"pred_masks_storage={self.pred_masks_storage!r}."
+            )
+        saved_quantize = saved_state.get("quantize_maskmem_features", False)
+        if saved_quantize != self.quantize_maskmem_features:
+            raise ValueError(
+                "The saved session stores its memory features with "
+                f"quantize_maskmem_features={saved_quantize}, but the predictor uses "
+                f"quantize_maskmem_features={self.quantize_maskmem_features}."
+            )
+
+        inference_state = self._init_video_state(
+            saved_state["video_path"],
+            offload_video_to_cpu=saved_state["offload_video_to_cpu"],
+            offload_state_to_cpu=saved_state["offload_state_to_cpu"],
+            async_loading_frames=async_loading_frames,
+            feature_cache_max_bytes=saved_state["feature_cache_max_bytes"],
+            feature_cache_max_cpu_bytes=saved_state["feature_cache_max_cpu_bytes"],
+            evict_unreachable_memory=saved_state["evict_unreachable_memory"],
+            evicted_mask_dir=saved_state["evicted_mask_dir"],
+            feature_store_dir=saved_state["feature_store_dir"],
+        )
+        if inference_state["num_frames"] != saved_state["num_frames"]:
+            raise RuntimeError(
+                f"The video has {inference_state['num_frames']} frames, but the saved "
+                f"session has {saved_state['num_frames']} frames."
+            )
+
+        obj_ids = saved_state["obj_ids"]
+        inference_state["obj_ids"] = obj_ids
+        inference_state["obj_id_to_idx"] = OrderedDict(
+            (obj_id, obj_idx) for obj_idx, obj_id in enumerate(obj_ids)
+        )
+        inference_state["obj_idx_to_id"] = OrderedDict(enumerate(obj_ids))
+        # small tensors (inputs, object pointers and scores) are moved to the compute
+        # device, while the mask scores and memories are kept where they are loaded
+        device = inference_state["device"]
+        inference_state["constants"] = _tensors_to(saved_state["constants"], device)
+        for key in ["point_inputs_per_obj", "mask_inputs_per_obj"]:
+            inference_state[key] = _tensors_to(saved_state[key], device)
+        for key in ["output_dict_per_obj", "temp_output_dict_per_obj"]:
+            output_dict_per_obj = saved_state[key]
+            for obj_output_dict in output_dict_per_obj.values():
+                for storage_key in ["cond_frame_outputs", "non_cond_frame_outputs"]:
+                    for out in obj_output_dict[storage_key].values():
+                        self._restore_saved_output(inference_state, out)
+            inference_state[key] = output_dict_per_obj
+        inference_state["frames_tracked_per_obj"] = saved_state[
+            "frames_tracked_per_obj"
+        ]
+        evicted_masks = inference_state["evicted_masks"]
+        if evicted_masks is not None:
+            for obj_id, t, pred_masks in saved_state["evicted_masks"]:
+                evicted_masks.put(obj_id, t, pred_masks)
         return inference_state
 
+    def _restore_saved_output(self, inference_state, out):
+        """Restore a frame output loaded by `load_state` in place."""
+        device = inference_state["device"]
+        for k in ["obj_ptr", "object_score_logits", "iou_score"]:
+            if out.get(k) is not None:
+                out[k] = out[k].to(device, non_blocking=True)
+        # "maskmem_pos_enc" isn't saved since it's the same across frames
+        out["maskmem_pos_enc"] = None
+        if out.get("maskmem_features") is not None:
+            maskmem_pos_enc = inference_state["constants"]["maskmem_pos_enc"]
+            batch_size = out["maskmem_features"].size(0)
+            out["maskmem_pos_enc"] = [
+                x.expand(batch_size, -1, -1, -1) for x in maskmem_pos_enc
+            ]
+
     @classmethod
     def from_pretrained(cls, model_id: str, **kwargs) -> "SAM2VideoPredictor":
         """
@@ -254,10 +645,12 @@ class SAM2VideoPredictor(SAM2Base):
             prev_out = obj_output_dict["cond_frame_outputs"].get(frame_idx)
             if prev_out is None:
                 prev_out = obj_output_dict["non_cond_frame_outputs"].get(frame_idx)
+            if prev_out is None:
+                prev_out = self._get_evicted_output(inference_state, obj_idx, frame_idx)
 
         if prev_out is not None and prev_out["pred_masks"] is not None:
             device = inference_state["device"]
-            prev_sam_mask_logits = prev_out["pred_masks"].to(device, non_blocking=True)
+            prev_sam_mask_logits = self._get_stored_pred_masks(prev_out, device)
             # Clamp the scale of prev_sam_mask_logits to avoid rare numerical issues.
             prev_sam_mask_logits = torch.clamp(prev_sam_mask_logits, -32.0, 32.0)
         current_out, _ = self._run_single_frame_inference(
@@ -389,17 +782,20 @@ class SAM2VideoPredictor(SAM2Base):
         video_H = inference_state["video_height"]
         video_W = inference_state["video_width"]
         any_res_masks = any_res_masks.to(device, non_blocking=True)
-        if any_res_masks.shape[-2:] == (video_H, video_W):
-            video_res_masks = any_res_masks
-        else:
-            video_res_masks = torch.nn.functional.interpolate(
-                any_res_masks,
-                size=(video_H, video_W),
-                mode="bilinear",
-                align_corners=False,
-            )
-        if self.non_overlap_masks:
-            video_res_masks = self._apply_non_overlapping_constraints(video_res_masks)
+        with self._profile_stage("upsample"):
+            if any_res_masks.shape[-2:] == (video_H, video_W):
+                video_res_masks = any_res_masks
+            else:
+                video_res_masks = torch.nn.functional.interpolate(
+                    any_res_masks,
+                    size=(video_H, video_W),
+                    mode="bilinear",
+                    align_corners=False,
+                )
+            if self.non_overlap_masks:
+                video_res_masks = self._apply_non_overlapping_constraints(
+                    video_res_masks
+                )
         return any_res_masks, video_res_masks
 
     def _consolidate_temp_output_across_obj(
@@ -454,13 +850,15 @@ class SAM2VideoPredictor(SAM2Base):
                 out = obj_output_dict["cond_frame_outputs"].get(frame_idx, None)
             if out is None:
                 out = obj_output_dict["non_cond_frame_outputs"].get(frame_idx, None)
+            if out is None:
+                out = self._get_evicted_output(inference_state, obj_idx, frame_idx)
             # If the object doesn't appear in "output_dict_per_obj" either, we skip it
             # and leave its mask scores to the default scores (i.e. the NO_OBJ_SCORE
             # placeholder above) and set its object pointer to be a dummy pointer.
             if out is None:
                 continue
             # Add the temporary object output mask to consolidated output mask
-            obj_mask = out["pred_masks"]
+            obj_mask = self._get_stored_pred_masks(out)
             consolidated_pred_masks = consolidated_out[consolidated_mask_key]
             if obj_mask.shape[-2:] == consolidated_pred_masks.shape[-2:]:
                 consolidated_pred_masks[obj_idx : obj_idx + 1] = obj_mask
@@ -503,12 +901,16 @@ class SAM2VideoPredictor(SAM2Base):
                     # Run memory encoder on the temporary outputs (if the memory feature is missing)
                     if out["maskmem_features"] is None:
                         high_res_masks = torch.nn.functional.interpolate(
-                            out["pred_masks"].to(inference_state["device"]),
+                            self._get_stored_pred_masks(out, inference_state["device"]),
                             size=(self.image_size, self.image_size),
                             mode="bilinear",
                             align_corners=False,
                         )
-                        maskmem_features, maskmem_pos_enc = self._run_memory_encoder(
+                        (
+                            maskmem_features,
+                            maskmem_features_scale,
+                            maskmem_pos_enc,
+                        ) = self._run_memory_encoder(
                             inference_state=inference_state,
                             frame_idx=frame_idx,
                             batch_size=1,  # run on the slice of a single object
@@ -518,6 +920,7 @@ class SAM2VideoPredictor(SAM2Base):
                             is_mask_from_pts=True,
                         )
                         out["maskmem_features"] = maskmem_features
+                        out["maskmem_features_scale"] = maskmem_features_scale
                         out["maskmem_pos_enc"] = maskmem_pos_enc
 
                     obj_output_dict[storage_key][frame_idx] = out
@@ -549,13 +952,57 @@ class SAM2VideoPredictor(SAM2Base):
         start_frame_idx=None,
         max_frame_num_to_track=None,
         reverse=False,
+        prefetch_frames=0,
+        prefetch_batch_size=1,
+        early_stop_frames=0,
+        early_stop_iou_thresh=0.95,
+        keyframe_stride=1,
+        keyframe_fallback_iou_thresh=0.5,
+        suspend_absent_frames=0,
+        suspended_check_interval=5,
+        lazy_output=False,
     ):
-        """Propagate the input points across frames to track in the entire video."""
+        """
+        Propagate the input points across frames to track in the entire video.
+
+        With `prefetch_frames > 0`, the image features of up to `prefetch_frames` upcoming
+        frames are computed in a background thread (in batches of `prefetch_batch_size`
+        frames) while tracking the current frame.
+
+        With `early_stop_frames > 0` (e.g. when re-propagating after a correction), the
+        propagation stops once the new outputs of all objects have converged to their
+        previous outputs for `early_stop_frames` consecutive frames, i.e. their masks have
+        an IoU above `early_stop_iou_thresh` and their object scores agree on whether the
+        object appears. The previous outputs and memories beyond that frame are kept.
+
+        With `keyframe_stride` k > 1 (e.g. for previews), only every k-th frame (and the
+        start, end and prompted frames) is tracked, with memories selected among these
+        keyframes, and the mask scores of the frames in between are linearly interpolated
+        from the two keyframes around them. If any object changes too much between two keyframes,
+        i.e. the IoU of its masks on them is below `keyframe_fallback_iou_thresh` (which
+        is also the case when it appears or disappears), the frames in between are tracked.
+
+        With `suspend_absent_frames` N > 0, an object that has been absent (i.e. with a
+        negative object score) on N consecutive tracked frames is suspended: it's no longer
+        tracked and gets empty masks (and no memory) on the following frames, except for
+        every `suspended_check_interval`-th frame, where it's tracked again to check if it
+        has reappeared (in which case it's tracked on every frame again).
+
+        With `lazy_output=True`, the yielded masks are `LazyVideoResMasks` holding the
+        low-resolution mask scores, which can be upsampled to the video resolution on
+        demand, or directly turned into binary masks or RLEs at the video resolution by
+        only upsampling the scores in the bounding box of each object.
+        """
+        if inference_state["streaming"]:
+            raise RuntimeError(
+                "Streaming sessions are tracked as frames are pushed with `push_frame`."
+            )
         self.propagate_in_video_preflight(inference_state)
+        self._init_obj_suspension(
+            inference_state, suspend_absent_frames, suspended_check_interval
+        )
 
-        obj_ids = inference_state["obj_ids"]
         num_frames = inference_state["num_frames"]
-        batch_size = self._get_obj_num(inference_state)
 
         # set start index, end index, and processing order
         if start_frame_idx is None:
@@ -579,55 +1026,628 @@ class SAM2VideoPredictor(SAM2Base):
                 start_frame_idx + max_frame_num_to_track, num_frames - 1
             )
             processing_order = range(start_frame_idx, end_frame_idx + 1)
+        if keyframe_stride > 1:
+            # the prompted frames of any object are always kept as keyframes, so that their
+            # outputs anchor the interpolation instead of being interpolated over
+            cond_frame_inds = {
+                t
+                for obj_output_dict in inference_state["output_dict_per_obj"].values()
+                for t in obj_output_dict["cond_frame_outputs"]
+            }
+            processing_order = [
+                t
+                for t in processing_order
+                if t % keyframe_stride == 0
+                or t in [start_frame_idx, end_frame_idx]
+                or t in cond_frame_inds
+            ]
 
-        for frame_idx in tqdm(processing_order, desc="propagate in video"):
-            pred_masks_per_obj = [None] * batch_size
-            for obj_idx in range(batch_size):
-                obj_output_dict = inference_state["output_dict_per_obj"][obj_idx]
-                # We skip those frames already in consolidated outputs (these are frames
-                # that received input clicks or mask). Note that we cannot directly run
-                # batched forward on them via `_run_single_frame_inference` because the
-                # number of clicks on each object might be different.
-                if frame_idx in obj_output_dict["cond_frame_outputs"]:
-                    storage_key = "cond_frame_outputs"
-                    current_out = obj_output_dict[storage_key][frame_idx]
-                    device = inference_state["device"]
-                    pred_masks = current_out["pred_masks"].to(device, non_blocking=True)
-                    if self.clear_non_cond_mem_around_input:
-                        # clear non-conditioning memory of the surrounding frames
-                        self._clear_obj_non_cond_mem_around_input(
-                            inference_state, frame_idx, obj_idx
+        prefetcher = None
+        if prefetch_frames > 0:
+            prefetcher = BackbonePrefetcher(
+                cache=inference_state["cached_features"],
+                compute_fn=lambda frame_inds: self._load_or_encode_frames(
+                    inference_state, frame_inds
+                ),
+                frame_inds=processing_order,
+                depth=prefetch_frames,
+                batch_size=prefetch_batch_size,
+                device=inference_state["device"],
+            ).start()
+        num_converged_frames = 0
+        prev_output = None
+        try:
+            for i, frame_idx in enumerate(
+                tqdm(processing_order, desc="propagate in video")
+            ):
+                if prefetcher is not None:
+                    prefetcher.wait(i)
+                prev_outs = [
+                    obj_output_dict["non_cond_frame_outputs"].get(frame_idx)
+                    for obj_output_dict in inference_state[
+                        "output_dict_per_obj"
+                    ].values()
+                ]
+                output = self._propagate_frame(
+                    inference_state,
+                    frame_idx,
+                    reverse,
+                    start_frame_idx,
+                    keyframe_stride,
+                )
+                if prev_output is not None and abs(frame_idx - prev_output[0]) > 1:
+                    # fill in the frames skipped between the previous keyframe and this one
+                    for skipped_output in self._fill_skipped_frames(
+                        inference_state,
+                        prev_output,
+                        output,
+                        reverse,
+                        start_frame_idx,
+                        keyframe_stride,
+                        keyframe_fallback_iou_thresh,
+                    ):
+                        yield self._get_propagation_output(
+                            inference_state, skipped_output, lazy_output
                         )
-                else:
-                    storage_key = "non_cond_frame_outputs"
-                    current_out, pred_masks = self._run_single_frame_inference(
-                        inference_state=inference_state,
-                        output_dict=obj_output_dict,
-                        frame_idx=frame_idx,
-                        batch_size=1,  # run on the slice of a single object
-                        is_init_cond_frame=False,
-                        point_inputs=None,
-                        mask_inputs=None,
-                        reverse=reverse,
-                        run_mem_encoder=True,
+                yield self._get_propagation_output(inference_state, output, lazy_output)
+                prev_output = output
+                if early_stop_frames > 0 and frame_idx != start_frame_idx:
+                    if self._is_frame_converged(
+                        inference_state, frame_idx, prev_outs, early_stop_iou_thresh
+                    ):
+                        num_converged_frames += 1
+                    else:
+                        num_converged_frames = 0
+                    if num_converged_frames >= early_stop_frames:
+                        break
+        finally:
+            if prefetcher is not None:
+                prefetcher.stop()
+
+    @torch.inference_mode()
+    def propagate_in_video_bidirectional(
+        self,
+        inference_state,
+        start_frame_idx=None,
+        max_frame_num_to_track=None,
+        prefetch_frames=0,
+        prefetch_batch_size=1,
+        early_stop_frames=0,
+        early_stop_iou_thresh=0.95,
+        suspend_absent_frames=0,
+        suspended_check_interval=5,
+        lazy_output=False,
+    ):
+        """
+        Propagate the input points both forward and backward in time from `start_frame_idx`
+        at the same time, i.e. the same as `propagate_in_video` with `reverse=False` and
+        then `reverse=True`, but in half the number of steps: on each step, the next frame
+        in both directions is tracked in one batched forward pass (with `batch_obj_tracking`).
+        The outputs are yielded as their frames are done (the start frame first and then
+        alternately forward and backward), with the start frame only yielded once.
+
+        Each direction only uses the prompted frames and the outputs tracked in its own
+        direction as memory, so the forward direction gives the same results as a forward
+        pass. The backward direction differs slightly from a backward pass run after the
+        forward pass, which also uses the forward outputs next to the start frame as memory.
+        The other arguments are the same as in `propagate_in_video`, where each direction
+        stops early (and suspends absent objects) on its own.
+        """
+        if inference_state["streaming"]:
+            raise RuntimeError(
+                "Streaming sessions are tracked as frames are pushed with `push_frame`."
+            )
+        self.propagate_in_video_preflight(inference_state)
+        self._init_obj_suspension(
+            inference_state, suspend_absent_frames, suspended_check_interval
+        )
+
+        num_frames = inference_state["num_frames"]
+        if start_frame_idx is None:
+            # default: start from the earliest frame with input points
+            start_frame_idx = min(
+                t
+                for obj_output_dict in inference_state["output_dict_per_obj"].values()
+                for t in obj_output_dict["cond_frame_outputs"]
+            )
+        if max_frame_num_to_track is None:
+            # default: track all the frames in the video
+            max_frame_num_to_track = num_frames
+        end_frame_idx = min(start_frame_idx + max_frame_num_to_track, num_frames - 1)
+        forward_order = range(start_frame_idx + 1, end_frame_idx + 1)
+        end_frame_idx = max(start_frame_idx - max_frame_num_to_track, 0)
+        backward_order = range(start_frame_idx - 1, end_frame_idx - 1, -1)
+        # on step k > 0, we track frames `start_frame_idx + k` and `start_frame_idx - k`
+        steps = [[(start_frame_idx, False)]]
+        for k in range(max(len(forward_order), len(backward_order))):
+            step = []
+            if k < len(forward_order):
+                step.append((forward_order[k], False))
+            if k < len(backward_order):
+                step.append((backward_order[k], True))
+            steps.append(step)
+
+        prefetcher = None
+        if prefetch_frames > 0:
+            prefetcher = BackbonePrefetcher(
+                cache=inference_state["cached_features"],
+                compute_fn=lambda frame_inds: self._load_or_encode_frames(
+                    inference_state, frame_inds
+                ),
+                frame_inds=[t for step in steps for t, _ in step],
+                depth=prefetch_frames,
+                batch_size=prefetch_batch_size,
+                device=inference_state["device"],
+            ).start()
+        num_converged_frames = {False: 0, True: 0}
+        is_stopped = {False: False, True: False}
+        num_frames_done = 0
+        inference_state["memory_per_direction"] = True
+        try:
+            for step in tqdm(steps, desc="propagate in video"):
+                if prefetcher is not None:
+                    prefetcher.wait(num_frames_done + len(step) - 1)
+                num_frames_done += len(step)
+                frames = [
+                    (t, reverse) for t, reverse in step if not is_stopped[reverse]
+                ]
+                if len(frames) == 0:
+                    break
+                prev_outs_per_frame = [
+                    [
+                        obj_output_dict["non_cond_frame_outputs"].get(frame_idx)
+                        for obj_output_dict in inference_state[
+                            "output_dict_per_obj"
+                        ].values()
+                    ]
+                    for frame_idx, _ in frames
+                ]
+                outputs = self._propagate_frames(
+                    inference_state, frames, start_frame_idx
+                )
+                for (frame_idx, reverse), prev_outs, output in zip(
+                    frames, prev_outs_per_frame, outputs
+                ):
+                    yield self._get_propagation_output(
+                        inference_state, output, lazy_output
                     )
-                    obj_output_dict[storage_key][frame_idx] = current_out
+                    if early_stop_frames > 0 and frame_idx != start_frame_idx:
+                        if self._is_frame_converged(
+                            inference_state, frame_idx, prev_outs, early_stop_iou_thresh
+                        ):
+                            num_converged_frames[reverse] += 1
+                        else:
+                            num_converged_frames[reverse] = 0
+                        if num_converged_frames[reverse] >= early_stop_frames:
+                            is_stopped[reverse] = True
+        finally:
+            inference_state["memory_per_direction"] = False
+            if prefetcher is not None:
+                prefetcher.stop()
+
+    def _fill_skipped_frames(
+        self,
+        inference_state,
+        prev_output,
+        output,
+        reverse,
+        start_frame_idx,
+        keyframe_stride,
+        fallback_iou_thresh,
+    ):
+        """
+        Yield the outputs on the frames between two consecutive keyframes in a keyframe-
+        stride propagation, given the outputs `prev_output` and `output` on the keyframes.
+        The mask scores are interpolated between the keyframes, unless any object changes
+        too much between them, in which case we fall back to tracking these frames.
+        """
+        prev_frame_idx, obj_ids, prev_masks = prev_output
+        frame_idx, _, masks = output
+        step = -1 if reverse else 1
+        skipped_frame_inds = range(prev_frame_idx + step, frame_idx, step)
+
+        prev_fg = (prev_masks > 0).flatten(1)
+        fg = (masks > 0).flatten(1)
+        intersection = torch.logical_and(prev_fg, fg).sum(dim=1)
+        union = torch.logical_or(prev_fg, fg).sum(dim=1)
+        iou = torch.where(union > 0, intersection / union.clamp(min=1), 1.0)
+        if bool((iou < fallback_iou_thresh).any()):
+            for t in skipped_frame_inds:
+                yield self._propagate_frame(
+                    inference_state, t, reverse, start_frame_idx, keyframe_stride
+                )
+            return
 
-                inference_state["frames_tracked_per_obj"][obj_idx][frame_idx] = {
-                    "reverse": reverse
-                }
-                pred_masks_per_obj[obj_idx] = pred_masks
+        for t in skipped_frame_inds:
+            for obj_frames_tracked in inference_state[
+                "frames_tracked_per_obj"
+            ].values():
+                obj_frames_tracked[t] = {"reverse": reverse}
+            weight = (t - prev_frame_idx) / (frame_idx - prev_frame_idx)
+            yield t, obj_ids, torch.lerp(prev_masks, masks, weight)
 
+    def _get_obj_memory_dict(self, inference_state, obj_idx, reverse):
+        """
+        Get the memory bank of an object to track it on a frame, i.e. its output dict,
+        which is restricted to the conditioning outputs and the non-conditioning outputs
+        tracked in the `reverse` direction during a bidirectional propagation.
+        """
+        obj_output_dict = inference_state["output_dict_per_obj"][obj_idx]
+        if not inference_state["memory_per_direction"]:
+            return obj_output_dict
+        return {
+            "cond_frame_outputs": obj_output_dict["cond_frame_outputs"],
+            "non_cond_frame_outputs": _OutputsTrackedInDirection(
+                obj_output_dict["non_cond_frame_outputs"],
+                inference_state["frames_tracked_per_obj"][obj_idx],
+                reverse,
+            ),
+        }
+
+    def _init_obj_suspension(
+        self, inference_state, suspend_absent_frames, suspended_check_interval
+    ):
+        """Set up the suspension of absent objects at the start of a propagation."""
+        if suspend_absent_frames > 0:
+            inference_state["obj_suspension"] = {
+                "absent_frames": suspend_absent_frames,
+                "check_interval": max(suspended_check_interval, 1),
+                # (obj_idx, reverse) -> the number of consecutive frames the object has
+                # been absent on, and the number of frames skipped since the last check
+                "num_absent": {},
+                "num_skipped": {},
+            }
+        else:
+            inference_state["obj_suspension"] = None
+
+    def _skip_suspended_obj(self, inference_state, obj_idx, reverse):
+        """
+        Check whether to skip tracking an object on the next frame of a propagation, i.e.
+        it has been suspended for being absent and this frame isn't one of its checks.
+        """
+        suspension = inference_state["obj_suspension"]
+        if suspension is None:
+            return False
+        key = (obj_idx, reverse)
+        if suspension["num_absent"].get(key, 0) < suspension["absent_frames"]:
+            return False
+        num_skipped = suspension["num_skipped"].get(key, 0) + 1
+        if num_skipped >= suspension["check_interval"]:
+            # track the object on this frame to check if it has reappeared
+            suspension["num_skipped"][key] = 0
+            return False
+        suspension["num_skipped"][key] = num_skipped
+        return True
+
+    def _update_obj_suspension(self, inference_state, obj_idx, reverse, is_present):
+        """Count the consecutive frames an object has been absent on in a propagation."""
+        suspension = inference_state["obj_suspension"]
+        if suspension is None:
+            return
+        key = (obj_idx, reverse)
+        if is_present:
+            suspension["num_absent"][key] = 0
+            suspension["num_skipped"].pop(key, None)
+        else:
+            suspension["num_absent"][key] = suspension["num_absent"].get(key, 0) + 1
+
+    def _is_frame_converged(self, inference_state, frame_idx, prev_outs, iou_thresh):
+        """
+        Check whether the outputs of all objects on a frame match their previous outputs
+        `prev_outs` (where frames with inputs are considered unchanged).
+        """
+        is_converged = []
+        for obj_output_dict, prev_out in zip(
+            inference_state["output_dict_per_obj"].values(), prev_outs
+        ):
+            if frame_idx in obj_output_dict["cond_frame_outputs"]:
+                continue
+            if prev_out is None:
+                return False
+            out = obj_output_dict["non_cond_frame_outputs"].get(frame_idx)
+            if out is None:
+                # the object is suspended for being absent on this frame
+                is_converged.append(torch.all(prev_out["object_score_logits"] <= 0))
+                continue
+            prev_mask = self._get_stored_pred_masks(prev_out) > 0
+            mask = self._get_stored_pred_masks(out, prev_mask.device) > 0
+            intersection = torch.logical_and(prev_mask, mask).sum()
+            union = torch.logical_or(prev_mask, mask).sum()
+            iou = torch.where(union > 0, intersection / union.clamp(min=1), 1.0)
+            prev_appear = prev_out["object_score_logits"] > 0
+            appear = out["object_score_logits"].to(prev_appear.device) > 0
+            is_converged.append(
+                torch.logical_and(iou >= iou_thresh, torch.all(prev_appear == appear))
+            )
+        if len(is_converged) == 0:
+            return True
+        return bool(torch.stack(is_converged).all())
+
+    def _get_propagation_output(self, inference_state, output, lazy_output=False):
+        """
+        Turn the low-resolution mask scores in an output of `_propagate_frames` into the
+        final mask scores at the original video resolution, or into `LazyVideoResMasks`
+        that only upsample them on demand if `lazy_output` is True.
+        """
+        frame_idx, obj_ids, low_res_masks = output
+        if not lazy_output:
             # Resize the output mask to the original video resolution (we directly use
             # the mask scores on GPU for output to avoid any CPU conversion in between)
-            if len(pred_masks_per_obj) > 1:
-                all_pred_masks = torch.cat(pred_masks_per_obj, dim=0)
-            else:
-                all_pred_masks = pred_masks_per_obj[0]
             _, video_res_masks = self._get_orig_video_res_output(
-                inference_state, all_pred_masks
+                inference_state, low_res_masks
+            )
+            return frame_idx, obj_ids, video_res_masks
+        video_res_masks = LazyVideoResMasks(
+            low_res_masks,
+            video_height=inference_state["video_height"],
+            video_width=inference_state["video_width"],
+            non_overlap_fn=(
+                self._apply_non_overlapping_constraints
+                if self.non_overlap_masks
+                else None
+            ),
+            profile_fn=self._profile_stage,
+        )
+        return frame_idx, obj_ids, video_res_masks
+
+    def _propagate_frame(
+        self, inference_state, frame_idx, reverse, start_frame_idx, keyframe_stride=1
+    ):
+        """Track all the objects on a frame in `propagate_in_video`."""
+        [output] = self._propagate_frames(
+            inference_state, [(frame_idx, reverse)], start_frame_idx, keyframe_stride
+        )
+        return output
+
+    def _propagate_frames(
+        self, inference_state, frames, start_frame_idx, keyframe_stride=1
+    ):
+        """
+        Track all the objects on several frames, given as a list of `(frame_idx, reverse)`
+        pairs (e.g. the next frame of each direction in a bidirectional propagation).
+        With `batch_obj_tracking`, all the objects on all these frames are tracked in a
+        single batched forward pass. Returns a list of `(frame_idx, obj_ids, masks)` with
+        the low-resolution mask scores of all objects on the device (which can be turned
+        into the final output with `_get_propagation_output`).
+
+        With a `step_scheduler`, the step is submitted to the scheduler instead, which
+        may run it along with the steps of other sessions.
+        """
+        if self.step_scheduler is not None:
+            return self.step_scheduler.run_step(
+                inference_state, frames, start_frame_idx, keyframe_stride
+            )
+        with self._profile_stage("track_frames", frames=[t for t, _ in frames]):
+            [outputs] = self._propagate_frames_across_sessions(
+                [(inference_state, frames, start_frame_idx, keyframe_stride)]
+            )
+        return outputs
+
+    def _propagate_frames_across_sessions(self, steps):
+        """
+        Run the tracking steps of several inference sessions (of this model), given as a
+        list of `(inference_state, frames, start_frame_idx, keyframe_stride)` (see
+        `_propagate_frames`). With `batch_obj_tracking`, all the objects of all the steps
+        are tracked in a single batched forward pass (one per keyframe stride), where each
+        object attends to the memory bank in its own session. Returns the outputs of
+        `_propagate_frames` for each step.
+        """
+        pred_masks_per_step = []
+        # the (step_idx, i, obj_idx) samples to track, i.e. the object `obj_idx` on the
+        # i-th frame of the step `step_idx`
+        samples_to_track = []
+        for step_idx, (inference_state, frames, _, _) in enumerate(steps):
+            batch_size = self._get_obj_num(inference_state)
+            pred_masks_per_frame = []
+            for i, (frame_idx, reverse) in enumerate(frames):
+                pred_masks_per_obj = [None] * batch_size
+                for obj_idx in range(batch_size):
+                    obj_output_dict = inference_state["output_dict_per_obj"][obj_idx]
+                    # We skip those frames already in consolidated outputs (these are
+                    # frames that received input clicks or mask). Note that we cannot
+                    # directly run batched forward on them via `_run_single_frame_inference`
+                    # because the number of clicks on each object might be different.
+                    if frame_idx in obj_output_dict["cond_frame_outputs"]:
+                        storage_key = "cond_frame_outputs"
+                        current_out = obj_output_dict[storage_key][frame_idx]
+                        device = inference_state["device"]
+                        pred_masks = self._get_stored_pred_masks(current_out, device)
+                        if self.clear_non_cond_mem_around_input:
+                            # clear non-conditioning memory of the surrounding frames
+                            self._clear_obj_non_cond_mem_around_input(
+                                inference_state, frame_idx, obj_idx
+                            )
+                        pred_masks_per_obj[obj_idx] = pred_masks
+                        self._update_obj_suspension(
+                            inference_state, obj_idx, reverse, is_present=True
+                        )
+                    elif self._skip_suspended_obj(inference_state, obj_idx, reverse):
+                        # the object has been absent for a while, so we give it empty
+                        # masks instead of tracking it (and drop its previous outputs)
+                        obj_output_dict["non_cond_frame_outputs"].pop(frame_idx, None)
+                        self._pop_evicted_output(inference_state, obj_idx, frame_idx)
+                        pred_masks_per_obj[obj_idx] = torch.full(
+                            (1, 1, self.image_size // 4, self.image_size // 4),
+                            NO_OBJ_SCORE,
+                            dtype=torch.float32,
+                            device=inference_state["device"],
+                        )
+                    else:
+                        samples_to_track.append((step_idx, i, obj_idx))
+
+                    inference_state["frames_tracked_per_obj"][obj_idx][frame_idx] = {
+                        "reverse": reverse
+                    }
+                pred_masks_per_frame.append(pred_masks_per_obj)
+            pred_masks_per_step.append(pred_masks_per_frame)
+
+        current_outs, pred_masks_list = {}, {}
+        if self.batch_obj_tracking and len(samples_to_track) > 1:
+            # track the remaining objects together in a batch (with per-object memory),
+            # separately for each keyframe stride
+            for keyframe_stride, group in itertools.groupby(
+                sorted(samples_to_track, key=lambda x: steps[x[0]][3]),
+                key=lambda x: steps[x[0]][3],
+            ):
+                group = list(group)
+                outs, masks = self._run_batched_obj_inference(
+                    [steps[step_idx][0] for step_idx, _, _ in group],
+                    obj_inds=[obj_idx for _, _, obj_idx in group],
+                    frame_idx=[steps[step_idx][1][i][0] for step_idx, i, _ in group],
+                    reverse=[steps[step_idx][1][i][1] for step_idx, i, _ in group],
+                    keyframe_stride=keyframe_stride,
+                )
+                current_outs.update(zip(group, outs))
+                pred_masks_list.update(zip(group, masks))
+        else:
+            for step_idx, i, obj_idx in samples_to_track:
+                inference_state, frames, _, keyframe_stride = steps[step_idx]
+                current_out, pred_masks = self._run_single_frame_inference(
+                    inference_state=inference_state,
+                    output_dict=self._get_obj_memory_dict(
+                        inference_state, obj_idx, frames[i][1]
+                    ),
+                    frame_idx=frames[i][0],
+                    batch_size=1,  # run on the slice of a single object
+                    is_init_cond_frame=False,
+                    point_inputs=None,
+                    mask_inputs=None,
+                    reverse=frames[i][1],
+                    run_mem_encoder=True,
+                    keyframe_stride=keyframe_stride,
+                )
+                current_outs[(step_idx, i, obj_idx)] = current_out
+                pred_masks_list[(step_idx, i, obj_idx)] = pred_masks
+        samples_to_suspend = [
+            x for x in samples_to_track if steps[x[0]][0]["obj_suspension"] is not None
+        ]
+        if len(samples_to_suspend) > 0:
+            # update the absence counters (with a single device-to-host copy)
+            is_present = torch.cat(
+                [current_outs[x]["object_score_logits"] for x in samples_to_suspend]
             )
-            yield frame_idx, obj_ids, video_res_masks
+            is_present = (is_present > 0).flatten().tolist()
+            for (step_idx, i, obj_idx), is_obj_present in zip(
+                samples_to_suspend, is_present
+            ):
+                inference_state, frames, _, _ = steps[step_idx]
+                self._update_obj_suspension(
+                    inference_state, obj_idx, frames[i][1], is_obj_present
+                )
+        for step_idx, i, obj_idx in samples_to_track:
+            inference_state, frames, _, _ = steps[step_idx]
+            obj_output_dict = inference_state["output_dict_per_obj"][obj_idx]
+            obj_output_dict["non_cond_frame_outputs"][frames[i][0]] = current_outs[
+                (step_idx, i, obj_idx)
+            ]
+            pred_masks_per_step[step_idx][i][obj_idx] = pred_masks_list[
+                (step_idx, i, obj_idx)
+            ]
+
+        outputs_per_step = []
+        for (inference_state, frames, start_frame_idx, keyframe_stride), (
+            pred_masks_per_frame
+        ) in zip(steps, pred_masks_per_step):
+            outputs = []
+            for (frame_idx, reverse), pred_masks_per_obj in zip(
+                frames, pred_masks_per_frame
+            ):
+                if inference_state["evict_unreachable_memory"]:
+                    self._evict_unreachable_memory(
+                        inference_state,
+                        frame_idx,
+                        reverse,
+                        start_frame_idx,
+                        keyframe_stride,
+                    )
+
+                if len(pred_masks_per_obj) > 1:
+                    all_pred_masks = torch.cat(pred_masks_per_obj, dim=0)
+                else:
+                    all_pred_masks = pred_masks_per_obj[0]
+                outputs.append((frame_idx, inference_state["obj_ids"], all_pred_masks))
+            outputs_per_step.append(outputs)
+        return outputs_per_step
+
+    def _run_batched_obj_inference(
+        self, inference_state, obj_inds, frame_idx, reverse, keyframe_stride=1
+    ):
+        """
+        Track several objects on a non-conditioning frame in one batched forward pass,
+        where each object attends to the memory bank in its own output dict. Returns
+        the per-object compact outputs and mask scores (as in `_run_single_frame_inference`).
+        `frame_idx` and `reverse` can also be per-object lists, to track the objects on
+        different frames (grouped by frame) in the same forward pass. `inference_state`
+        can also be a per-object list, to track the objects of different sessions
+        (grouped by session) in the same forward pass.
+        """
+        batch_size = len(obj_inds)
+
+        def _per_obj(x):
+            return x if isinstance(x, list) else [x] * batch_size
+
+        states = _per_obj(inference_state)
+        frame_inds = _per_obj(frame_idx)
+        # consecutive objects of the same session share their image features, and their
+        # outputs are compacted with the storage settings of their session
+        session_slices = []
+        for _, group in itertools.groupby(
+            range(batch_size), key=lambda i: id(states[i])
+        ):
+            group = list(group)
+            session_slices.append(slice(group[0], group[-1] + 1))
+        image_feature = self._concat_image_features(
+            [
+                self._get_image_feature_per_sample(states[sl.start], frame_inds[sl])
+                for sl in session_slices
+            ]
+        )
+        _, _, current_vision_feats, current_vision_pos_embeds, feat_sizes = (
+            image_feature
+        )
+        with self._profile_stage("track_step", batch_size=batch_size):
+            current_out = self.track_step(
+                frame_idx=frame_idx,
+                is_init_cond_frame=False,
+                current_vision_feats=current_vision_feats,
+                current_vision_pos_embeds=current_vision_pos_embeds,
+                feat_sizes=feat_sizes,
+                point_inputs=None,
+                mask_inputs=None,
+                output_dict=[
+                    self._get_obj_memory_dict(state, obj_idx, obj_reverse)
+                    for state, obj_idx, obj_reverse in zip(
+                        states, obj_inds, _per_obj(reverse)
+                    )
+                ],
+                num_frames=[self._get_tracking_num_frames(state) for state in states],
+                track_in_reverse=reverse,
+                run_mem_encoder=True,
+                keyframe_stride=keyframe_stride,
+                memory_kv_cache=[state["memory_kv_cache"] for state in states],
+            )
+
+        # split the batched output into the slices of each object
+        current_outs, pred_masks_list = [], []
+        for sl in session_slices:
+            state = states[sl.start]
+            # in "bbox" mode, crop the mask scores around each object (instead of their
+            # union box)
+            per_obj_bbox = self.pred_masks_storage == "bbox"
+            session_out, pred_masks = self._compact_current_out(
+                state,
+                _slice_batch(current_out, sl),
+                compress_pred_masks=not per_obj_bbox,
+            )
+            if per_obj_bbox:
+                obj_pred_masks = self._compress_pred_masks_per_obj(state, pred_masks)
+            for i in range(sl.stop - sl.start):
+                obj_out = _slice_batch(session_out, slice(i, i + 1))
+                if per_obj_bbox:
+                    obj_out.update(obj_pred_masks[i])
+                current_outs.append(obj_out)
+                pred_masks_list.append(pred_masks[i : i + 1])
+        return current_outs, pred_masks_list
 
     @torch.inference_mode()
     def clear_all_prompts_in_frame(
@@ -685,6 +1705,7 @@ class SAM2VideoPredictor(SAM2Base):
         inference_state["output_dict_per_obj"].clear()
         inference_state["temp_output_dict_per_obj"].clear()
         inference_state["frames_tracked_per_obj"].clear()
+        inference_state["obj_suspension"] = None
 
     def _reset_tracking_results(self, inference_state):
         """Reset all tracking inputs and results across the videos."""
@@ -700,21 +1721,68 @@ class SAM2VideoPredictor(SAM2Base):
             v["non_cond_frame_outputs"].clear()
         for v in inference_state["frames_tracked_per_obj"].values():
             v.clear()
+        inference_state["obj_suspension"] = None
+        if inference_state["evicted_masks"] is not None:
+            inference_state["evicted_masks"].clear()
+        if inference_state["memory_kv_cache"] is not None:
+            inference_state["memory_kv_cache"].clear()
+
+    def get_feature_cache_stats(self, inference_state):
+        """Get the hit/miss counters and the size of the image feature cache."""
+        stats = inference_state["cached_features"].stats()
+        feature_store = inference_state["feature_store"]
+        if feature_store is not None:
+            stats["store_hits"] = feature_store.hits
+            stats["store_misses"] = feature_store.misses
+        return stats
+
+    def get_memory_bank_nbytes(self, inference_state):
+        """Get the total size in bytes of the memory features stored for all objects."""
+        nbytes = 0
+        for obj_output_dict in inference_state["output_dict_per_obj"].values():
+            for storage_key in ["cond_frame_outputs", "non_cond_frame_outputs"]:
+                for out in obj_output_dict[storage_key].values():
+                    for k in ["maskmem_features", "maskmem_features_scale"]:
+                        if out.get(k) is not None:
+                            nbytes += out[k].numel() * out[k].element_size()
+        return nbytes
+
+    def _get_feature_store_key(self, video_path):
+        """A key of the visual features of a video from this model in a feature store."""
+        if getattr(self, "_feature_store_model_hash", None) is None:
+            # the image features depend on the image encoder and the high-res feature
+            # projections in the SAM mask decoder that are precomputed in `forward_image`
+            modules = [self.image_encoder]
+            if self.use_high_res_features_in_sam:
+                modules += [
+                    self.sam_mask_decoder.conv_s0,
+                    self.sam_mask_decoder.conv_s1,
+                ]
+            self._feature_store_model_hash = compute_module_hash(modules)
+        video_hash = compute_video_hash(video_path)
+        key = f"{video_hash}-{self._feature_store_model_hash}-{self.image_size}"
+        return hashlib.sha1(key.encode()).hexdigest()
 
     def _get_image_feature(self, inference_state, frame_idx, batch_size):
         """Compute the image features on a given frame."""
+        if inference_state["image_size"] != self.image_size:
+            raise RuntimeError(
+                f"The session was initialized at image size {inference_state['image_size']}, "
+                f"but the model now runs at {self.image_size}."
+            )
         # Look up in the cache first
         image, backbone_out = inference_state["cached_features"].get(
             frame_idx, (None, None)
         )
         if backbone_out is None:
             # Cache miss -- we will run inference on a single image
-            device = inference_state["device"]
-            image = inference_state["images"][frame_idx].to(device).float().unsqueeze(0)
-            backbone_out = self.forward_image(image)
-            # Cache the most recent frame's feature (for repeated interactions with
-            # a frame; we can use an LRU cache for more frames in the future).
-            inference_state["cached_features"] = {frame_idx: (image, backbone_out)}
+            [(image, backbone_out)] = self._load_or_encode_frames(
+                inference_state, [frame_idx]
+            )
+            # Cache the frame's feature (for repeated interactions with a frame and for
+            # propagation passes that revisit it); the cache evicts the least recently
+            # used frames beyond its byte budget.
+            inference_state["cached_features"].put(frame_idx, image, backbone_out)
 
         # expand the features to have the same dimension as the number of objects
         expanded_image = image.expand(batch_size, -1, -1, -1)
@@ -734,6 +1802,95 @@ class SAM2VideoPredictor(SAM2Base):
         features = (expanded_image,) + features
         return features
 
+    def _get_image_feature_per_sample(self, inference_state, frame_inds):
+        """
+        Compute the image features of a batch where each sample is on its own frame in
+        `frame_inds` (consecutive samples on the same frame share their features).
+        """
+        return self._concat_image_features(
+            [
+                self._get_image_feature(inference_state, frame_idx, len(list(group)))
+                for frame_idx, group in itertools.groupby(frame_inds)
+            ]
+        )
+
+    def _concat_image_features(self, features_list):
+        """Concatenate the image features of several batches (from `_get_image_feature`)."""
+        if len(features_list) == 1:
+            return features_list[0]
+        images, _, vision_feats, vision_pos_embeds, feat_sizes = zip(*features_list)
+        # the vision features and positional embeddings are in (HW)BC format
+        return (
+            torch.cat(images, dim=0),
+            None,
+            [torch.cat(x, dim=1) for x in zip(*vision_feats)],
+            [torch.cat(x, dim=1) for x in zip(*vision_pos_embeds)],
+            feat_sizes[0],
+        )
+
+    def _load_or_encode_frames(self, inference_state, frame_inds):
+        """
+        Get the image features of a list of frames from the session's feature store (if
+        there is one) and run the image encoder on the remaining frames in a batch.
+        """
+        device = inference_state["device"]
+        feature_store = inference_state["feature_store"]
+        outputs = {}
+        if feature_store is not None:
+            for t in frame_inds:
+                stored_out = feature_store.get(t)
+                if stored_out is None:
+                    continue
+                image = inference_state["images"][t].to(device).float().unsqueeze(0)
+                backbone_out = {
+                    "backbone_fpn": [
+                        x.to(device, non_blocking=True).to(dtype)
+                        for x, dtype in zip(
+                            stored_out["backbone_fpn"], feature_store.fpn_dtypes
+                        )
+                    ],
+                    "vision_pos_enc": [
+                        x.to(device, non_blocking=True).to(dtype)
+                        for x, dtype in zip(
+                            stored_out["vision_pos_enc"], feature_store.pos_enc_dtypes
+                        )
+                    ],
+                }
+                outputs[t] = (image, backbone_out)
+
+        frame_inds_to_encode = [t for t in frame_inds if t not in outputs]
+        if len(frame_inds_to_encode) > 0:
+            encoded = self._encode_frames(inference_state, frame_inds_to_encode)
+            for t, (image, backbone_out) in zip(frame_inds_to_encode, encoded):
+                if feature_store is not None:
+                    feature_store.put(t, backbone_out)
+                outputs[t] = (image, backbone_out)
+        return [outputs[t] for t in frame_inds]
+
+    def _encode_frames(self, inference_state, frame_inds):
+        """Run the image encoder on a batch of frames and split its outputs per frame."""
+        device = inference_state["device"]
+        images = [inference_state["images"][t] for t in frame_inds]
+        images = torch.stack(images, dim=0).to(device).float()
+        with self._profile_stage("image_encoder", frames=list(frame_inds)):
+            backbone_out = self.forward_image(images)
+        if len(frame_inds) == 1:
+            return [(images, backbone_out)]
+
+        # clone the per-frame slices so that each frame's features can be freed separately
+        outputs = []
+        for i in range(len(frame_inds)):
+            frame_backbone_out = {
+                "backbone_fpn": [
+                    x[i : i + 1].clone() for x in backbone_out["backbone_fpn"]
+                ],
+                "vision_pos_enc": [
+                    x[i : i + 1].clone() for x in backbone_out["vision_pos_enc"]
+                ],
+            }
+            outputs.append((images[i : i + 1].clone(), frame_backbone_out))
+        return outputs
+
     def _run_single_frame_inference(
         self,
         inference_state,
@@ -746,59 +1903,88 @@ class SAM2VideoPredictor(SAM2Base):
         reverse,
         run_mem_encoder,
         prev_sam_mask_logits=None,
+        keyframe_stride=1,
     ):
-        """Run tracking on a single frame based on current inputs and previous memory."""
+        """
+        Run tracking on a single frame based on current inputs and previous memory.
+        With per-object memory banks (`output_dict` as a list), `frame_idx` can also be a
+        per-object list of frames (see `_run_batched_obj_inference`).
+        """
         # Retrieve correct image features
-        (
-            _,
-            _,
-            current_vision_feats,
-            current_vision_pos_embeds,
-            feat_sizes,
-        ) = self._get_image_feature(inference_state, frame_idx, batch_size)
+        if isinstance(frame_idx, list):
+            image_feature = self._get_image_feature_per_sample(
+                inference_state, frame_idx
+            )
+        else:
+            image_feature = self._get_image_feature(
+                inference_state, frame_idx, batch_size
+            )
+        _, _, current_vision_feats, current_vision_pos_embeds, feat_sizes = (
+            image_feature
+        )
 
         # point and mask should not appear as input simultaneously on the same frame
         assert point_inputs is None or mask_inputs is None
-        current_out = self.track_step(
-            frame_idx=frame_idx,
-            is_init_cond_frame=is_init_cond_frame,
-            current_vision_feats=current_vision_feats,
-            current_vision_pos_embeds=current_vision_pos_embeds,
-            feat_sizes=feat_sizes,
-            point_inputs=point_inputs,
-            mask_inputs=mask_inputs,
-            output_dict=output_dict,
-            num_frames=inference_state["num_frames"],
-            track_in_reverse=reverse,
-            run_mem_encoder=run_mem_encoder,
-            prev_sam_mask_logits=prev_sam_mask_logits,
-        )
+        with self._profile_stage("track_step", batch_size=batch_size):
+            current_out = self.track_step(
+                frame_idx=frame_idx,
+                is_init_cond_frame=is_init_cond_frame,
+                current_vision_feats=current_vision_feats,
+                current_vision_pos_embeds=current_vision_pos_embeds,
+                feat_sizes=feat_sizes,
+                point_inputs=point_inputs,
+                mask_inputs=mask_inputs,
+                output_dict=output_dict,
+                num_frames=self._get_tracking_num_frames(inference_state),
+                track_in_reverse=reverse,
+                run_mem_encoder=run_mem_encoder,
+                prev_sam_mask_logits=prev_sam_mask_logits,
+                keyframe_stride=keyframe_stride,
+                memory_kv_cache=inference_state["memory_kv_cache"],
+            )
 
-        # optionally offload the output to CPU memory to save GPU space
-        storage_device = inference_state["storage_device"]
-        maskmem_features = current_out["maskmem_features"]
-        if maskmem_features is not None:
-            maskmem_features = maskmem_features.to(torch.bfloat16)
-            maskmem_features = maskmem_features.to(storage_device, non_blocking=True)
+        return self._compact_current_out(inference_state, current_out)
+
+    def _compact_current_out(
+        self, inference_state, current_out, compress_pred_masks=True
+    ):
+        """
+        Make a compact version of a frame's output (from `track_step`) to store in the
+        state. Returns it along with the mask scores on the device. If not
+        `compress_pred_masks`, the mask scores are left out of the compact output.
+        """
         pred_masks_gpu = current_out["pred_masks"]
         # potentially fill holes in the predicted masks
         if self.fill_hole_area > 0:
-            pred_masks_gpu = fill_holes_in_mask_scores(
-                pred_masks_gpu, self.fill_hole_area
+            with self._profile_stage("fill_holes"):
+                pred_masks_gpu = fill_holes_in_mask_scores(
+                    pred_masks_gpu, self.fill_hole_area
+                )
+        # optionally offload the output to CPU memory to save GPU space
+        with self._profile_stage("store_output"):
+            maskmem_features, maskmem_features_scale = self._compress_maskmem_features(
+                inference_state, current_out["maskmem_features"]
+            )
+            compressed_pred_masks = (
+                self._compress_pred_masks(inference_state, pred_masks_gpu)
+                if compress_pred_masks
+                else {}
             )
-        pred_masks = pred_masks_gpu.to(storage_device, non_blocking=True)
         # "maskmem_pos_enc" is the same across frames, so we only need to store one copy of it
         maskmem_pos_enc = self._get_maskmem_pos_enc(inference_state, current_out)
         # object pointer is a small tensor, so we always keep it on GPU memory for fast access
         obj_ptr = current_out["obj_ptr"]
         object_score_logits = current_out["object_score_logits"]
+        iou_score = current_out["iou_score"]
         # make a compact version of this frame's output to reduce the state size
         compact_current_out = {
             "maskmem_features": maskmem_features,
+            "maskmem_features_scale": maskmem_features_scale,
             "maskmem_pos_enc": maskmem_pos_enc,
-            "pred_masks": pred_masks,
+            **compressed_pred_masks,
             "obj_ptr": obj_ptr,
             "object_score_logits": object_score_logits,
+            "iou_score": iou_score,
         }
         return compact_current_out, pred_masks_gpu
 
@@ -820,23 +2006,150 @@ class SAM2VideoPredictor(SAM2Base):
         _, _, current_vision_feats, _, feat_sizes = self._get_image_feature(
             inference_state, frame_idx, batch_size
         )
-        maskmem_features, maskmem_pos_enc = self._encode_new_memory(
-            current_vision_feats=current_vision_feats,
-            feat_sizes=feat_sizes,
-            pred_masks_high_res=high_res_masks,
-            object_score_logits=object_score_logits,
-            is_mask_from_pts=is_mask_from_pts,
-        )
+        with self._profile_stage("memory_encoder"):
+            maskmem_features, maskmem_pos_enc = self._encode_new_memory(
+                current_vision_feats=current_vision_feats,
+                feat_sizes=feat_sizes,
+                pred_masks_high_res=high_res_masks,
+                object_score_logits=object_score_logits,
+                is_mask_from_pts=is_mask_from_pts,
+            )
 
         # optionally offload the output to CPU memory to save GPU space
-        storage_device = inference_state["storage_device"]
-        maskmem_features = maskmem_features.to(torch.bfloat16)
-        maskmem_features = maskmem_features.to(storage_device, non_blocking=True)
+        maskmem_features, maskmem_features_scale = self._compress_maskmem_features(
+            inference_state, maskmem_features
+        )
         # "maskmem_pos_enc" is the same across frames, so we only need to store one copy of it
         maskmem_pos_enc = self._get_maskmem_pos_enc(
             inference_state, {"maskmem_pos_enc": maskmem_pos_enc}
         )
-        return maskmem_features, maskmem_pos_enc
+        return maskmem_features, maskmem_features_scale, maskmem_pos_enc
+
+    def _compress_maskmem_features(self, inference_state, maskmem_features):
+        """
+        Convert the memory features of a frame into their storage format on the storage
+        device: bfloat16, or int8 with per-channel scales if `quantize_maskmem_features`
+        is set. Returns the features and their scales (None if not quantized).
+        """
+        if maskmem_features is None:
+            return None, None
+        storage_device = inference_state["storage_device"]
+        maskmem_features_scale = None
+        if self.quantize_maskmem_features:
+            maskmem_features, maskmem_features_scale = quantize_per_channel_int8(
+                maskmem_features
+            )
+            maskmem_features_scale = maskmem_features_scale.to(
+                storage_device, non_blocking=True
+            )
+        else:
+            maskmem_features = maskmem_features.to(torch.bfloat16)
+        maskmem_features = maskmem_features.to(storage_device, non_blocking=True)
+        return maskmem_features, maskmem_features_scale
+
+    def _compress_pred_masks(self, inference_state, pred_masks):
+        """
+        Convert the mask scores of a frame into their storage format (according to
+        `pred_masks_storage`) on the storage device. Returns the entries to store in the
+        frame output: "pred_masks", and in "bbox" mode, "pred_masks_box" (the top, left,
+        height and width of the full mask scores) and "pred_masks_fill" (the per-object
+        background score outside the box).
+        """
+        storage_device = inference_state["storage_device"]
+        if self.pred_masks_storage == "float32":
+            return {"pred_masks": pred_masks.to(storage_device, non_blocking=True)}
+        if self.pred_masks_storage == "float16":
+            pred_masks = pred_masks.to(torch.float16)
+            return {"pred_masks": pred_masks.to(storage_device, non_blocking=True)}
+
+        # crop the union box of the foreground (positive scores) of all objects
+        (box,) = self._get_pred_masks_boxes(pred_masks, union=True)
+        return self._crop_pred_masks(inference_state, pred_masks, box)
+
+    def _compress_pred_masks_per_obj(self, inference_state, pred_masks):
+        """
+        Like `_compress_pred_masks` in "bbox" mode, but crop the mask scores of each
+        object around its own foreground box. Returns a list of entries per object.
+        """
+        boxes = self._get_pred_masks_boxes(pred_masks)
+        return [
+            self._crop_pred_masks(inference_state, pred_masks[i : i + 1], box)
+            for i, box in enumerate(boxes)
+        ]
+
+    def _get_pred_masks_boxes(self, pred_masks, union=False):
+        """
+        Get the (top, bottom, left, right) box of the foreground (positive scores) of each
+        object's mask scores, or of their union if `union`, expanded by
+        `pred_masks_bbox_margin` (an empty box if there is no foreground). The boxes are
+        computed in one batched reduction and copied to the host at once.
+        """
+        H, W = pred_masks.shape[-2:]
+        is_fg = pred_masks > 0
+        fg_rows = is_fg.any(dim=3).any(dim=1)
+        fg_cols = is_fg.any(dim=2).any(dim=1)
+        if union:
+            fg_rows = fg_rows.any(dim=0, keepdim=True)
+            fg_cols = fg_cols.any(dim=0, keepdim=True)
+        rows = torch.arange(H, device=pred_masks.device)
+        cols = torch.arange(W, device=pred_masks.device)
+        boxes = torch.stack(
+            [
+                fg_rows.any(dim=1).long(),
+                torch.where(fg_rows, rows, H).amin(dim=1),
+                torch.where(fg_rows, rows, -1).amax(dim=1) + 1,
+                torch.where(fg_cols, cols, W).amin(dim=1),
+                torch.where(fg_cols, cols, -1).amax(dim=1) + 1,
+            ],
+            dim=1,
+        ).tolist()
+        margin = self.pred_masks_bbox_margin
+        return [
+            (
+                (
+                    max(top - margin, 0),
+                    min(bottom + margin, H),
+                    max(left - margin, 0),
+                    min(right + margin, W),
+                )
+                if has_fg
+                else (0, 0, 0, 0)
+            )
+            for has_fg, top, bottom, left, right in boxes
+        ]
+
+    def _crop_pred_masks(self, inference_state, pred_masks, box):
+        """Crop mask scores to a (top, bottom, left, right) box in the "bbox" storage format."""
+        storage_device = inference_state["storage_device"]
+        H, W = pred_masks.shape[-2:]
+        top, bottom, left, right = box
+        crop = pred_masks[..., top:bottom, left:right]
+        # fill the background outside the box with its mean score
+        num_outside = H * W - crop.shape[-2] * crop.shape[-1]
+        outside_sum = pred_masks.sum(dim=(2, 3), keepdim=True) - crop.sum(
+            dim=(2, 3), keepdim=True
+        )
+        fill = outside_sum / max(num_outside, 1)
+        return {
+            "pred_masks": crop.to(torch.float16).to(storage_device, non_blocking=True),
+            "pred_masks_box": (top, left, H, W),
+            "pred_masks_fill": fill.to(storage_device, non_blocking=True),
+        }
+
+    def _get_stored_pred_masks(self, out, device=None):
+        """Expand the stored mask scores of a frame output to full float32 mask scores."""
+        pred_masks = out["pred_masks"]
+        if device is not None:
+            pred_masks = pred_masks.to(device, non_blocking=True)
+        box = out.get("pred_masks_box")
+        if box is not None:
+            top, left, H, W = box
+            h, w = pred_masks.shape[-2:]
+            fill = out["pred_masks_fill"].to(pred_masks.device, non_blocking=True)
+            full_pred_masks = fill.expand(-1, -1, H, W).clone()
+            full_pred_masks[..., top : top + h, left : left + w] = pred_masks
+            pred_masks = full_pred_masks
+        return pred_masks.float()
 
     def _get_maskmem_pos_enc(self, inference_state, current_out):
         """
@@ -930,6 +2243,8 @@ class SAM2VideoPredictor(SAM2Base):
         _map_keys(inference_state["output_dict_per_obj"])
         _map_keys(inference_state["temp_output_dict_per_obj"])
         _map_keys(inference_state["frames_tracked_per_obj"])
+        if inference_state["evicted_masks"] is not None:
+            inference_state["evicted_masks"].remove_object(obj_id)
 
         # Step 3: Further collect the outputs on those frames in `obj_input_frames_inds`, which
         # could show an updated mask for objects previously occluded by the object being removed
@@ -971,14 +2286,87 @@ class SAM2VideoPredictor(SAM2Base):
             non_cond_frame_outputs = obj_output_dict["non_cond_frame_outputs"]
             for t in range(frame_idx_begin, frame_idx_end + 1):
                 non_cond_frame_outputs.pop(t, None)
+                self._pop_evicted_output(inference_state, obj_idx, t)
+
+    def _evict_unreachable_memory(
+        self, inference_state, frame_idx, reverse, start_frame_idx, keyframe_stride=1
+    ):
+        """
+        Evict the non-conditioning frame output that has just moved out of the memory
+        reach of the propagation (i.e. it won't be read as memory for the following frames).
+        Outputs within the memory reach of any conditioning frame or of the propagation's
+        start frame are kept, so that a later propagation in the other direction from these
+        frames reads the same memory as without eviction. The evicted mask scores are moved
+        to the disk-backed store of the session (if there is one).
+
+        When only every `keyframe_stride`-th frame is tracked, the memory reach is scaled
+        accordingly and all the outputs in the last `keyframe_stride` frames out of reach
+        are evicted.
+        """
+        reach = self._get_memory_reach(self._get_tracking_num_frames(inference_state))
+        reach *= keyframe_stride
+        for t in range(reach + 1, reach + keyframe_stride + 1):
+            t = frame_idx + t if reverse else frame_idx - t
+            if abs(t - start_frame_idx) > reach:
+                self._evict_frame_output(inference_state, t, reach)
+
+    def _evict_frame_output(self, inference_state, t, reach):
+        """Evict the non-conditioning outputs on frame `t` (see `_evict_unreachable_memory`)."""
+        evicted_masks = inference_state["evicted_masks"]
+        for obj_idx, obj_output_dict in inference_state["output_dict_per_obj"].items():
+            if t not in obj_output_dict["non_cond_frame_outputs"]:
+                continue
+            if any(
+                abs(t - cond_t) <= reach
+                for cond_t in obj_output_dict["cond_frame_outputs"]
+            ):
+                continue
+            out = obj_output_dict["non_cond_frame_outputs"].pop(t)
+            if evicted_masks is not None:
+                obj_id = self._obj_idx_to_id(inference_state, obj_idx)
+                evicted_masks.put(obj_id, t, self._get_stored_pred_masks(out))
+
+    def _get_tracking_num_frames(self, inference_state):
+        """The number of frames in the video for tracking (None if it's a stream)."""
+        if inference_state["streaming"]:
+            return None
+        return inference_state["num_frames"]
+
+    def _get_evicted_output(self, inference_state, obj_idx, frame_idx):
+        """Look up the evicted mask scores of an object on a frame (or None)."""
+        evicted_masks = inference_state["evicted_masks"]
+        if evicted_masks is None:
+            return None
+        obj_id = self._obj_idx_to_id(inference_state, obj_idx)
+        pred_masks = evicted_masks.get(
+            obj_id, frame_idx, device=inference_state["storage_device"]
+        )
+        if pred_masks is None:
+            return None
+        return {"pred_masks": pred_masks}
+
+    def _pop_evicted_output(self, inference_state, obj_idx, frame_idx):
+        """Remove the evicted mask scores of an object on a frame (if there are any)."""
+        evicted_masks = inference_state["evicted_masks"]
+        if evicted_masks is not None:
+            obj_id = self._obj_idx_to_id(inference_state, obj_idx)
+            evicted_masks.pop(obj_id, frame_idx)
 
 
 class SAM2VideoPredictorVOS(SAM2VideoPredictor):
     """Optimized for the VOS setting"""
 
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        # whether to `torch.compile` the components on start (not needed when running the
+        # ahead-of-time compiled packages of `sam2.utils.aot_compile` as the backend)
+        compile_all_components=True,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
-        self._compile_all_components()
+        if compile_all_components:
+            self._compile_all_components()
 
     def _compile_all_components(self):
         print("Compiling all components for VOS setting. First time may be very slow.")
@@ -1015,6 +2403,8 @@ class SAM2VideoPredictorVOS(SAM2VideoPredictor):
         Identical to the corresponding method in the parent (SAM2VideoPredictor), but
         cloning the backbone features and pos encoding to enable compilation.
         """
+        if self.backend is not None:
+            return super().forward_image(img_batch)
         backbone_out = self.image_encoder(img_batch)
         if self.use_high_res_features_in_sam:
             # precompute projected level 0 and level 1 features in SAM decoder
@@ -1045,6 +2435,14 @@ class SAM2VideoPredictorVOS(SAM2VideoPredictor):
         Identical to the corresponding method in the parent (SAM2VideoPredictor), but
         cloning the outputs of prompt_encoder and mask_decoder to enable compilation.
         """
+        if self.backend is not None:
+            return super()._forward_sam_heads(
+                backbone_features,
+                point_inputs=point_inputs,
+                mask_inputs=mask_inputs,
+                high_res_features=high_res_features,
+                multimask_output=multimask_output,
+            )
         B = backbone_features.size(0)
         device = backbone_features.device
         assert backbone_features.size(1) == self.sam_prompt_embed_dim
@@ -1180,6 +2578,14 @@ class SAM2VideoPredictorVOS(SAM2VideoPredictor):
         Identical to the corresponding method in the parent (SAM2VideoPredictor), but
         cloning the memories and their pos enc to enable compilation.
         """
+        if self.backend is not None:
+            return super()._encode_new_memory(
+                current_vision_feats,
+                feat_sizes,
+                pred_masks_high_res,
+                object_score_logits,
+                is_mask_from_pts,
+            )
         B = current_vision_feats[-1].size(1)  # batch size on this frame
         C = self.hidden_dim
         H, W = feat_sizes[-1]  # top-level (lowest-resolution) feature size
@@ -1221,3 +2627,65 @@ class SAM2VideoPredictorVOS(SAM2VideoPredictor):
             )
 
         return maskmem_features, maskmem_pos_enc
+
+
+def _compact_tensors(x, skip_keys=()):
+    """
+    Copy the tensors in a nested container of dicts, lists and tuples into compact CPU
+    tensors (views of larger tensors would otherwise be saved along with their storage).
+    """
+    if isinstance(x, torch.Tensor):
+        return x.detach().to("cpu", copy=True).contiguous()
+    if isinstance(x, dict):
+        return {
+            k: (None if k in skip_keys else _compact_tensors(v, skip_keys))
+            for k, v in x.items()
+        }
+    if isinstance(x, (list, tuple)):
+        return type(x)(_compact_tensors(v, skip_keys) for v in x)
+    return x
+
+
+def _tensors_to(x, device):
+    """Move the tensors in a nested container of dicts, lists and tuples to a device."""
+    if isinstance(x, torch.Tensor):
+        return x.to(device, non_blocking=True)
+    if isinstance(x, dict):
+        return {k: _tensors_to(v, device) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(_tensors_to(v, device) for v in x)
+    return x
+
+
+class _OutputsTrackedInDirection:
+    """
+    A read-only view of the non-conditioning outputs of an object (as used to select its
+    memory frames in `SAM2Base._get_memory_bank`) with only the frames tracked in the
+    `reverse` direction according to `frames_tracked`.
+    """
+
+    def __init__(self, outputs, frames_tracked, reverse):
+        self.outputs = outputs
+        self.frames_tracked = frames_tracked
+        self.reverse = reverse
+
+    def get(self, frame_idx, default=None):
+        tracked = self.frames_tracked.get(frame_idx)
+        if tracked is None or tracked["reverse"] != self.reverse:
+            return default
+        return self.outputs.get(frame_idx, default)
+
+    def __contains__(self, frame_idx):
+        return self.get(frame_idx) is not None
+
+
+def _slice_batch(x, batch_slice):
+    """Take a slice along the batch dimension of the tensors in an output dict."""
+    out = {}
+    for k, v in x.items():
+        if torch.is_tensor(v):
+            v = v[batch_slice]
+        elif isinstance(v, list):
+            v = [t[batch_slice] for t in v]
+        out[k] = v
+    return out
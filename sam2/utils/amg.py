@@ -111,32 +111,95 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     Encodes masks to an uncompressed RLE, in the format expected by
     pycoco tools.
     """
-    # Put in fortran order and flatten h,w
     b, h, w = tensor.shape
-    tensor = tensor.permute(0, 2, 1).flatten(1)
+    counts, num_counts = _mask_to_rle_counts_pytorch(tensor)
+    counts = torch.split(counts.cpu(), num_counts.cpu().tolist())
+    return [{"size": [h, w], "counts": c.tolist()} for c in counts]
 
-    # Compute change indices
-    diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
 
-    # Encode run length
+def mask_to_coco_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
+    """
+    Encodes masks to a compressed COCO RLE (the same as `pycocotools.mask.encode`,
+    with the counts decoded to a string as in `coco_encode_rle`). The masks of all the
+    objects are encoded on their device at once, so that only the compressed counts
+    are copied to the host.
+    """
+    b, h, w = tensor.shape
+    counts, num_counts = _mask_to_rle_counts_pytorch(tensor)
+    chars, num_chars = _compress_rle_counts_pytorch(counts, num_counts)
+    chars = bytes(chars.cpu().numpy())
     out = []
-    for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
-        out.append({"size": [h, w], "counts": counts})
+    offset = 0
+    for n in num_chars.cpu().tolist():
+        out.append({"size": [h, w], "counts": chars[offset : offset + n].decode()})
+        offset += n
     return out
 
 
+def _mask_to_rle_counts_pytorch(
+    tensor: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Computes the RLE counts of a batch of masks in a single pass. Returns the counts of
+    all masks concatenated, along with the number of counts of each mask.
+    """
+    # Put in fortran order and flatten h,w
+    b, h, w = tensor.shape
+    tensor = tensor.permute(0, 2, 1).flatten(1).bool()
+    # Pad with a zero in front, so that a mask starting with a one gets a zero count
+    tensor = torch.cat([tensor.new_zeros(b, 1), tensor], dim=1)
+
+    # Compute change indices (i.e. the start of each run after the first one)
+    diff = tensor[:, 1:] ^ tensor[:, :-1]
+    mask_idxs, change_idxs = diff.nonzero(as_tuple=True)
+
+    # Each mask has one more run than its changes, the last one ending at h * w
+    num_counts = torch.bincount(mask_idxs, minlength=b) + 1
+    ends = torch.full(
+        (mask_idxs.numel() + b,), h * w, dtype=torch.long, device=tensor.device
+    )
+    pos = torch.arange(mask_idxs.numel(), device=tensor.device) + mask_idxs
+    ends[pos] = change_idxs
+
+    # Encode run length (from the end of the previous run in the same mask)
+    starts = torch.cat([ends.new_zeros(1), ends[:-1]])
+    first = torch.cumsum(num_counts, dim=0) - num_counts
+    starts[first] = 0
+    return ends - starts, num_counts
+
+
+def _compress_rle_counts_pytorch(
+    counts: torch.Tensor, num_counts: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compresses RLE counts into the characters of COCO's string format (as in `rleToString`
+    from pycocotools). Returns the characters of all masks concatenated, along with the
+    number of characters of each mask.
+    """
+    # Each count (after the first two) is stored relative to the count two runs before
+    mask_idxs = torch.repeat_interleave(
+        torch.arange(num_counts.numel(), device=counts.device), num_counts
+    )
+    first = torch.cumsum(num_counts, dim=0) - num_counts
+    idx_in_mask = torch.arange(counts.numel(), device=counts.device) - first[mask_idxs]
+    x = counts.clone()
+    x[2:] -= torch.where(idx_in_mask[2:] > 2, counts[:-2], 0)
+
+    # Split each value into chunks of 5 bits (enough for 32-bit values), and stop once
+    # the remaining bits are only the sign extension of the last chunk
+    shifts = torch.arange(0, 35, 5, device=counts.device)
+    chunks = (x[:, None] >> shifts) & 0x1F
+    rest = x[:, None] >> (shifts + 5)
+    more = torch.where((chunks & 0x10) != 0, rest != -1, rest != 0)
+    num_chunks = torch.cumprod(more.long(), dim=1).sum(dim=1) + 1
+    chars = (chunks | (more.long() << 5)) + 48
+    keep = shifts[None] < num_chunks[:, None] * 5
+    chars = chars[keep].to(torch.uint8)
+
+    num_chars = torch.zeros_like(num_counts).index_add_(0, mask_idxs, num_chunks)
+    return chars, num_chars
+
+
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
@@ -0,0 +1,214 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compile the inference components of a SAM 2 model ahead of time with AOTInductor, and
+run the compiled packages as the execution backend of the model (`SAM2Base.backend`).
+This replaces the `torch.compile` of `SAM2VideoPredictorVOS` on every process start
+(which takes minutes) with loading the packages compiled once per model (in seconds).
+
+The four graphs of `sam2.utils.onnx_backend` (the image encoder, the SAM prompt encoder
+and mask decoder, the memory attention and the memory encoder) are exported with
+`torch.export`, with dynamic batch sizes, numbers of prompt points and memory lengths,
+and compiled with max-autotune (as the modules of `SAM2VideoPredictorVOS`) into `.pt2`
+packages under a cache directory, in a subdirectory keyed on the PyTorch version, the
+device, the autocast dtype, the model config and input resolution and the model weights
+(which are packaged with the compiled code). They're compiled on the first start with
+a new key, and loaded on the next ones:
+
+    predictor = build_sam2_video_predictor(
+        config_file,
+        ckpt_path,
+        vos_optimized=True,
+        aot_cache_dir="path/to/aot_cache",
+        aot_autocast_dtype=torch.bfloat16,
+    )
+
+The graphs are exported under the autocast dtype the predictor runs with (e.g. the
+bfloat16 autocast of `tools/vos_inference.py`), which is baked into the packages; their
+inputs are cast to float32 (the autocast casts them in the graphs) and their outputs are
+returned as float32. The packages can also be compiled ahead of the deployment with
+`tools/compile_aot.py`. They don't support the projected memory cache (`cache_memory_kv`).
+"""
+
+import hashlib
+import logging
+import os
+import time
+import uuid
+
+import torch
+
+from sam2.utils.feature_store import compute_module_hash
+from sam2.utils.onnx_backend import (
+    DYNAMIC_AXES,
+    get_export_inputs,
+    GRAPH_VERSION,
+    GraphBackend,
+    ONNX_MODEL_NAMES,
+    real_valued_rope,
+)
+
+
+def get_aot_cache_key(model, config=None, autocast_dtype=None):
+    """
+    The key of the compiled packages of a model: the PyTorch version and graph version,
+    the device, the `autocast_dtype` they run with (None for float32), the model
+    `config` (e.g. its Hydra config as YAML) and input resolution, and its weights.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(f"torch={torch.__version__}\n".encode())
+    hasher.update(f"graphs={GRAPH_VERSION}\n".encode())
+    hasher.update(f"device={model.device.type}\n".encode())
+    hasher.update(f"autocast_dtype={autocast_dtype}\n".encode())
+    hasher.update(f"image_size={model.image_size}\n".encode())
+    hasher.update(f"config={config}\n".encode())
+    hasher.update(compute_module_hash([model]).encode())
+    return hasher.hexdigest()
+
+
+def _get_export_dim(dim_name):
+    if dim_name in ["num_memory", "num_memory_and_obj_ptrs"]:
+        # the memory length is a multiple of the frame size, and the memory mask covers
+        # both the memory and the object pointers, so let `torch.export` infer them
+        return torch.export.Dim.AUTO
+    if dim_name == "num_points":
+        # (zero points for mask-only prompts, see `GraphBackend.predict_masks`)
+        return torch.export.Dim(dim_name, min=0)
+    # (sizes of 1 are allowed explicitly, as they're traced with larger sizes)
+    return torch.export.Dim(dim_name, min=1)
+
+
+def _compile_and_package(exported_program, args, package_path):
+    # compile with max-autotune, as the `torch.compile` of `SAM2VideoPredictorVOS`
+    inductor_configs = {"max_autotune": True}
+    pytorch_version = tuple(int(v) for v in torch.__version__.split(".")[:2])
+    if pytorch_version < (2, 6):
+        # (the example inputs are a required argument before PyTorch 2.6)
+        return torch._inductor.aoti_compile_and_package(
+            exported_program,
+            args,
+            package_path=package_path,
+            inductor_configs=inductor_configs,
+        )
+    return torch._inductor.aoti_compile_and_package(
+        exported_program,
+        package_path=package_path,
+        inductor_configs=inductor_configs,
+    )
+
+
+@torch.no_grad()
+def compile_aot_packages(model, package_dir, batch_size=2, autocast_dtype=None):
+    """
+    Export the four graphs of a SAM 2 model (see `ONNX_MODEL_NAMES`) under the autocast
+    of `autocast_dtype` (None for float32) and compile them into AOTInductor packages in
+    `package_dir` (see `get_export_inputs` for `batch_size`). Each package is written to
+    a temporary file first, so that the processes sharing a cache directory never load a
+    partially written package. Returns their paths.
+    """
+    assert model.backend is None, "cannot compile a model with an execution backend"
+    os.makedirs(package_dir, exist_ok=True)
+    model.eval()
+    paths = {}
+    autocast = torch.autocast(
+        model.device.type,
+        dtype=autocast_dtype,
+        enabled=autocast_dtype is not None,
+    )
+    with real_valued_rope(model), autocast:
+        exports = get_export_inputs(model, batch_size=batch_size)
+        for name, (module, args, input_names, _) in exports.items():
+            start_time = time.perf_counter()
+            dims = {}
+            dynamic_shapes = {
+                input_name: {
+                    axis: dims.setdefault(dim_name, _get_export_dim(dim_name))
+                    for axis, dim_name in DYNAMIC_AXES[name][input_name].items()
+                }
+                for input_name in input_names
+            }
+            exported_program = torch.export.export(
+                module, args, dynamic_shapes=dynamic_shapes
+            )
+            path = os.path.join(package_dir, f"{name}.pt2")
+            tmp_path = os.path.join(package_dir, f".{name}-{uuid.uuid4().hex}.pt2")
+            try:
+                _compile_and_package(exported_program, args, package_path=tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            logging.info(
+                f"compiled {name} to {path} in {time.perf_counter() - start_time:.1f}s"
+            )
+            paths[name] = path
+    return paths
+
+
+class AOTInductorBackend(GraphBackend):
+    """
+    An execution backend running the AOTInductor packages compiled by
+    `compile_aot_packages` (in `package_dir`), to set as the `backend` of a SAM 2 model.
+    The inputs are passed in float32 (and run in the autocast dtype the packages were
+    compiled with) on the device the packages were compiled for, and the outputs are
+    returned as float32 tensors on the device of the inputs.
+    """
+
+    def __init__(self, package_dir, device):
+        self.device = torch.device(device)
+        self.packages = {
+            name: torch._inductor.aoti_load_package(
+                os.path.join(package_dir, f"{name}.pt2")
+            )
+            for name in ONNX_MODEL_NAMES
+        }
+
+    def _run(self, name, device, **inputs):
+        args = []
+        # (the graph inputs are in the order of `DYNAMIC_AXES`)
+        for k in DYNAMIC_AXES[name]:
+            x = inputs[k].to(self.device)
+            x = x.float() if x.is_floating_point() else x
+            # (the compiled code expects contiguous inputs)
+            args.append(x.contiguous())
+        outputs = self.packages[name](*args)
+        if isinstance(outputs, torch.Tensor):
+            outputs = [outputs]
+        return [
+            x.to(device, torch.float32 if x.is_floating_point() else x.dtype)
+            for x in outputs
+        ]
+
+
+def load_or_compile_aot_backend(model, cache_dir, config=None, autocast_dtype=None):
+    """
+    Load the AOTInductor packages of a model from `cache_dir` (see `get_aot_cache_key`),
+    compiling them first (under the autocast of `autocast_dtype`, None for float32) if
+    they aren't there yet, and return them as a backend.
+    """
+    package_dir = os.path.join(
+        cache_dir,
+        get_aot_cache_key(model, config=config, autocast_dtype=autocast_dtype),
+    )
+    missing = [
+        name
+        for name in ONNX_MODEL_NAMES
+        if not os.path.exists(os.path.join(package_dir, f"{name}.pt2"))
+    ]
+    if len(missing) > 0:
+        print(
+            f"Compiling the AOT packages of the model to {package_dir} "
+            "(only on the first start with this model, it may be slow)."
+        )
+        compile_aot_packages(model, package_dir, autocast_dtype=autocast_dtype)
+    start_time = time.perf_counter()
+    backend = AOTInductorBackend(package_dir, device=model.device)
+    logging.info(
+        f"loaded the AOT packages from {package_dir} in "
+        f"{time.perf_counter() - start_time:.1f}s"
+    )
+    return backend
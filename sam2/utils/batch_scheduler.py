@@ -0,0 +1,117 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import contextlib
+import threading
+import time
+
+
+class CrossSessionBatchScheduler:
+    """
+    Run the tracking steps of several inference sessions on the same model in batched
+    forward passes, in the style of continuous batching.
+
+    Each session runs its propagation (e.g. `propagate_in_video`) in its own thread, and
+    all the model calls are serialized by `lock`, which a session holds while advancing
+    its propagation (but not e.g. while sending its outputs). Once this scheduler is set
+    as the predictor's `step_scheduler`, each tracking step of a session (the frames to
+    track in `_propagate_frames`) is submitted to `run_step`, where the calling thread
+    releases `lock` until the step has been run. The pending steps are run together (up
+    to `max_batch_sessions` of them) in a single batched forward pass, where each object
+    attends to the memory bank of its own session, as soon as all the active sessions
+    (see `activate`) have submitted their next step, or once the oldest pending step
+    has waited for `max_wait_ms`. A session has at most one pending step at a time, so
+    the steps of each session always run in their order.
+    """
+
+    def __init__(self, predictor, lock, max_wait_ms=10, max_batch_sessions=None):
+        self.predictor = predictor
+        self.lock = lock
+        self.max_wait_ms = max_wait_ms
+        self.max_batch_sessions = max_batch_sessions
+        self._cond = threading.Condition(lock)
+        self._pending = []
+        self._num_active = 0
+        # the number of batched forward passes and of the steps they have run
+        self.num_batches = 0
+        self.num_steps = 0
+
+    @contextlib.contextmanager
+    def activate(self):
+        """
+        Mark a session as propagating while inside this context (to be entered without
+        holding `lock`), so that the pending steps wait for its next step.
+        """
+        with self._cond:
+            self._num_active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._num_active -= 1
+                # the pending steps might no longer need to wait for this session
+                self._cond.notify_all()
+
+    def run_step(self, inference_state, frames, start_frame_idx, keyframe_stride=1):
+        """
+        Submit a tracking step of a session and wait until it has been run (with `lock`
+        held by the calling thread). Returns its outputs as in `_propagate_frames`.
+        """
+        step = _PendingStep(
+            args=(inference_state, frames, start_frame_idx, keyframe_stride),
+            submit_time=time.monotonic(),
+        )
+        self._pending.append(step)
+        self._cond.notify_all()
+        while not step.done:
+            wait_time = self._pending[0].submit_time + self.max_wait_ms / 1000
+            wait_time -= time.monotonic()
+            if self._is_batch_full() or wait_time <= 0:
+                # run the pending steps in this thread
+                self._run_pending_steps()
+            else:
+                self._cond.wait(timeout=wait_time)
+        if step.exception is not None:
+            raise step.exception
+        return step.outputs
+
+    def _is_batch_full(self):
+        if self.max_batch_sessions is not None:
+            if len(self._pending) >= self.max_batch_sessions:
+                return True
+        return len(self._pending) >= self._num_active
+
+    def _run_pending_steps(self):
+        num_steps = len(self._pending)
+        if self.max_batch_sessions is not None:
+            num_steps = min(num_steps, self.max_batch_sessions)
+        steps = self._pending[:num_steps]
+        del self._pending[:num_steps]
+        try:
+            with self.predictor._profile_stage("track_frames", batch_size=len(steps)):
+                outputs = self.predictor._propagate_frames_across_sessions(
+                    [step.args for step in steps]
+                )
+            for step, step_outputs in zip(steps, outputs):
+                step.outputs = step_outputs
+        except Exception as e:
+            for step in steps:
+                step.exception = e
+        finally:
+            for step in steps:
+                step.done = True
+            self.num_batches += 1
+            self.num_steps += len(steps)
+            self._cond.notify_all()
+
+
+class _PendingStep:
+    def __init__(self, args, submit_time):
+        self.args = args
+        self.submit_time = submit_time
+        self.done = False
+        self.outputs = None
+        self.exception = None
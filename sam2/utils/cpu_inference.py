@@ -0,0 +1,80 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import contextlib
+import logging
+import warnings
+
+import torch
+
+
+def is_cpu_bf16_supported():
+    """Whether the CPU natively supports bfloat16 matmuls (e.g. with AVX512-BF16 or AMX)."""
+    return (
+        torch.backends.mkldnn.is_available()
+        and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    )
+
+
+def set_cpu_num_threads(num_threads=None, num_interop_threads=None):
+    """
+    Set the number of threads used for intra-op parallelism (within e.g. a matmul or a
+    convolution; PyTorch uses one per physical core by default) and for inter-op
+    parallelism. Leave them unchanged if None or 0.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            # it can only be set once, before any inter-op parallel work has started
+            warnings.warn(
+                f"{e}\n\nSkipping setting the number of inter-op threads "
+                f"to {num_interop_threads}.",
+                category=UserWarning,
+                stacklevel=2,
+            )
+    logging.info(
+        f"using {torch.get_num_threads()} intra-op and "
+        f"{torch.get_num_interop_threads()} inter-op CPU threads"
+    )
+
+
+def optimize_model_for_cpu(model, channels_last=True, quantize_int8=False):
+    """
+    Optimize a SAM 2 model for inference on CPU (in place).
+
+    - channels_last: store the convolution weights in channels-last memory format (so
+      that oneDNN runs the convolutions of the image encoder neck, the memory encoder
+      and the mask decoder without reordering their inputs and outputs).
+    - quantize_int8: apply dynamic int8 quantization to the linear layers of the image
+      encoder trunk (Hiera), the memory attention and the mask decoder's transformer,
+      whose weights are quantized once and activations on the fly. It only runs with
+      float32 inputs, so it can't be combined with bfloat16 autocast.
+
+    The accuracy cost of each option can be measured with `tools/cpu_benchmark.py`.
+    """
+    model.eval()
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    if quantize_int8:
+        from torch.ao.quantization import quantize_dynamic
+
+        for module in [
+            model.image_encoder.trunk,
+            model.memory_attention,
+            model.sam_mask_decoder.transformer,
+        ]:
+            quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def cpu_autocast_context(use_bf16):
+    """The autocast context for the CPU inference (bfloat16 autocast if `use_bf16`)."""
+    if use_bf16:
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
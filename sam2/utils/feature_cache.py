@@ -0,0 +1,340 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def _backbone_out_nbytes(backbone_out):
+    """Total number of bytes held by the tensors of a backbone output."""
+    tensors = backbone_out["backbone_fpn"] + backbone_out["vision_pos_enc"]
+    return sum(x.numel() * x.element_size() for x in tensors)
+
+
+def _entry_nbytes(image, backbone_out):
+    """Total number of bytes held by a cache entry (the image and its backbone output)."""
+    return image.numel() * image.element_size() + _backbone_out_nbytes(backbone_out)
+
+
+def _backbone_out_to(backbone_out, device):
+    """Move the tensors of a backbone output to `device` (other keys are dropped)."""
+    return {
+        "backbone_fpn": [x.to(device) for x in backbone_out["backbone_fpn"]],
+        "vision_pos_enc": [x.to(device) for x in backbone_out["vision_pos_enc"]],
+    }
+
+
+class BackboneFeatureCache:
+    """
+    An LRU cache of per-frame image encoder outputs in a video inference session.
+
+    Entries are `(image, backbone_out)` tuples keyed by frame index. The cache keeps
+    entries on the compute device up to a budget of `max_bytes` (counting the
+    `image`, `backbone_fpn` and `vision_pos_enc` tensors); the most recently used entry is
+    always kept, so `max_bytes=0` caches only the last visited frame. Entries evicted
+    from the compute device are moved to CPU RAM if `max_cpu_bytes > 0` (up to that
+    budget) and moved back to the compute device when they are hit again.
+
+    Hit and miss counters are available through `stats()` to size the budgets.
+
+    Entries can be added as pinned (e.g. by `BackbonePrefetcher` for the frames that are
+    about to be tracked), in which case they are not evicted before they are looked up
+    once. The cache can be accessed from multiple threads.
+    """
+
+    def __init__(self, max_bytes=0, max_cpu_bytes=0):
+        self.max_bytes = max_bytes
+        self.max_cpu_bytes = max_cpu_bytes
+        # frame_idx -> (image, backbone_out, nbytes), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._cpu_entries = OrderedDict()
+        self._pinned = set()
+        self._nbytes = 0
+        self._cpu_nbytes = 0
+        self._lock = threading.RLock()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._entries) + len(self._cpu_entries)
+
+    def __contains__(self, frame_idx):
+        return frame_idx in self._entries or frame_idx in self._cpu_entries
+
+    def get(self, frame_idx, default=None):
+        """Look up the `(image, backbone_out)` entry of a frame and mark it as used."""
+        with self._lock:
+            return self._get(frame_idx, default)
+
+    def put(self, frame_idx, image, backbone_out, pin=False):
+        """Add a frame's `(image, backbone_out)` entry as the most recently used one."""
+        nbytes = _entry_nbytes(image, backbone_out)
+        with self._lock:
+            self._pop(frame_idx)
+            if pin:
+                self._pinned.add(frame_idx)
+            self._insert(frame_idx, image, backbone_out, nbytes)
+
+    def pop(self, frame_idx):
+        """Remove a frame from the cache (if it's cached)."""
+        with self._lock:
+            self._pop(frame_idx)
+
+    def unpin_all(self):
+        """Make all pinned entries evictable again (and evict them if over the budget)."""
+        with self._lock:
+            self._pinned.clear()
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._cpu_entries.clear()
+            self._pinned.clear()
+            self._nbytes = 0
+            self._cpu_nbytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.cpu_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """Hit/miss counters and the current size of the cache."""
+        num_lookups = self.hits + self.cpu_hits + self.misses
+        return {
+            "hits": self.hits,
+            "cpu_hits": self.cpu_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.cpu_hits) / max(num_lookups, 1),
+            "evictions": self.evictions,
+            "num_frames": len(self._entries),
+            "num_cpu_frames": len(self._cpu_entries),
+            "num_pinned_frames": len(self._pinned),
+            "nbytes": self._nbytes,
+            "cpu_nbytes": self._cpu_nbytes,
+            "max_bytes": self.max_bytes,
+            "max_cpu_bytes": self.max_cpu_bytes,
+        }
+
+    def _get(self, frame_idx, default):
+        self._pinned.discard(frame_idx)
+        entry = self._entries.get(frame_idx)
+        if entry is not None:
+            self._entries.move_to_end(frame_idx)
+            self.hits += 1
+            return entry[0], entry[1]
+
+        entry = self._cpu_entries.pop(frame_idx, None)
+        if entry is not None:
+            image, backbone_out, nbytes = entry
+            self._cpu_nbytes -= nbytes
+            self.cpu_hits += 1
+            # promote the entry back to the compute device
+            device = backbone_out["device"]
+            image = image.to(device, non_blocking=True)
+            backbone_out = _backbone_out_to(backbone_out, device)
+            self._insert(frame_idx, image, backbone_out, nbytes)
+            return image, backbone_out
+
+        self.misses += 1
+        return default
+
+    def _pop(self, frame_idx):
+        self._pinned.discard(frame_idx)
+        entry = self._entries.pop(frame_idx, None)
+        if entry is not None:
+            self._nbytes -= entry[2]
+        entry = self._cpu_entries.pop(frame_idx, None)
+        if entry is not None:
+            self._cpu_nbytes -= entry[2]
+
+    def _insert(self, frame_idx, image, backbone_out, nbytes):
+        self._entries[frame_idx] = (image, backbone_out, nbytes)
+        self._nbytes += nbytes
+        self._evict()
+
+    def _evict(self):
+        # evict the least recently used entries that aren't pinned (always keeping the newest one)
+        newest_frame_idx = next(reversed(self._entries), None)
+        while self._nbytes > self.max_bytes:
+            old_frame_idx = next(
+                (
+                    t
+                    for t in self._entries
+                    if t not in self._pinned and t != newest_frame_idx
+                ),
+                None,
+            )
+            if old_frame_idx is None:
+                break
+            old_entry = self._entries.pop(old_frame_idx)
+            self._nbytes -= old_entry[2]
+            self._spill_to_cpu(old_frame_idx, old_entry)
+
+    def _spill_to_cpu(self, frame_idx, entry):
+        image, backbone_out, nbytes = entry
+        if nbytes > self.max_cpu_bytes:
+            self.evictions += 1
+            return
+        device = backbone_out["backbone_fpn"][0].device
+        cpu_backbone_out = _backbone_out_to(backbone_out, torch.device("cpu"))
+        # remember where to move this entry back when it's hit again
+        cpu_backbone_out["device"] = device
+        self._cpu_entries[frame_idx] = (image.cpu(), cpu_backbone_out, nbytes)
+        self._cpu_nbytes += nbytes
+        while self._cpu_nbytes > self.max_cpu_bytes:
+            _, old_entry = self._cpu_entries.popitem(last=False)
+            self._cpu_nbytes -= old_entry[2]
+            self.evictions += 1
+
+
+class BackbonePrefetcher:
+    """
+    Compute the image encoder outputs of the upcoming frames in a background thread.
+
+    The frames in `frame_inds` (in their processing order) are encoded with
+    `compute_fn(frame_inds) -> [(image, backbone_out), ...]` in micro-batches of up to
+    `batch_size` frames, and the results are added as pinned entries to `cache`. The
+    prefetcher runs at most `depth` frames ahead of the consumer, which reports its
+    position through `wait(position)` and blocks until that frame has been prefetched.
+
+    On CUDA, the prefetching runs on a separate stream. On CPU, the intra-op threads are
+    partitioned between the prefetching thread (`num_threads`, by default half of them)
+    and the calling thread (the rest) until `stop()` is called.
+    """
+
+    def __init__(
+        self,
+        cache,
+        compute_fn,
+        frame_inds,
+        depth,
+        batch_size=1,
+        device=None,
+        num_threads=None,
+    ):
+        self.cache = cache
+        self.compute_fn = compute_fn
+        self.frame_inds = list(frame_inds)
+        self.depth = depth
+        self.batch_size = max(batch_size, 1)
+        self.device = torch.device(device) if device is not None else None
+        self.num_threads = num_threads
+        # the number of frames in `frame_inds` that have been prefetched or consumed
+        self._num_done = 0
+        # the position of the frame currently being consumed
+        self._position = 0
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._main_num_threads = None
+        self._consumer_stream = None
+        # catch and raise any exceptions in the prefetching thread
+        self.exception = None
+
+    def start(self):
+        # replicate the inference mode and autocast settings of the calling thread
+        device_type = self.device.type if self.device is not None else "cpu"
+        inference_mode = torch.is_inference_mode_enabled()
+        autocast_enabled = torch.is_autocast_enabled(device_type)
+        autocast_dtype = torch.get_autocast_dtype(device_type)
+        worker_num_threads = None
+        if device_type == "cuda":
+            self._consumer_stream = torch.cuda.current_stream(self.device)
+        elif device_type == "cpu":
+            total_num_threads = torch.get_num_threads()
+            worker_num_threads = self.num_threads or max(total_num_threads // 2, 1)
+            if total_num_threads > worker_num_threads:
+                self._main_num_threads = total_num_threads
+                torch.set_num_threads(total_num_threads - worker_num_threads)
+
+        def _run():
+            try:
+                if worker_num_threads is not None:
+                    torch.set_num_threads(worker_num_threads)
+                with torch.inference_mode(inference_mode), torch.autocast(
+                    device_type, dtype=autocast_dtype, enabled=autocast_enabled
+                ):
+                    self._prefetch_frames(device_type)
+            except Exception as e:
+                self.exception = e
+            finally:
+                with self._cond:
+                    self._stopped = True
+                    self._cond.notify_all()
+
+        self._thread = threading.Thread(target=_run, daemon=True)
+        self._thread.start()
+        return self
+
+    def wait(self, position):
+        """Block until the frame at `position` in `frame_inds` has been prefetched."""
+        with self._cond:
+            self._position = position
+            self._cond.notify_all()
+            while self._num_done <= position and not self._stopped:
+                self._cond.wait()
+        if self.exception is not None:
+            raise RuntimeError("Failure in backbone prefetching") from self.exception
+
+    def stop(self):
+        """Stop prefetching and unpin any prefetched frames that haven't been consumed."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._main_num_threads is not None:
+            torch.set_num_threads(self._main_num_threads)
+            self._main_num_threads = None
+        self.cache.unpin_all()
+
+    def _prefetch_frames(self, device_type):
+        stream = None
+        if device_type == "cuda":
+            stream = torch.cuda.Stream(self.device)
+        while True:
+            with self._cond:
+                # wait until the consumer is close enough to the next frames to prefetch
+                while (
+                    not self._stopped
+                    and self._num_done < len(self.frame_inds)
+                    and self._num_done > self._position + self.depth
+                ):
+                    self._cond.wait()
+                if self._stopped or self._num_done >= len(self.frame_inds):
+                    return
+                start = self._num_done
+                end = min(
+                    start + self.batch_size,
+                    len(self.frame_inds),
+                    self._position + self.depth + 1,
+                )
+            # skip the frames that are already in the cache
+            batch_frame_inds = [
+                t for t in self.frame_inds[start:end] if t not in self.cache
+            ]
+            if len(batch_frame_inds) > 0:
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        outputs = self.compute_fn(batch_frame_inds)
+                    stream.synchronize()
+                    # the consumer will use (and free) these tensors on its own stream
+                    for image, backbone_out in outputs:
+                        tensors = [image] + backbone_out["backbone_fpn"]
+                        for x in tensors + backbone_out["vision_pos_enc"]:
+                            x.record_stream(self._consumer_stream)
+                else:
+                    outputs = self.compute_fn(batch_frame_inds)
+                for t, (image, backbone_out) in zip(batch_frame_inds, outputs):
+                    self.cache.put(t, image, backbone_out, pin=True)
+            with self._cond:
+                self._num_done = end
+                self._cond.notify_all()
@@ -0,0 +1,180 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+import torch
+
+
+def compute_video_hash(video_path):
+    """
+    Hash the content of a video, given as an MP4 file path, the bytes of a video file or
+    a directory of JPEG frames (hashing the frame file names and their content).
+    """
+    hasher = hashlib.sha1()
+    if isinstance(video_path, bytes):
+        hasher.update(video_path)
+    elif os.path.isdir(video_path):
+        frame_names = sorted(
+            p
+            for p in os.listdir(video_path)
+            if os.path.splitext(p)[-1] in [".jpg", ".jpeg", ".JPG", ".JPEG"]
+        )
+        for frame_name in frame_names:
+            hasher.update(frame_name.encode())
+            _update_hash_from_file(hasher, os.path.join(video_path, frame_name))
+    else:
+        _update_hash_from_file(hasher, video_path)
+    return hasher.hexdigest()
+
+
+def _update_hash_from_file(hasher, path, chunk_size=1 << 20):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+
+
+def compute_module_hash(modules):
+    """Hash the parameters and buffers of a list of modules (e.g. to identify a checkpoint)."""
+    hasher = hashlib.sha1()
+    for module in modules:
+        for name, x in list(module.named_parameters()) + list(module.named_buffers()):
+            x = x.detach().to(device="cpu", dtype=torch.float32).contiguous()
+            hasher.update(f"{name}:{tuple(x.shape)}".encode())
+            hasher.update(x.numpy().tobytes())
+    return hasher.hexdigest()
+
+
+class BackboneFeatureStore:
+    """
+    A persistent on-disk store of the image encoder outputs of a video.
+
+    The `backbone_fpn` features of each level are kept in a memory-mapped fp16 array of
+    shape [num_frames, C, H, W] under `root_dir/key`, along with a per-frame flag of which
+    frames have been written. Since `vision_pos_enc` is the same for all the frames of a
+    video, it's only stored once. The arrays are created when the first frame is written
+    (and are shared by all the sessions on the same video), so `key` should identify the
+    video content, the model weights and the image size (see `compute_video_hash`).
+
+    Reads return CPU tensors that are views of the memory-mapped files (zero copy).
+    """
+
+    def __init__(self, root_dir, key, num_frames):
+        self.root_dir = root_dir
+        self.path = os.path.join(root_dir, key)
+        self.num_frames = num_frames
+        self._lock = threading.Lock()
+        self._fpn = None
+        self._pos_enc = None
+        self._written = None
+        # the dtypes of the original features (to cast the stored fp16 features back to)
+        self.fpn_dtypes = None
+        self.pos_enc_dtypes = None
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(os.path.join(self.path, "meta.json")):
+            self._open()
+
+    def __contains__(self, frame_idx):
+        return self._written is not None and bool(self._written[frame_idx])
+
+    def get(self, frame_idx):
+        """Read the `backbone_out` of a frame as fp16 CPU tensors (or None if not stored)."""
+        if frame_idx not in self:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {
+            "backbone_fpn": [
+                torch.from_numpy(x[frame_idx : frame_idx + 1]) for x in self._fpn
+            ],
+            "vision_pos_enc": [torch.from_numpy(x) for x in self._pos_enc],
+        }
+
+    def put(self, frame_idx, backbone_out):
+        """Write the `backbone_out` of a frame (creating the store on the first write)."""
+        with self._lock:
+            if self._written is None:
+                self._create(backbone_out)
+            for x, feat in zip(self._fpn, backbone_out["backbone_fpn"]):
+                x[frame_idx] = feat[0].to(device="cpu", dtype=torch.float16).numpy()
+            # set the flag after the features, so that readers never see partial frames
+            self._written[frame_idx] = True
+
+    def flush(self):
+        with self._lock:
+            if self._written is not None:
+                for x in self._fpn:
+                    x.flush()
+                self._written.flush()
+
+    def _create(self, backbone_out):
+        meta = {
+            "num_frames": self.num_frames,
+            "fpn_shapes": [list(x.shape[1:]) for x in backbone_out["backbone_fpn"]],
+            "pos_enc_shapes": [list(x.shape) for x in backbone_out["vision_pos_enc"]],
+            "fpn_dtypes": [str(x.dtype) for x in backbone_out["backbone_fpn"]],
+            "pos_enc_dtypes": [str(x.dtype) for x in backbone_out["vision_pos_enc"]],
+        }
+        # create the files in a temporary directory and move it into place, so that
+        # concurrent sessions on the same video never see a partially created store
+        tmp_path = f"{self.path}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp_path)
+        for i, shape in enumerate(meta["fpn_shapes"]):
+            np.lib.format.open_memmap(
+                os.path.join(tmp_path, f"fpn_{i}.npy"),
+                mode="w+",
+                dtype=np.float16,
+                shape=(self.num_frames, *shape),
+            ).flush()
+        for i, pos in enumerate(backbone_out["vision_pos_enc"]):
+            pos = pos[0:1].to(device="cpu", dtype=torch.float16).numpy()
+            np.save(os.path.join(tmp_path, f"pos_enc_{i}.npy"), pos)
+        np.lib.format.open_memmap(
+            os.path.join(tmp_path, "written.npy"),
+            mode="w+",
+            dtype=np.bool_,
+            shape=(self.num_frames,),
+        ).flush()
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            # another session has created the store in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self._open()
+
+    def _open(self):
+        with open(os.path.join(self.path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["num_frames"] != self.num_frames:
+            raise RuntimeError(
+                f"The feature store at {self.path} has {meta['num_frames']} frames, "
+                f"but the video has {self.num_frames} frames."
+            )
+        self._fpn = [
+            np.load(os.path.join(self.path, f"fpn_{i}.npy"), mmap_mode="r+")
+            for i in range(len(meta["fpn_shapes"]))
+        ]
+        self._pos_enc = [
+            np.load(os.path.join(self.path, f"pos_enc_{i}.npy"))
+            for i in range(len(meta["pos_enc_shapes"]))
+        ]
+        self.fpn_dtypes = [_parse_dtype(d) for d in meta["fpn_dtypes"]]
+        self.pos_enc_dtypes = [_parse_dtype(d) for d in meta["pos_enc_dtypes"]]
+        self._written = np.load(os.path.join(self.path, "written.npy"), mmap_mode="r+")
+
+
+def _parse_dtype(name):
+    # e.g. "torch.bfloat16" -> torch.bfloat16
+    return getattr(torch, name.split(".")[-1])
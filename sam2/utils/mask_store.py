@@ -0,0 +1,87 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+
+class EvictedMaskStore:
+    """
+    A disk-backed store of per-object mask scores evicted from a video inference session.
+
+    Masks are appended as float32 arrays to an anonymous temporary file created under
+    `root_dir` (the system temporary directory by default), which is deleted when the
+    store is closed or garbage collected. Only a small `(obj_id, frame_idx)` index is
+    kept in memory. Entries are keyed by object id (instead of object index) so that
+    they remain valid when other objects are removed from the session.
+    """
+
+    def __init__(self, root_dir=None):
+        self.root_dir = root_dir
+        self._file = tempfile.TemporaryFile(dir=root_dir)
+        # (obj_id, frame_idx) -> (offset, shape) of the mask scores in the file
+        self._index = {}
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        """Iterate over the `(obj_id, frame_idx)` keys of the stored entries."""
+        return iter(list(self._index))
+
+    @property
+    def nbytes(self):
+        """Number of bytes written to the file (including overwritten entries)."""
+        return self._nbytes
+
+    def put(self, obj_id, frame_idx, masks):
+        """Write the mask scores of an object on a frame (replacing any previous entry)."""
+        array = masks.detach().to(device="cpu", dtype=torch.float32).numpy()
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        self._file.write(array.tobytes())
+        self._index[(obj_id, frame_idx)] = (offset, array.shape)
+        self._nbytes = offset + array.nbytes
+
+    def get(self, obj_id, frame_idx, device=None):
+        """Read back the mask scores of an object on a frame (or None if not stored)."""
+        entry = self._index.get((obj_id, frame_idx))
+        if entry is None:
+            return None
+        offset, shape = entry
+        self._file.seek(offset)
+        buffer = self._file.read(int(np.prod(shape)) * 4)
+        masks = torch.from_numpy(np.frombuffer(buffer, dtype=np.float32).copy())
+        masks = masks.view(shape)
+        if device is not None:
+            masks = masks.to(device, non_blocking=True)
+        return masks
+
+    def pop(self, obj_id, frame_idx):
+        """Remove an entry (the file space is reclaimed on `clear`)."""
+        self._index.pop((obj_id, frame_idx), None)
+
+    def remove_object(self, obj_id):
+        """Remove all the entries of an object."""
+        for key in [key for key in self._index if key[0] == obj_id]:
+            del self._index[key]
+
+    def clear(self):
+        self._index.clear()
+        self._file.seek(0)
+        self._file.truncate()
+        self._nbytes = 0
+
+    def close(self):
+        self._index.clear()
+        self._file.close()
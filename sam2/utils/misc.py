@@ -63,6 +63,41 @@ def get_connected_components(mask):
     return _C.get_connected_componnets(mask.to(torch.uint8).contiguous())
 
 
+def get_small_connected_components(mask, max_area):
+    """
+    Get the pixels of the connected components (8-connectivity) with an area of at most
+    `max_area` in binary masks of shape (N, 1, H, W). It's a pure PyTorch alternative to
+    `get_connected_components` (whose CUDA kernel isn't available e.g. on CPU), which is
+    cheap for a small `max_area`.
+
+    The label of each component (its largest pixel index) is propagated to its pixels
+    in (max_area - 1) steps, which covers every component with an area of at most
+    `max_area`. Labels that only cover a part of a larger component are discarded, as
+    some of their pixels have a neighbor with another label.
+    """
+    N, _, H, W = mask.shape
+    mask = mask.bool()
+    # the (1-based) pixel indices as labels (float64 represents them exactly)
+    labels = torch.arange(1, N * H * W + 1, dtype=torch.float64, device=mask.device)
+    labels = torch.where(mask, labels.view(N, 1, H, W), 0)
+    for _ in range(max_area - 1):
+        max_labels = torch.nn.functional.max_pool2d(labels, 3, stride=1, padding=1)
+        labels = torch.where(mask, max_labels, 0)
+    # the pixels with a neighbor of another label (their labels only partially cover
+    # their components)
+    max_labels = torch.nn.functional.max_pool2d(labels, 3, stride=1, padding=1)
+    min_labels = -torch.nn.functional.max_pool2d(
+        torch.where(mask, -labels, -float("inf")), 3, stride=1, padding=1
+    )
+    is_partial = mask & ((max_labels != labels) | (min_labels != labels))
+    labels = labels.long().flatten()
+    areas = torch.bincount(labels, minlength=N * H * W + 1)
+    is_partial_label = torch.zeros_like(areas, dtype=torch.bool)
+    is_partial_label[labels[is_partial.flatten()]] = True
+    is_small = (areas[labels] <= max_area) & ~is_partial_label[labels]
+    return mask & is_small.view(N, 1, H, W)
+
+
 def mask_to_box(masks: torch.Tensor):
     """
     compute bounding box given an input mask
@@ -169,6 +204,66 @@ class AsyncVideoFrameLoader:
         return len(self.images)
 
 
+class StreamingFrameBuffer:
+    """
+    A buffer of the most recent frames of a video stream (e.g. from a camera), where the
+    frames are pushed one at a time and indexed by their position in the stream. Only the
+    last `max_frames` frames are kept.
+    """
+
+    def __init__(
+        self,
+        image_size,
+        max_frames,
+        offload_video_to_cpu,
+        img_mean=(0.485, 0.456, 0.406),
+        img_std=(0.229, 0.224, 0.225),
+        compute_device=torch.device("cuda"),
+    ):
+        self.image_size = image_size
+        self.max_frames = max_frames
+        self.offload_video_to_cpu = offload_video_to_cpu
+        self.img_mean = torch.tensor(img_mean, dtype=torch.float32)[:, None, None]
+        self.img_std = torch.tensor(img_std, dtype=torch.float32)[:, None, None]
+        self.compute_device = compute_device
+        self.images = {}
+        self.num_frames = 0
+        # video_height and video_width be filled when pushing the first frame
+        self.video_height = None
+        self.video_width = None
+
+    def append(self, frame):
+        """Push a frame (an RGB PIL image or uint8 array) and return its frame index."""
+        img_pil = frame if isinstance(frame, Image.Image) else Image.fromarray(frame)
+        self.video_width, self.video_height = img_pil.size
+        img_np = np.array(img_pil.convert("RGB").resize((self.image_size,) * 2))
+        if img_np.dtype != np.uint8:
+            raise RuntimeError(f"Unknown image dtype: {img_np.dtype}")
+        img = torch.from_numpy(img_np / 255.0).permute(2, 0, 1).float()
+        # normalize by mean and std
+        img -= self.img_mean
+        img /= self.img_std
+        if not self.offload_video_to_cpu:
+            img = img.to(self.compute_device, non_blocking=True)
+        frame_idx = self.num_frames
+        self.images[frame_idx] = img
+        self.images.pop(frame_idx - self.max_frames, None)
+        self.num_frames += 1
+        return frame_idx
+
+    def __getitem__(self, index):
+        img = self.images.get(index)
+        if img is None:
+            raise IndexError(
+                f"Frame {index} is not in the buffer of the last {self.max_frames} "
+                f"frames (out of {self.num_frames} frames in the stream)"
+            )
+        return img
+
+    def __len__(self):
+        return self.num_frames
+
+
 def load_video_frames(
     video_path,
     image_size,
@@ -341,8 +436,12 @@ def fill_holes_in_mask_scores(mask, max_area):
 
     input_mask = mask
     try:
-        labels, areas = get_connected_components(mask <= 0)
-        is_hole = (labels > 0) & (areas <= max_area)
+        if mask.device.type == "cpu":
+            # (the CUDA kernel of `get_connected_components` isn't available on CPU)
+            is_hole = get_small_connected_components(mask <= 0, max_area)
+        else:
+            labels, areas = get_connected_components(mask <= 0)
+            is_hole = (labels > 0) & (areas <= max_area)
         # We fill holes with a small positive mask score (0.1) to change them to foreground.
         mask = torch.where(is_hole, 0.1, mask)
     except Exception as e:
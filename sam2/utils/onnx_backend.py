@@ -0,0 +1,487 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Export the inference components of a SAM 2 model to ONNX, and run them with ONNX Runtime
+as the execution backend of a model (`SAM2Base.backend`), e.g. to serve the image and
+video predictors on CPU-only nodes without running the PyTorch modules.
+
+The model is split into four graphs (which can be exported with `tools/export_onnx.py`):
+- "image_encoder": the Hiera trunk and the FPN neck (with the projections of the high-
+  resolution features in the SAM mask decoder), as in `SAM2Base.forward_image`
+- "prompt_mask_decoder": the SAM prompt encoder on point and mask prompts and the SAM
+  mask decoder, with the outputs of all the mask tokens (see `MaskDecoder.predict_masks`)
+- "memory_attention": the memory attention on a spatial memory and object pointers
+- "memory_encoder": the memory encoder on the (sigmoid) mask scores
+
+To run a predictor with ONNX Runtime (the PyTorch modules are then only used for the
+glue code, e.g. the object pointer projections and the mask selection):
+
+    predictor = SAM2ImagePredictor(build_sam2(...))
+    predictor.model.backend = OnnxRuntimeBackend("path/to/onnx_dir")
+
+    predictor = build_sam2_video_predictor(...)
+    predictor.backend = OnnxRuntimeBackend("path/to/onnx_dir")
+
+The backend doesn't support the projected memory cache (`cache_memory_kv`) or the
+compiled modules of `SAM2VideoPredictorVOS`.
+"""
+
+import contextlib
+import logging
+import os
+
+import numpy as np
+import torch
+from torch import nn
+
+from sam2.modeling.sam.transformer import RoPEAttention
+
+ONNX_MODEL_NAMES = [
+    "image_encoder",
+    "prompt_mask_decoder",
+    "memory_attention",
+    "memory_encoder",
+]
+# the version of the graph inputs and outputs, to bump when they change (so that the
+# graphs compiled by a previous version aren't loaded from a cache)
+GRAPH_VERSION = 2
+
+
+class ImageEncoderOnnx(nn.Module):
+    """
+    The image encoder of a SAM 2 model (as in `SAM2Base.forward_image`) with flat outputs:
+    the FPN features ("backbone_fpn_{i}") and their positional encoding
+    ("vision_pos_enc_{i}") from the highest to the lowest resolution.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        backbone_out = self.model.forward_image(image)
+        return tuple(backbone_out["backbone_fpn"]) + tuple(
+            backbone_out["vision_pos_enc"]
+        )
+
+
+class PromptMaskDecoderOnnx(nn.Module):
+    """
+    The SAM prompt encoder and mask decoder of a SAM 2 model on point prompts (with boxes
+    as points, see `SAM2Base._predict_sam_masks`) and a mask prompt, which is only used
+    where `has_mask_input` is 1 (as there's no optional input in the graph). The points
+    aren't padded in the graph (the caller adds the padding point of the prompt encoder),
+    so that mask-only prompts can be run with zero points. The image embeddings must have
+    the same batch size as the prompts.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        assert model.use_high_res_features_in_sam
+        self.prompt_encoder = model.sam_prompt_encoder
+        self.mask_decoder = model.sam_mask_decoder
+
+    def forward(
+        self,
+        image_embeddings,
+        high_res_feats_0,
+        high_res_feats_1,
+        point_coords,
+        point_labels,
+        mask_input,
+        has_mask_input,
+    ):
+        # (as in `PromptEncoder.forward` with points, which are padded by the caller)
+        sparse_embeddings = self.prompt_encoder._embed_points(
+            point_coords, point_labels, pad=False
+        )
+        has_mask_input = has_mask_input.reshape(-1, 1, 1, 1)
+        dense_embeddings = has_mask_input * self.prompt_encoder._embed_masks(
+            mask_input
+        ) + (1 - has_mask_input) * self.prompt_encoder.no_mask_embed.weight.reshape(
+            1, -1, 1, 1
+        )
+        return self.mask_decoder.predict_masks(
+            image_embeddings=image_embeddings,
+            image_pe=self.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            repeat_image=False,
+            high_res_features=[high_res_feats_0, high_res_feats_1],
+        )
+
+
+class MemoryAttentionOnnx(nn.Module):
+    """
+    The memory attention of a SAM 2 model, with the spatial memory and the object pointers
+    as separate inputs (so that the number of object pointer tokens, which are excluded
+    from the rotary encoding, is part of the input shapes) and a [B, N] mask of the valid
+    memory tokens (all ones for a memory bank shared by all the samples).
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.memory_attention = model.memory_attention
+
+    def forward(
+        self, curr, curr_pos, memory, memory_pos, obj_ptrs, obj_ptrs_pos, memory_mask
+    ):
+        return self.memory_attention(
+            curr=curr,
+            curr_pos=curr_pos,
+            memory=torch.cat([memory, obj_ptrs], dim=0),
+            memory_pos=torch.cat([memory_pos, obj_ptrs_pos], dim=0),
+            num_obj_ptr_tokens=obj_ptrs.shape[0],
+            memory_mask=memory_mask,
+        )
+
+
+class MemoryEncoderOnnx(nn.Module):
+    """The memory encoder of a SAM 2 model on the mask scores after sigmoid."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.memory_encoder = model.memory_encoder
+
+    def forward(self, pix_feat, masks):
+        out = self.memory_encoder(pix_feat, masks, skip_mask_sigmoid=True)
+        return out["vision_features"], out["vision_pos_enc"][-1]
+
+
+# the dynamic dimensions of the inputs of each graph
+DYNAMIC_AXES = {
+    "image_encoder": {"image": {0: "batch"}},
+    "prompt_mask_decoder": {
+        "image_embeddings": {0: "batch"},
+        "high_res_feats_0": {0: "batch"},
+        "high_res_feats_1": {0: "batch"},
+        "point_coords": {0: "batch", 1: "num_points"},
+        "point_labels": {0: "batch", 1: "num_points"},
+        "mask_input": {0: "batch"},
+        "has_mask_input": {0: "batch"},
+    },
+    "memory_attention": {
+        "curr": {1: "batch"},
+        "curr_pos": {1: "batch"},
+        "memory": {0: "num_memory", 1: "batch"},
+        "memory_pos": {0: "num_memory", 1: "batch"},
+        "obj_ptrs": {0: "num_obj_ptrs", 1: "batch"},
+        "obj_ptrs_pos": {0: "num_obj_ptrs", 1: "batch"},
+        "memory_mask": {0: "batch", 1: "num_memory_and_obj_ptrs"},
+    },
+    "memory_encoder": {"pix_feat": {0: "batch"}, "masks": {0: "batch"}},
+}
+
+
+@contextlib.contextmanager
+def real_valued_rope(model):
+    """Switch the rotary encoding of a model to real-valued operations (for export)."""
+    rope_modules = [m for m in model.modules() if isinstance(m, RoPEAttention)]
+    for m in rope_modules:
+        m.use_real_rope = True
+    try:
+        yield
+    finally:
+        for m in rope_modules:
+            m.use_real_rope = False
+
+
+@torch.no_grad()
+def get_export_inputs(model, batch_size=2):
+    """
+    The module of each of the four graphs of a SAM 2 model (see `ONNX_MODEL_NAMES`) with
+    example inputs of `batch_size` samples (the dynamic dimensions should be traced with
+    sizes above 1), and the names of its inputs and outputs.
+    """
+    device = next(model.parameters()).device
+    B, C, mem_dim = batch_size, model.hidden_dim, model.mem_dim
+    image_size = model.image_size
+    H = W = model.sam_image_embedding_size
+    image = torch.randn(B, 3, image_size, image_size, device=device)
+    backbone_out = model.forward_image(image)
+    num_levels = len(backbone_out["backbone_fpn"])
+    # (the backbone features are channels-last, but the graphs are run on contiguous
+    # inputs, and the strides of the example inputs are baked into compiled graphs)
+    high_res_feats = [x.contiguous() for x in backbone_out["backbone_fpn"][:2]]
+    image_embeddings = backbone_out["backbone_fpn"][-1].contiguous()
+    num_points = 3
+    num_mem_frames, num_ptrs = 2, 4
+    mask_size = model.sam_prompt_encoder.mask_input_size
+    return {
+        "image_encoder": (
+            ImageEncoderOnnx(model),
+            (image,),
+            ["image"],
+            [f"backbone_fpn_{i}" for i in range(num_levels)]
+            + [f"vision_pos_enc_{i}" for i in range(num_levels)],
+        ),
+        "prompt_mask_decoder": (
+            PromptMaskDecoderOnnx(model),
+            (
+                image_embeddings,
+                high_res_feats[0],
+                high_res_feats[1],
+                torch.rand(B, num_points, 2, device=device) * image_size,
+                torch.randint(0, 4, (B, num_points), device=device).float(),
+                torch.randn(B, 1, *mask_size, device=device),
+                torch.ones(B, device=device),
+            ),
+            [
+                "image_embeddings",
+                "high_res_feats_0",
+                "high_res_feats_1",
+                "point_coords",
+                "point_labels",
+                "mask_input",
+                "has_mask_input",
+            ],
+            ["masks", "iou_pred", "mask_tokens_out", "object_score_logits"],
+        ),
+        "memory_attention": (
+            MemoryAttentionOnnx(model),
+            (
+                torch.randn(H * W, B, C, device=device),
+                torch.randn(H * W, B, C, device=device),
+                torch.randn(num_mem_frames * H * W, B, mem_dim, device=device),
+                torch.randn(num_mem_frames * H * W, B, mem_dim, device=device),
+                torch.randn(num_ptrs, B, mem_dim, device=device),
+                torch.randn(num_ptrs, B, mem_dim, device=device),
+                torch.ones(
+                    B,
+                    num_mem_frames * H * W + num_ptrs,
+                    dtype=torch.bool,
+                    device=device,
+                ),
+            ),
+            [
+                "curr",
+                "curr_pos",
+                "memory",
+                "memory_pos",
+                "obj_ptrs",
+                "obj_ptrs_pos",
+                "memory_mask",
+            ],
+            ["pix_feat_with_mem"],
+        ),
+        "memory_encoder": (
+            MemoryEncoderOnnx(model),
+            (
+                image_embeddings,
+                torch.rand(B, 1, image_size, image_size, device=device),
+            ),
+            ["pix_feat", "masks"],
+            ["maskmem_features", "maskmem_pos_enc"],
+        ),
+    }
+
+
+@torch.no_grad()
+def export_onnx_models(model, output_dir, opset_version=17, batch_size=2):
+    """
+    Export the four graphs of a SAM 2 model (see `ONNX_MODEL_NAMES`) as ONNX files in
+    `output_dir`, with dynamic batch sizes, numbers of prompt points and memory lengths
+    (see `get_export_inputs` for `batch_size`). Returns the paths of the exported files.
+    """
+    assert model.backend is None, "cannot export a model with an execution backend"
+    os.makedirs(output_dir, exist_ok=True)
+    model.eval()
+    paths = {}
+    with real_valued_rope(model):
+        exports = get_export_inputs(model, batch_size=batch_size)
+        for name, (module, args, input_names, output_names) in exports.items():
+            axes = dict(DYNAMIC_AXES[name])
+            for output_name in output_names:
+                axes[output_name] = {1 if name == "memory_attention" else 0: "batch"}
+            path = os.path.join(output_dir, f"{name}.onnx")
+            torch.onnx.export(
+                module,
+                args,
+                path,
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_axes=axes,
+                opset_version=opset_version,
+                dynamo=False,
+            )
+            logging.info(f"exported {name} to {path}")
+            paths[name] = path
+    return paths
+
+
+class GraphBackend:
+    """
+    The base class of the execution backends running the four graphs of a SAM 2 model
+    (see `ONNX_MODEL_NAMES`) in place of its modules, which adapts the calls of the model
+    to the graph inputs. Subclasses implement `_run` to run a graph on named inputs.
+    """
+
+    def _run(self, name, device, **inputs):
+        """Run a graph and return its outputs as a list of tensors on `device`."""
+        raise NotImplementedError
+
+    def forward_image(self, img_batch):
+        """Run the image encoder (see `SAM2Base.forward_image`)."""
+        outputs = self._run("image_encoder", img_batch.device, image=img_batch)
+        num_levels = len(outputs) // 2
+        backbone_fpn, vision_pos_enc = outputs[:num_levels], outputs[num_levels:]
+        return {
+            "vision_features": backbone_fpn[-1],
+            "vision_pos_enc": vision_pos_enc,
+            "backbone_fpn": backbone_fpn,
+        }
+
+    def predict_masks(
+        self,
+        image_embeddings,
+        high_res_features,
+        point_coords,
+        point_labels,
+        mask_inputs,
+        repeat_image,
+    ):
+        """
+        Run the SAM prompt encoder and mask decoder, returning the outputs of all the mask
+        tokens (see `MaskDecoder.predict_masks`). As in `PromptEncoder.forward`, the point
+        prompts get a padding point, and without point prompts there are no point tokens.
+        """
+        device = image_embeddings.device
+        if point_coords is not None:
+            B = point_coords.size(0)
+        elif mask_inputs is not None:
+            B = mask_inputs.size(0)
+        else:
+            B = image_embeddings.size(0)
+        if point_coords is None:
+            point_coords = torch.zeros(B, 0, 2, device=device)
+            point_labels = torch.zeros(B, 0, device=device)
+        else:
+            # (the labels are promoted to float with the padding label in the prompt encoder)
+            point_coords = torch.cat(
+                [point_coords, torch.zeros(B, 1, 2, device=device)], dim=1
+            )
+            point_labels = torch.cat(
+                [point_labels.float(), -torch.ones(B, 1, device=device)], dim=1
+            )
+        has_mask_input = torch.ones(B, device=device)
+        if mask_inputs is None:
+            mask_size = (image_embeddings.size(-2) * 4, image_embeddings.size(-1) * 4)
+            mask_inputs = torch.zeros(B, 1, *mask_size, device=device)
+            has_mask_input = torch.zeros(B, device=device)
+        if repeat_image:
+            image_embeddings = image_embeddings.repeat_interleave(B, dim=0)
+            high_res_features = [
+                x.repeat_interleave(B, dim=0) for x in high_res_features
+            ]
+        masks, iou_pred, mask_tokens_out, object_score_logits = self._run(
+            "prompt_mask_decoder",
+            device,
+            image_embeddings=image_embeddings,
+            high_res_feats_0=high_res_features[0],
+            high_res_feats_1=high_res_features[1],
+            point_coords=point_coords,
+            point_labels=point_labels,
+            mask_input=mask_inputs,
+            has_mask_input=has_mask_input,
+        )
+        return masks, iou_pred, mask_tokens_out, object_score_logits
+
+    def memory_attention(
+        self,
+        curr,
+        memory,
+        curr_pos=None,
+        memory_pos=None,
+        num_obj_ptr_tokens=0,
+        memory_mask=None,
+        memory_kv=None,
+    ):
+        """Run the memory attention (see `MemoryAttention.forward`)."""
+        if memory_kv is not None:
+            raise NotImplementedError(
+                "The projected memory cache isn't supported by the exported graphs."
+            )
+        if isinstance(curr, list):
+            curr, curr_pos = curr[0], curr_pos[0]
+        num_spatial = memory.size(0) - num_obj_ptr_tokens
+        if memory_mask is None:
+            memory_mask = torch.ones(
+                memory.size(1), memory.size(0), dtype=torch.bool, device=memory.device
+            )
+        (pix_feat_with_mem,) = self._run(
+            "memory_attention",
+            curr.device,
+            curr=curr,
+            curr_pos=curr_pos,
+            memory=memory[:num_spatial],
+            memory_pos=memory_pos[:num_spatial],
+            obj_ptrs=memory[num_spatial:],
+            obj_ptrs_pos=memory_pos[num_spatial:],
+            memory_mask=memory_mask,
+        )
+        return pix_feat_with_mem
+
+    def memory_encoder(self, pix_feat, masks, skip_mask_sigmoid=False):
+        """Run the memory encoder (see `MemoryEncoder.forward`)."""
+        if not skip_mask_sigmoid:
+            masks = torch.sigmoid(masks)
+        maskmem_features, maskmem_pos_enc = self._run(
+            "memory_encoder", pix_feat.device, pix_feat=pix_feat, masks=masks
+        )
+        return {
+            "vision_features": maskmem_features,
+            "vision_pos_enc": [maskmem_pos_enc],
+        }
+
+
+class OnnxRuntimeBackend(GraphBackend):
+    """
+    An execution backend running the four graphs exported by `export_onnx_models` (in
+    `onnx_dir`) with ONNX Runtime, to set as the `backend` of a SAM 2 model. The inputs
+    are run in float32 on the ONNX Runtime `providers` (CPU by default), and the outputs
+    are returned as float32 tensors on the device of the inputs.
+    """
+
+    def __init__(
+        self,
+        onnx_dir,
+        providers=("CPUExecutionProvider",),
+        intra_op_num_threads=0,
+        inter_op_num_threads=0,
+    ):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            print("Please install onnxruntime")
+            raise e
+
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = (
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        # 0 for ONNX Runtime's default number of threads
+        sess_options.intra_op_num_threads = intra_op_num_threads
+        sess_options.inter_op_num_threads = inter_op_num_threads
+        self.sessions = {
+            name: ort.InferenceSession(
+                os.path.join(onnx_dir, f"{name}.onnx"),
+                sess_options=sess_options,
+                providers=list(providers),
+            )
+            for name in ONNX_MODEL_NAMES
+        }
+
+    def _run(self, name, device, **inputs):
+        inputs = {
+            k: x.detach()
+            .to("cpu", torch.float32 if x.is_floating_point() else x.dtype)
+            .contiguous()
+            .numpy()
+            for k, x in inputs.items()
+        }
+        outputs = self.sessions[name].run(None, inputs)
+        return [torch.from_numpy(np.asarray(x)).to(device) for x in outputs]
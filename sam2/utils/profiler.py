@@ -0,0 +1,174 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+
+class StageProfiler:
+    """
+    Record the wall time of the stages of the video tracking (e.g. the image encoder,
+    the memory attention or the SAM heads) on each frame.
+
+    Stages are recorded with `with profiler.stage(name, **args):` (e.g. through
+    `SAM2Base._profile_stage` once set as the model's `profiler`), where nested stages
+    inherit the `args` (e.g. the frame index) of the stages around them. Recording can
+    be switched on and off at any time with `enabled`, and a disabled (or missing)
+    profiler doesn't record anything.
+
+    With `synchronize=True` (the default), the CUDA device is synchronized around each
+    stage, so that its wall time includes its GPU work (at the cost of removing the
+    overlap between the stages). On CUDA, the number of bytes allocated by each stage is
+    also recorded (from the caching allocator's statistics).
+
+    The recorded stages can be exported as a Chrome trace (see `export_chrome_trace`,
+    which can be opened in chrome://tracing or https://ui.perfetto.dev) or aggregated
+    per stage (see `get_summary` and `get_histograms`).
+    """
+
+    def __init__(self, enabled=True, synchronize=True):
+        self.enabled = enabled
+        self.synchronize = synchronize
+        self.events = []
+        self._local = threading.local()
+        self._start_time = time.perf_counter()
+
+    def reset(self):
+        self.events = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **args):
+        """Record the wall time of the code inside this context as a stage `name`."""
+        if not self.enabled:
+            yield
+            return
+        stack = self._get_stack()
+        if stack:
+            args = {**stack[-1], **args}
+        stack.append(args)
+        cuda = self.synchronize and torch.cuda.is_available()
+        if cuda:
+            torch.cuda.synchronize()
+        alloc_bytes = _get_cuda_allocated_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if cuda:
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            stack.pop()
+            event = {
+                "name": name,
+                "start": start - self._start_time,
+                "duration": end - start,
+                "thread": threading.get_ident(),
+                "args": args,
+            }
+            if alloc_bytes is not None:
+                event["alloc_bytes"] = _get_cuda_allocated_bytes() - alloc_bytes
+            self.events.append(event)
+
+    def _get_stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def export_chrome_trace(self, path):
+        """Save the recorded stages as a Chrome trace JSON file."""
+        trace_events = []
+        for event in self.events:
+            args = dict(event["args"])
+            if "alloc_bytes" in event:
+                args["alloc_bytes"] = event["alloc_bytes"]
+            trace_events.append(
+                {
+                    "name": event["name"],
+                    "ph": "X",  # complete event (with a duration)
+                    "ts": event["start"] * 1e6,
+                    "dur": event["duration"] * 1e6,
+                    "pid": os.getpid(),
+                    "tid": event["thread"],
+                    "args": args,
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+    def get_summary(self):
+        """
+        Aggregate the recorded stages by name, with their count, total, mean, median,
+        90th/99th percentile and max wall time (in ms), and mean allocated bytes.
+        """
+        durations = defaultdict(list)
+        alloc_bytes = defaultdict(list)
+        for event in self.events:
+            durations[event["name"]].append(event["duration"] * 1000)
+            if "alloc_bytes" in event:
+                alloc_bytes[event["name"]].append(event["alloc_bytes"])
+        summary = {}
+        for name, x in durations.items():
+            x = np.array(x)
+            summary[name] = {
+                "count": len(x),
+                "total_ms": float(x.sum()),
+                "mean_ms": float(x.mean()),
+                "p50_ms": float(np.percentile(x, 50)),
+                "p90_ms": float(np.percentile(x, 90)),
+                "p99_ms": float(np.percentile(x, 99)),
+                "max_ms": float(x.max()),
+            }
+            if len(alloc_bytes[name]) > 0:
+                summary[name]["mean_alloc_bytes"] = float(np.mean(alloc_bytes[name]))
+        return summary
+
+    def get_histograms(self, bin_edges_ms=None):
+        """
+        Count the recorded wall times (in ms) of each stage in the bins `bin_edges_ms`
+        (by default, log-spaced bins from 0.01 ms to 10 s). Returns a dict of stage name
+        to `(bin_edges_ms, counts)`.
+        """
+        if bin_edges_ms is None:
+            bin_edges_ms = np.logspace(-2, 4, 25)
+        durations = defaultdict(list)
+        for event in self.events:
+            durations[event["name"]].append(event["duration"] * 1000)
+        histograms = {}
+        for name, x in durations.items():
+            counts, _ = np.histogram(x, bins=bin_edges_ms)
+            histograms[name] = (bin_edges_ms, counts)
+        return histograms
+
+    def format_summary(self):
+        """Format `get_summary` as a table (sorted by total time)."""
+        summary = self.get_summary()
+        lines = [
+            f"{'stage':<28}{'count':>8}{'total ms':>12}{'mean ms':>10}"
+            f"{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'alloc MB':>10}"
+        ]
+        for name, s in sorted(summary.items(), key=lambda x: -x[1]["total_ms"]):
+            alloc_mb = s.get("mean_alloc_bytes", float("nan")) / 1024**2
+            lines.append(
+                f"{name:<28}{s['count']:>8}{s['total_ms']:>12.1f}{s['mean_ms']:>10.2f}"
+                f"{s['p50_ms']:>10.2f}{s['p90_ms']:>10.2f}{s['p99_ms']:>10.2f}"
+                f"{alloc_mb:>10.1f}"
+            )
+        return "\n".join(lines)
+
+
+def _get_cuda_allocated_bytes():
+    """The total number of bytes allocated so far by the CUDA caching allocator."""
+    if not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda.memory_stats().get("allocated_bytes.all.allocated", 0)
@@ -0,0 +1,196 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import contextlib
+
+import torch
+import torch.nn.functional as F
+
+from sam2.utils.amg import mask_to_coco_rle_pytorch
+
+
+class LazyVideoResMasks:
+    """
+    The low-resolution mask scores of the objects on a video frame, which are only
+    upsampled to the video resolution on demand.
+
+    `upsample` gives the same video-resolution mask scores as the default (non-lazy)
+    outputs of `SAM2VideoPredictor`. `to_binary` and `to_rle` only upsample the scores
+    inside the bounding box of each object (the region where the upsampled scores can
+    be above the threshold), so that their cost scales with the object area rather than
+    the frame area (with non-overlapping constraints, the scores of all objects are
+    upsampled in the box of each object to apply them). Their results are the same as
+    thresholding the output of `upsample`, up to the rounding of the scores (which may
+    only matter on the pixels where two objects have the same score).
+
+    `profile_fn` (e.g. `SAM2Base._profile_stage`) optionally gives the context in which
+    the upsampling is recorded as a profiled stage.
+    """
+
+    def __init__(
+        self,
+        low_res_masks,
+        video_height,
+        video_width,
+        non_overlap_fn=None,
+        profile_fn=None,
+    ):
+        # low_res_masks: [num_obj, 1, h, w] mask scores (on the device)
+        self.low_res_masks = low_res_masks
+        self.video_height = video_height
+        self.video_width = video_width
+        self.non_overlap_fn = non_overlap_fn
+        self.profile_fn = profile_fn
+
+    def _profile_stage(self, name):
+        if self.profile_fn is None:
+            return contextlib.nullcontext()
+        return self.profile_fn(name)
+
+    def __len__(self):
+        return self.low_res_masks.size(0)
+
+    @property
+    def shape(self):
+        """The shape of the upsampled mask scores."""
+        return (len(self), 1, self.video_height, self.video_width)
+
+    def upsample(self):
+        """Upsample the mask scores of all objects to the video resolution."""
+        with self._profile_stage("upsample"):
+            return self._upsample()
+
+    def _upsample(self):
+        video_size = (self.video_height, self.video_width)
+        if self.low_res_masks.shape[-2:] == video_size:
+            video_res_masks = self.low_res_masks
+        else:
+            video_res_masks = F.interpolate(
+                self.low_res_masks,
+                size=video_size,
+                mode="bilinear",
+                align_corners=False,
+            )
+        if self.non_overlap_fn is not None:
+            video_res_masks = self.non_overlap_fn(video_res_masks)
+        return video_res_masks
+
+    def to_binary(self, threshold=0.0):
+        """Get the [num_obj, H, W] binary masks at the video resolution."""
+        masks = torch.zeros(
+            len(self),
+            self.video_height,
+            self.video_width,
+            dtype=torch.bool,
+            device=self.low_res_masks.device,
+        )
+        for i, (top, left, roi) in enumerate(self.upsample_rois(threshold)):
+            masks[i, top : top + roi.size(0), left : left + roi.size(1)] = roi
+        return masks
+
+    def to_rle(self, threshold=0.0):
+        """
+        Encode the binary masks at the video resolution in the uncompressed COCO RLE
+        format (as in `sam2.utils.amg.mask_to_rle_pytorch`).
+        """
+        H, W = self.video_height, self.video_width
+        rles = []
+        for top, left, roi in self.upsample_rois(threshold):
+            h, w = roi.shape
+            # the column-major (COCO) indices where a run starts, found column by column
+            # in the box (padded with zeros above and below each column of the box)
+            roi = F.pad(roi.t().to(torch.uint8), (1, 1))
+            col_inds, row_inds = torch.nonzero(roi[:, 1:] != roi[:, :-1], as_tuple=True)
+            starts = (left + col_inds) * H + top + row_inds
+            if top == 0 and h == H:
+                # the box spans whole columns, so the padding at the end of a column and
+                # the padding at the start of the next column are the same pixel, where
+                # two opposite changes cancel out
+                starts, counts = torch.unique(starts, return_counts=True)
+                starts = starts[counts % 2 == 1]
+            # (a change after the last pixel of the frame doesn't start a run)
+            starts = starts[starts < H * W].cpu().tolist()
+            counts = [b - a for a, b in zip([0] + starts, starts + [H * W])]
+            rles.append({"size": [H, W], "counts": counts})
+        return rles
+
+    def to_coco_rle(self, threshold=0.0):
+        """
+        Encode the binary masks at the video resolution in the compressed COCO RLE
+        format (as in `sam2.utils.amg.mask_to_coco_rle_pytorch`), on their device.
+        """
+        return mask_to_coco_rle_pytorch(self.to_binary(threshold))
+
+    def upsample_rois(self, threshold=0.0):
+        """
+        Upsample the mask scores of each object inside its bounding box and threshold
+        them. Returns a list of `(top, left, roi)` with the [h, w] binary masks `roi` in
+        the box of each object (which is empty if the object has no foreground).
+        """
+        with self._profile_stage("upsample"):
+            return self._upsample_rois(threshold)
+
+    def _upsample_rois(self, threshold):
+        low_res_masks = self.low_res_masks.float()[:, 0]
+        h, w = low_res_masks.shape[-2:]
+        H, W = self.video_height, self.video_width
+        device = low_res_masks.device
+        # the source rows and columns of the bilinear interpolation of each pixel
+        y_lo, y_hi, y_weight = _get_bilinear_src_inds(h, H, device)
+        x_lo, x_hi, x_weight = _get_bilinear_src_inds(w, W, device)
+
+        # (the non-overlapping constraints only lower scores, so the bounds still hold)
+        is_fg = low_res_masks > threshold
+        # an upsampled score can only be above the threshold if one of its source
+        # scores is, which bounds the rows and columns of the foreground of each object
+        is_fg_row = is_fg.any(dim=2)
+        is_fg_col = is_fg.any(dim=1)
+        is_fg_row = is_fg_row[:, y_lo] | is_fg_row[:, y_hi]
+        is_fg_col = is_fg_col[:, x_lo] | is_fg_col[:, x_hi]
+        is_fg_row, is_fg_col = is_fg_row.cpu(), is_fg_col.cpu()
+
+        rois = []
+        for i in range(len(self)):
+            rows = torch.nonzero(is_fg_row[i])
+            cols = torch.nonzero(is_fg_col[i])
+            if rows.numel() == 0 or cols.numel() == 0:
+                empty = torch.zeros(0, 0, dtype=torch.bool, device=device)
+                rois.append((0, 0, empty))
+                continue
+            top, bottom = int(rows[0]), int(rows[-1]) + 1
+            left, right = int(cols[0]), int(cols[-1]) + 1
+            # bilinear interpolation in the box (in the same order of operations as
+            # `F.interpolate`, i.e. along the columns and then along the rows)
+            y_slice, x_slice = slice(top, bottom), slice(left, right)
+            if self.non_overlap_fn is None:
+                scores = low_res_masks[i : i + 1]
+            else:
+                scores = low_res_masks
+            wx = x_weight[x_slice]
+            scores = (
+                scores[:, :, x_lo[x_slice]] * (1 - wx)
+                + scores[:, :, x_hi[x_slice]] * wx
+            )
+            wy = y_weight[y_slice, None]
+            scores = scores[:, y_lo[y_slice]] * (1 - wy) + scores[:, y_hi[y_slice]] * wy
+            if self.non_overlap_fn is not None:
+                scores = self.non_overlap_fn(scores[:, None])[i : i + 1, 0]
+            rois.append((top, left, scores[0] > threshold))
+        return rois
+
+
+def _get_bilinear_src_inds(in_size, out_size, device):
+    """
+    The two source indices and the weight of the second one for each output index in
+    a bilinear interpolation with `align_corners=False` (as in `F.interpolate`).
+    """
+    scale = in_size / out_size
+    src = (torch.arange(out_size, device=device, dtype=torch.float32) + 0.5) * scale
+    src = (src - 0.5).clamp(min=0)
+    lo = src.long().clamp(max=in_size - 1)
+    hi = (lo + 1).clamp(max=in_size - 1)
+    weight = src - lo
+    return lo, hi, weight
@@ -52,6 +52,12 @@ parser.add_argument(
     required=True,
     help="Path to a folder containing folders of masks to be evaluated, with exactly the same structure as gt_root",
 )
+parser.add_argument(
+    "--baseline_pred_root",
+    default=None,
+    help="Optional path to the masks of a baseline (e.g. predicted without int8 quantized "
+    "memory features), to report the J&F difference between pred_root and the baseline",
+)
 parser.add_argument(
     "-n", "--num_processes", default=16, type=int, help="Number of concurrent processes"
 )
@@ -79,11 +85,26 @@ parser.add_argument(
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    benchmark(
-        [args.gt_root],
-        [args.pred_root],
+    pred_roots = [args.pred_root]
+    if args.baseline_pred_root is not None:
+        pred_roots.append(args.baseline_pred_root)
+    all_global_jf, all_global_j, all_global_f, _ = benchmark(
+        [args.gt_root] * len(pred_roots),
+        pred_roots,
         args.strict,
         args.num_processes,
         verbose=not args.quiet,
         skip_first_and_last=not args.do_not_skip_first_and_last_frame,
     )
+    if args.baseline_pred_root is not None:
+        print("\nComparison to the baseline:")
+        for name, scores in [
+            ("J&F", all_global_jf),
+            ("J", all_global_j),
+            ("F", all_global_f),
+        ]:
+            pred_score, baseline_score = scores
+            print(
+                f"{name}: {pred_score:.1f} vs. {baseline_score:.1f} "
+                f"(delta: {pred_score - baseline_score:+.1f})"
+            )
@@ -0,0 +1,42 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+
+# the smallest model at a reduced resolution, with random weights, to test on CPU
+TINY_MODEL_CFG = "configs/sam2.1/sam2.1_hiera_t.yaml"
+TINY_MODEL_OVERRIDES = ["++model.image_size=256"]
+
+
+@pytest.fixture(scope="session")
+def tiny_video_predictor():
+    import torch
+    from sam2.build_sam import build_sam2_video_predictor
+
+    torch.manual_seed(0)
+    return build_sam2_video_predictor(
+        TINY_MODEL_CFG,
+        ckpt_path=None,
+        device="cpu",
+        hydra_overrides_extra=TINY_MODEL_OVERRIDES,
+    )
+
+
+@pytest.fixture
+def video_dir(tmp_path):
+    """A directory of 8 small JPEG frames of a square moving on a noisy background."""
+    import numpy as np
+    from PIL import Image
+
+    video_dir = tmp_path / "video"
+    video_dir.mkdir()
+    rng = np.random.RandomState(0)
+    background = rng.randint(0, 64, (96, 128, 3), np.uint8)
+    for t in range(8):
+        frame = background.copy()
+        frame[20:60, 10 + 8 * t : 50 + 8 * t] = (220, 40, 40)
+        Image.fromarray(frame).save(video_dir / f"{t:05d}.jpg")
+    return str(video_dir)
@@ -0,0 +1,52 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("hydra")
+
+from conftest import TINY_MODEL_CFG, TINY_MODEL_OVERRIDES  # noqa: E402
+
+
+def test_build_sam2():
+    from sam2.build_sam import build_sam2
+
+    model = build_sam2(
+        TINY_MODEL_CFG,
+        ckpt_path=None,
+        device="cpu",
+        hydra_overrides_extra=TINY_MODEL_OVERRIDES,
+    )
+    assert model.backend is None
+    assert model.profiler is None
+    assert model.image_size == 256
+    assert model.sam_image_embedding_size == 256 // model.backbone_stride
+    backbone_out = model.forward_image(torch.zeros(1, 3, 256, 256))
+    assert backbone_out["vision_features"].shape[-1] == model.sam_image_embedding_size
+
+
+def test_set_image_size(tiny_video_predictor):
+    model = tiny_video_predictor
+    model.set_image_size(512)
+    try:
+        assert model.image_size == 512
+        assert model.sam_prompt_encoder.mask_input_size == (128, 128)
+        with pytest.raises(ValueError):
+            model.set_image_size(500)
+    finally:
+        model.set_image_size(256)
+
+
+def test_set_image_size_with_backend(tiny_video_predictor):
+    model = tiny_video_predictor
+    model.backend = object()
+    try:
+        with pytest.raises(RuntimeError):
+            model.set_image_size(512)
+    finally:
+        model.backend = None
+    assert model.image_size == 256
@@ -0,0 +1,94 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("hydra")
+
+
+def _square_mask(t):
+    """The mask of the square moving in the frames of the `video_dir` fixture."""
+    mask = torch.zeros(96, 128, dtype=torch.bool)
+    mask[20:60, 10 + 8 * t : 50 + 8 * t] = True
+    return mask
+
+
+def test_keyframe_stride_keeps_prompted_frames(tiny_video_predictor, video_dir):
+    predictor = tiny_video_predictor
+    inference_state = predictor.init_state(video_path=video_dir)
+    predictor.add_new_mask(inference_state, 0, 1, _square_mask(0))
+    # a prompt off the keyframe grid (with a stride of 4)
+    _, _, prompted_masks = predictor.add_new_mask(
+        inference_state, 3, 1, _square_mask(3)
+    )
+
+    outputs = {}
+    for frame_idx, obj_ids, masks in predictor.propagate_in_video(
+        inference_state,
+        keyframe_stride=4,
+        # always interpolate between the keyframes
+        keyframe_fallback_iou_thresh=0.0,
+    ):
+        assert frame_idx not in outputs
+        outputs[frame_idx] = masks
+    assert sorted(outputs) == list(range(8))
+    # the prompted frame keeps its output instead of being interpolated over
+    assert torch.equal(outputs[3] > 0, prompted_masks > 0)
+
+
+def test_bidirectional_forward_matches_forward_pass(tiny_video_predictor, video_dir):
+    predictor = tiny_video_predictor
+    inference_state = predictor.init_state(video_path=video_dir)
+    predictor.add_new_mask(inference_state, 3, 1, _square_mask(3))
+    bidirectional_outputs = {
+        frame_idx: masks
+        for frame_idx, _, masks in predictor.propagate_in_video_bidirectional(
+            inference_state
+        )
+    }
+    assert sorted(bidirectional_outputs) == list(range(8))
+
+    inference_state = predictor.init_state(video_path=video_dir)
+    predictor.add_new_mask(inference_state, 3, 1, _square_mask(3))
+    for frame_idx, _, masks in predictor.propagate_in_video(inference_state):
+        # the forward direction doesn't use the backward outputs as memory
+        torch.testing.assert_close(bidirectional_outputs[frame_idx], masks)
+    assert not inference_state["memory_per_direction"]
+
+
+def test_reset_state_clears_obj_suspension(tiny_video_predictor, video_dir):
+    predictor = tiny_video_predictor
+    inference_state = predictor.init_state(video_path=video_dir)
+    predictor.add_new_mask(inference_state, 0, 1, _square_mask(0))
+    for _ in predictor.propagate_in_video(inference_state, suspend_absent_frames=2):
+        pass
+    assert inference_state["obj_suspension"] is not None
+    predictor.reset_state(inference_state)
+    assert inference_state["obj_suspension"] is None
+
+
+@pytest.mark.parametrize(
+    "setting, value",
+    [("pred_masks_storage", "float16"), ("quantize_maskmem_features", True)],
+)
+def test_load_state_storage_mismatch(
+    tiny_video_predictor, video_dir, tmp_path, setting, value
+):
+    predictor = tiny_video_predictor
+    inference_state = predictor.init_state(video_path=video_dir)
+    predictor.add_new_mask(inference_state, 0, 1, _square_mask(0))
+    path = str(tmp_path / "session.pt")
+    predictor.save_state(inference_state, path)
+
+    default_value = getattr(predictor, setting)
+    setattr(predictor, setting, value)
+    try:
+        with pytest.raises(ValueError, match=setting):
+            predictor.load_state(path)
+    finally:
+        setattr(predictor, setting, default_value)
+    assert predictor.load_state(path)["obj_ids"] == [1]
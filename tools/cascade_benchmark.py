@@ -0,0 +1,283 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Benchmark the cascade of a small and a large SAM 2 model (see
+`sam2.sam2_cascade_video_predictor`) against each model alone on a VOS dataset in the
+DAVIS or SA-V format, and report the FPS of each run, its speed-up over the large model
+and its J&F against the ground truth (or against the outputs of the large model if no
+ground truth is given), along with the share of object-frames the cascade re-ran with
+the large model.
+
+Each video is run as in `tools/vos_inference.py` (under bfloat16 autocast on CUDA),
+with the same options for the input masks. For SA-V (as in its official evaluation),
+use `--base_video_dir sav_val/JPEGImages_24fps --input_mask_dir sav_val/Annotations_6fps
+--gt_root sav_val/Annotations_6fps --per_obj_png_file
+--track_object_appearing_later_in_video`.
+"""
+
+import argparse
+import csv
+import os
+import tempfile
+
+import torch
+from cpu_benchmark import evaluate
+from sam2.build_sam import build_sam2_video_predictor
+from sam2.sam2_cascade_video_predictor import SAM2CascadeVideoPredictor
+from vos_inference import vos_inference, vos_separate_inference_per_object
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--small_cfg",
+        type=str,
+        default="configs/sam2.1/sam2.1_hiera_t.yaml",
+        help="configuration file of the small SAM 2 model",
+    )
+    parser.add_argument(
+        "--small_checkpoint",
+        type=str,
+        default="./checkpoints/sam2.1_hiera_tiny.pt",
+        help="path to the checkpoint of the small SAM 2 model",
+    )
+    parser.add_argument(
+        "--large_cfg",
+        type=str,
+        default="configs/sam2.1/sam2.1_hiera_l.yaml",
+        help="configuration file of the large SAM 2 model",
+    )
+    parser.add_argument(
+        "--large_checkpoint",
+        type=str,
+        default="./checkpoints/sam2.1_hiera_large.pt",
+        help="path to the checkpoint of the large SAM 2 model",
+    )
+    parser.add_argument(
+        "--base_video_dir",
+        type=str,
+        required=True,
+        help="directory containing videos (as JPEG files) to run VOS prediction on",
+    )
+    parser.add_argument(
+        "--input_mask_dir",
+        type=str,
+        required=True,
+        help="directory containing input masks (as PNG files) of each video",
+    )
+    parser.add_argument(
+        "--output_mask_dir",
+        type=str,
+        required=True,
+        help="directory to save the output masks of each run (in a subdirectory per run)",
+    )
+    parser.add_argument(
+        "--gt_root",
+        type=str,
+        default=None,
+        help="directory of the ground-truth masks to compute the J&F against (by default, "
+        "the J&F is computed against the outputs of the large model)",
+    )
+    parser.add_argument(
+        "--video_list_file",
+        type=str,
+        default=None,
+        help="text file containing the list of video names to run VOS prediction on",
+    )
+    parser.add_argument(
+        "--per_obj_png_file",
+        action="store_true",
+        help="whether to use separate per-object PNG files for input and output masks "
+        "(e.g. for SA-V)",
+    )
+    parser.add_argument(
+        "--track_object_appearing_later_in_video",
+        action="store_true",
+        help="whether to track objects that appear later in the video (i.e. not on the "
+        "first frame), as in the SA-V evaluation (see `tools/vos_inference.py`)",
+    )
+    parser.add_argument(
+        "--use_all_masks",
+        action="store_true",
+        help="whether to use all available PNG files in input_mask_dir as inputs (see "
+        "`tools/vos_inference.py`)",
+    )
+    parser.add_argument(
+        "--iou_threshs",
+        type=str,
+        default="0.7,0.8,0.9",
+        help="comma-separated list of the predicted IoU thresholds to run the cascade "
+        "with (the small model's outputs below it are re-run with the large model)",
+    )
+    parser.add_argument(
+        "--object_score_margin",
+        type=float,
+        default=2.0,
+        help="re-run the objects whose object score logit is within this margin of 0 "
+        "with the large model",
+    )
+    parser.add_argument(
+        "--num_backfill_frames",
+        type=int,
+        default=1,
+        help="number of previous frames whose accepted masks are encoded into the memory "
+        "of the large model before it re-runs an object",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="device to run the models on",
+    )
+    parser.add_argument(
+        "--csv_file",
+        type=str,
+        default=None,
+        help="if set, save the FPS, J&F and share of re-run object-frames of each run to "
+        "this CSV file",
+    )
+    parser.add_argument(
+        "--num_warmup_frames",
+        type=int,
+        default=5,
+        help="number of frames to track (on the first video) before timing each run",
+    )
+    parser.add_argument(
+        "--apply_postprocessing",
+        action="store_true",
+        help="whether to apply postprocessing (e.g. hole-filling) to the output masks",
+    )
+    parser.add_argument(
+        "--num_processes",
+        type=int,
+        default=4,
+        help="number of processes to compute the J&F with",
+    )
+    parser.add_argument(
+        "--do_not_skip_first_and_last_frame",
+        action="store_true",
+        help="include the first and the last frames in the J&F (by default, they're "
+        "skipped as in the DAVIS semi-supervised evaluation)",
+    )
+    args = parser.parse_args()
+
+    if args.video_list_file is not None:
+        with open(args.video_list_file, "r") as f:
+            video_names = [v.strip() for v in f.readlines()]
+    else:
+        video_names = [
+            p
+            for p in os.listdir(args.base_video_dir)
+            if os.path.isdir(os.path.join(args.base_video_dir, p))
+        ]
+    iou_threshs = [float(x) for x in args.iou_threshs.split(",")]
+    print(
+        f"running cascade benchmark on {len(video_names)} videos with IoU thresholds "
+        f"{iou_threshs}"
+    )
+
+    # if we use per-object PNG files, they could possibly overlap in inputs and outputs
+    hydra_overrides_extra = [
+        "++model.non_overlap_masks=" + ("false" if args.per_obj_png_file else "true")
+    ]
+    predictors = {
+        name: build_sam2_video_predictor(
+            config_file=cfg,
+            ckpt_path=ckpt,
+            device=args.device,
+            apply_postprocessing=args.apply_postprocessing,
+            hydra_overrides_extra=hydra_overrides_extra,
+        )
+        for name, cfg, ckpt in [
+            ("large", args.large_cfg, args.large_checkpoint),
+            ("small", args.small_cfg, args.small_checkpoint),
+        ]
+    }
+    for iou_thresh in iou_threshs:
+        predictors[f"cascade@{iou_thresh}"] = SAM2CascadeVideoPredictor(
+            predictors["small"],
+            predictors["large"],
+            iou_thresh=iou_thresh,
+            object_score_margin=args.object_score_margin,
+            num_backfill_frames=args.num_backfill_frames,
+        )
+
+    # run each video as in `tools/vos_inference.py`
+    if args.track_object_appearing_later_in_video:
+        run_video = vos_separate_inference_per_object
+    else:
+        run_video = vos_inference
+    video_kwargs = dict(
+        base_video_dir=args.base_video_dir,
+        input_mask_dir=args.input_mask_dir,
+        use_all_masks=args.use_all_masks,
+        per_obj_png_file=args.per_obj_png_file,
+    )
+
+    fps_per_run, verified_ratio_per_run = {}, {}
+    for run, predictor in predictors.items():
+        with tempfile.TemporaryDirectory() as warmup_dir:
+            run_video(
+                predictor,
+                output_mask_dir=warmup_dir,
+                video_name=video_names[0],
+                max_frame_num_to_track=args.num_warmup_frames,
+                **video_kwargs,
+            )
+        total_frames, total_time = 0, 0.0
+        num_obj_frames, num_verified_obj_frames = 0, 0
+        for video_name in video_names:
+            num_frames, elapsed_time, inference_state = run_video(
+                predictor,
+                output_mask_dir=os.path.join(args.output_mask_dir, run),
+                video_name=video_name,
+                **video_kwargs,
+            )
+            total_frames += num_frames
+            total_time += elapsed_time
+            if isinstance(predictor, SAM2CascadeVideoPredictor):
+                stats = predictor.get_cascade_stats(inference_state)
+                num_obj_frames += stats["num_obj_frames"]
+                num_verified_obj_frames += stats["num_verified_obj_frames"]
+        fps_per_run[run] = total_frames / total_time
+        verified_ratio_per_run[run] = (
+            num_verified_obj_frames / max(num_obj_frames, 1)
+            if isinstance(predictor, SAM2CascadeVideoPredictor)
+            else None
+        )
+        print(f"{run}: {fps_per_run[run]:.2f} FPS on {total_frames} frames")
+
+    gt_root = args.gt_root or os.path.join(args.output_mask_dir, "large")
+    scores = evaluate(
+        gt_root,
+        [os.path.join(args.output_mask_dir, run) for run in predictors],
+        num_processes=args.num_processes,
+        skip_first_and_last=not args.do_not_skip_first_and_last_frame,
+    )
+    print(f"\nJ&F against {'the ground truth' if args.gt_root else 'the large model'}:")
+    print(
+        f"{'run':<20}{'FPS':>8}{'speedup':>10}{'J&F':>8}{'J':>8}{'F':>8}{'re-run':>9}"
+    )
+    rows = []
+    for run, (jf, j, f) in zip(predictors, scores):
+        speedup = fps_per_run[run] / fps_per_run["large"]
+        verified_ratio = verified_ratio_per_run[run]
+        rerun = f"{verified_ratio:.1%}" if verified_ratio is not None else ""
+        print(
+            f"{run:<20}{fps_per_run[run]:>8.2f}{speedup:>9.2f}x"
+            f"{jf:>8.1f}{j:>8.1f}{f:>8.1f}{rerun:>9}"
+        )
+        rows.append([run, fps_per_run[run], speedup, jf, j, f, verified_ratio])
+    if args.csv_file is not None:
+        with open(args.csv_file, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["run", "fps", "speedup", "J&F", "J", "F", "rerun_ratio"])
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compile the components of a SAM 2 model ahead of time with AOTInductor into a cache
+directory (see `sam2.utils.aot_compile`), e.g. when building a deployment image, so that
+`build_sam2_video_predictor(..., vos_optimized=True, aot_cache_dir=...)` only loads them.
+Reports the compile time and the time to build the predictor from the cache.
+"""
+
+import argparse
+import time
+
+import torch
+from sam2.build_sam import build_sam2_video_predictor
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sam2_cfg",
+        type=str,
+        default="configs/sam2.1/sam2.1_hiera_b+.yaml",
+        help="SAM 2 model configuration file",
+    )
+    parser.add_argument(
+        "--sam2_checkpoint",
+        type=str,
+        default="./checkpoints/sam2.1_hiera_base_plus.pt",
+        help="path to the SAM 2 model checkpoint",
+    )
+    parser.add_argument(
+        "--aot_cache_dir",
+        type=str,
+        required=True,
+        help="directory to save the compiled modules to",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="device to compile the modules for (they only run on this device type)",
+    )
+    parser.add_argument(
+        "--image_size",
+        type=int,
+        default=None,
+        help="input resolution to compile the modules for (default: the one in the config)",
+    )
+    parser.add_argument(
+        "--autocast_dtype",
+        type=str,
+        choices=["float32", "bfloat16", "float16"],
+        default=None,
+        help="autocast dtype the predictor will run with, to compile the modules for "
+        "(default: bfloat16 on CUDA as in `tools/vos_inference.py`, float32 otherwise)",
+    )
+    args = parser.parse_args()
+
+    autocast_dtype = args.autocast_dtype
+    if autocast_dtype is None:
+        autocast_dtype = "bfloat16" if args.device.startswith("cuda") else "float32"
+    # (float32 means no autocast)
+    autocast_dtype = (
+        None if autocast_dtype == "float32" else getattr(torch, autocast_dtype)
+    )
+    hydra_overrides_extra = []
+    if args.image_size is not None:
+        hydra_overrides_extra.append(f"++model.image_size={args.image_size}")
+    timings = {}
+    for name in ["compile", "load"]:
+        start_time = time.perf_counter()
+        predictor = build_sam2_video_predictor(
+            config_file=args.sam2_cfg,
+            ckpt_path=args.sam2_checkpoint,
+            device=args.device,
+            hydra_overrides_extra=hydra_overrides_extra,
+            vos_optimized=True,
+            aot_cache_dir=args.aot_cache_dir,
+            aot_autocast_dtype=autocast_dtype,
+        )
+        timings[name] = time.perf_counter() - start_time
+        del predictor
+    # (the first build only loads the modules if they were already in the cache)
+    print(f"built the predictor and compiled its modules in {timings['compile']:.1f}s")
+    print(f"built the predictor from the cache in {timings['load']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
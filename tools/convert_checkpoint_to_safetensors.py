@@ -0,0 +1,56 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Convert a SAM 2 checkpoint (a PyTorch checkpoint with the model weights under "model")
+to the safetensors format, which `build_sam2` and `build_sam2_video_predictor` load
+directly on the target device (when the checkpoint path ends with ".safetensors").
+"""
+
+import argparse
+import os
+
+import torch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sam2_checkpoint",
+        type=str,
+        required=True,
+        help="path to the SAM 2 model checkpoint to convert",
+    )
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        default=None,
+        help="path to save the safetensors file to (default: the checkpoint path with "
+        "a .safetensors extension)",
+    )
+    args = parser.parse_args()
+
+    try:
+        from safetensors.torch import save_file
+    except ImportError as e:
+        print("Please install safetensors")
+        raise e
+
+    output_path = args.output_path
+    if output_path is None:
+        output_path = os.path.splitext(args.sam2_checkpoint)[0] + ".safetensors"
+    sd = torch.load(
+        args.sam2_checkpoint, map_location="cpu", mmap=True, weights_only=True
+    )["model"]
+    save_file({k: v.contiguous() for k, v in sd.items()}, output_path)
+    print(
+        f"converted {len(sd)} tensors from {args.sam2_checkpoint} to {output_path} "
+        f"({os.path.getsize(output_path) / 2**20:.1f} MiB)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Benchmark the CPU inference modes of SAM 2 (see `sam2.utils.cpu_inference`) on a VOS
+dataset in the DAVIS format (tracking the objects in the masks of the first frame),
+and report the FPS of each mode and its J&F against the ground truth (or against the
+float32 outputs if no ground truth is given). Each mode can also be run at several
+input resolutions (see `SAM2Base.set_image_size`) to get an FPS-versus-J&F curve.
+"""
+
+import argparse
+import csv
+import os
+import sys
+import time
+
+import torch
+from sam2.build_sam import build_sam2_video_predictor
+from sam2.utils.cpu_inference import (
+    cpu_autocast_context,
+    is_cpu_bf16_supported,
+    optimize_model_for_cpu,
+    set_cpu_num_threads,
+)
+from vos_inference import DAVIS_PALETTE, load_masks_from_dir, save_masks_to_dir
+
+
+# the CPU inference modes to compare (the float32 one is the plain eager PyTorch model)
+CPU_MODES = {
+    "fp32": dict(channels_last=False, bf16=False, quantize_int8=False),
+    "channels_last": dict(channels_last=True, bf16=False, quantize_int8=False),
+    "bf16": dict(channels_last=True, bf16=True, quantize_int8=False),
+    "int8": dict(channels_last=True, bf16=False, quantize_int8=True),
+}
+
+
+@torch.inference_mode()
+def run_video(
+    predictor,
+    base_video_dir,
+    input_mask_dir,
+    video_name,
+    output_mask_dir=None,
+    score_thresh=0.0,
+    max_frame_num_to_track=None,
+    per_obj_png_file=False,
+):
+    """
+    Track the objects in the first frame's masks of a video, and optionally save the
+    output masks to `output_mask_dir`. Returns the number of tracked frames, the time
+    spent tracking them (without loading the video frames) and the inference state.
+    """
+    video_dir = os.path.join(base_video_dir, video_name)
+    frame_names = [
+        os.path.splitext(p)[0]
+        for p in os.listdir(video_dir)
+        if os.path.splitext(p)[-1] in [".jpg", ".jpeg", ".JPG", ".JPEG"]
+    ]
+    frame_names.sort(key=lambda p: int(os.path.splitext(p)[0]))
+    inference_state = predictor.init_state(
+        video_path=video_dir, async_loading_frames=False
+    )
+    height = inference_state["video_height"]
+    width = inference_state["video_width"]
+
+    start_time = time.perf_counter()
+    per_obj_input_mask, input_palette = load_masks_from_dir(
+        input_mask_dir=input_mask_dir,
+        video_name=video_name,
+        frame_name=frame_names[0],
+        per_obj_png_file=per_obj_png_file,
+    )
+    for object_id, object_mask in per_obj_input_mask.items():
+        predictor.add_new_mask(
+            inference_state=inference_state,
+            frame_idx=0,
+            obj_id=object_id,
+            mask=object_mask,
+        )
+    video_segments = {}
+    for out_frame_idx, out_obj_ids, out_mask_logits in predictor.propagate_in_video(
+        inference_state, max_frame_num_to_track=max_frame_num_to_track
+    ):
+        video_segments[out_frame_idx] = {
+            out_obj_id: (out_mask_logits[i] > score_thresh).cpu().numpy()
+            for i, out_obj_id in enumerate(out_obj_ids)
+        }
+    elapsed_time = time.perf_counter() - start_time
+
+    if output_mask_dir is not None:
+        for out_frame_idx, per_obj_output_mask in video_segments.items():
+            save_masks_to_dir(
+                output_mask_dir=output_mask_dir,
+                video_name=video_name,
+                frame_name=frame_names[out_frame_idx],
+                per_obj_output_mask=per_obj_output_mask,
+                height=height,
+                width=width,
+                per_obj_png_file=per_obj_png_file,
+                output_palette=input_palette or DAVIS_PALETTE,
+            )
+    return len(video_segments), elapsed_time, inference_state
+
+
+def evaluate(gt_root, pred_roots, num_processes, skip_first_and_last):
+    """Compute the global J&F, J and F of each of `pred_roots` against `gt_root`."""
+    # use the J&F evaluation of the SA-V dataset tools
+    sys.path.append(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sav_dataset")
+    )
+    from utils.sav_benchmark import benchmark
+
+    all_global_jf, all_global_j, all_global_f, _ = benchmark(
+        [gt_root] * len(pred_roots),
+        pred_roots,
+        strict=False,
+        num_processes=num_processes,
+        verbose=False,
+        skip_first_and_last=skip_first_and_last,
+    )
+    return list(zip(all_global_jf, all_global_j, all_global_f))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sam2_cfg",
+        type=str,
+        default="configs/sam2.1/sam2.1_hiera_t.yaml",
+        help="SAM 2 model configuration file",
+    )
+    parser.add_argument(
+        "--sam2_checkpoint",
+        type=str,
+        default="./checkpoints/sam2.1_hiera_tiny.pt",
+        help="path to the SAM 2 model checkpoint",
+    )
+    parser.add_argument(
+        "--base_video_dir",
+        type=str,
+        required=True,
+        help="directory containing videos (as JPEG files) to run VOS prediction on",
+    )
+    parser.add_argument(
+        "--input_mask_dir",
+        type=str,
+        required=True,
+        help="directory containing input masks (as PNG files) of each video",
+    )
+    parser.add_argument(
+        "--output_mask_dir",
+        type=str,
+        required=True,
+        help="directory to save the output masks of each mode (in a subdirectory per mode)",
+    )
+    parser.add_argument(
+        "--gt_root",
+        type=str,
+        default=None,
+        help="directory of the ground-truth masks to compute the J&F against (by default, "
+        "the J&F is computed against the outputs of the fp32 mode)",
+    )
+    parser.add_argument(
+        "--video_list_file",
+        type=str,
+        default=None,
+        help="text file containing the list of video names to run VOS prediction on",
+    )
+    parser.add_argument(
+        "--modes",
+        type=str,
+        default="fp32,channels_last,bf16,int8",
+        help=f"comma-separated list of the CPU inference modes to run (among "
+        f"{', '.join(CPU_MODES)})",
+    )
+    parser.add_argument(
+        "--image_sizes",
+        type=str,
+        default=None,
+        help="comma-separated list of the input resolutions to run each mode at (e.g. "
+        "1024,768,512; by default, only the one in the config)",
+    )
+    parser.add_argument(
+        "--csv_file",
+        type=str,
+        default=None,
+        help="if set, save the image size, FPS and J&F of each run to this CSV file",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=0,
+        help="number of intra-op CPU threads (default: 0, i.e. PyTorch's default)",
+    )
+    parser.add_argument(
+        "--num_interop_threads",
+        type=int,
+        default=1,
+        help="number of inter-op CPU threads",
+    )
+    parser.add_argument(
+        "--num_warmup_frames",
+        type=int,
+        default=5,
+        help="number of frames to track (on the first video) before timing each mode",
+    )
+    parser.add_argument(
+        "--apply_postprocessing",
+        action="store_true",
+        help="whether to apply postprocessing (e.g. hole-filling) to the output masks",
+    )
+    parser.add_argument(
+        "--num_processes",
+        type=int,
+        default=4,
+        help="number of processes to compute the J&F with",
+    )
+    parser.add_argument(
+        "--do_not_skip_first_and_last_frame",
+        action="store_true",
+        help="include the first and the last frames in the J&F (by default, they're "
+        "skipped as in the DAVIS semi-supervised evaluation)",
+    )
+    args = parser.parse_args()
+
+    modes = args.modes.split(",")
+    for mode in modes:
+        if mode not in CPU_MODES:
+            raise ValueError(f"unknown mode {mode}, expected one of {list(CPU_MODES)}")
+    if args.gt_root is None and "fp32" not in modes:
+        raise ValueError("the fp32 mode is needed to compute the J&F without --gt_root")
+    image_sizes = [None]
+    if args.image_sizes is not None:
+        # the largest size first, so that the reference run (fp32 at the largest size) is
+        # the first fp32 run
+        image_sizes = sorted(map(int, args.image_sizes.split(",")), reverse=True)
+    # the runs of each mode at each image size (named by mode if there's a single size)
+    runs = [
+        (mode if image_size is None else f"{mode}@{image_size}", mode, image_size)
+        for image_size in image_sizes
+        for mode in modes
+    ]
+    ref_run = (
+        next(name for name, mode, _ in runs if mode == "fp32")
+        if "fp32" in modes
+        else None
+    )
+    if "bf16" in modes and not is_cpu_bf16_supported():
+        print("WARNING: this CPU doesn't natively support bfloat16 (it's emulated)")
+    set_cpu_num_threads(args.num_threads, args.num_interop_threads)
+
+    if args.video_list_file is not None:
+        with open(args.video_list_file, "r") as f:
+            video_names = [v.strip() for v in f.readlines()]
+    else:
+        video_names = [
+            p
+            for p in os.listdir(args.base_video_dir)
+            if os.path.isdir(os.path.join(args.base_video_dir, p))
+        ]
+    print(
+        f"running CPU benchmark on {len(video_names)} videos in modes {modes} "
+        f"at image sizes {image_sizes}"
+    )
+
+    fps_per_run, image_size_per_run = {}, {}
+    for run, mode, image_size in runs:
+        options = CPU_MODES[mode]
+        predictor = build_sam2_video_predictor(
+            config_file=args.sam2_cfg,
+            ckpt_path=args.sam2_checkpoint,
+            device="cpu",
+            apply_postprocessing=args.apply_postprocessing,
+            hydra_overrides_extra=["++model.non_overlap_masks=true"],
+        )
+        if image_size is not None:
+            predictor.set_image_size(image_size)
+        image_size_per_run[run] = predictor.image_size
+        optimize_model_for_cpu(
+            predictor,
+            channels_last=options["channels_last"],
+            quantize_int8=options["quantize_int8"],
+        )
+        total_frames, total_time = 0, 0.0
+        with cpu_autocast_context(options["bf16"]):
+            run_video(
+                predictor,
+                args.base_video_dir,
+                args.input_mask_dir,
+                video_names[0],
+                max_frame_num_to_track=args.num_warmup_frames,
+            )
+            for video_name in video_names:
+                num_frames, elapsed_time, _ = run_video(
+                    predictor,
+                    args.base_video_dir,
+                    args.input_mask_dir,
+                    video_name,
+                    output_mask_dir=os.path.join(args.output_mask_dir, run),
+                )
+                total_frames += num_frames
+                total_time += elapsed_time
+        fps_per_run[run] = total_frames / total_time
+        print(f"{run}: {fps_per_run[run]:.2f} FPS on {total_frames} frames")
+
+    gt_root = args.gt_root or os.path.join(args.output_mask_dir, ref_run)
+    scores = evaluate(
+        gt_root,
+        [os.path.join(args.output_mask_dir, run) for run, _, _ in runs],
+        num_processes=args.num_processes,
+        skip_first_and_last=not args.do_not_skip_first_and_last_frame,
+    )
+    print(f"\nJ&F against {'the ground truth' if args.gt_root else ref_run}:")
+    print(f"{'mode':<20}{'size':>6}{'FPS':>8}{'speedup':>10}{'J&F':>8}{'J':>8}{'F':>8}")
+    rows = []
+    for (run, mode, _), (jf, j, f) in zip(runs, scores):
+        speedup = ""
+        if ref_run is not None:
+            speedup = f"{fps_per_run[run] / fps_per_run[ref_run]:.2f}x"
+        print(
+            f"{run:<20}{image_size_per_run[run]:>6}{fps_per_run[run]:>8.2f}"
+            f"{speedup:>10}{jf:>8.1f}{j:>8.1f}{f:>8.1f}"
+        )
+        rows.append([mode, image_size_per_run[run], fps_per_run[run], jf, j, f])
+    if args.csv_file is not None:
+        with open(args.csv_file, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["mode", "image_size", "fps", "J&F", "J", "F"])
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
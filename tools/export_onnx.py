@@ -0,0 +1,333 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Export a SAM 2 model to ONNX (see `sam2.utils.onnx_backend`), and check the parity of
+the exported graphs run with ONNX Runtime against the PyTorch model from `build_sam2`:
+each graph on the same inputs as its PyTorch modules, and the image and video predictors
+end to end (the video predictor on a small generated clip, or on a video in the DAVIS
+format).
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+from PIL import Image
+from sam2.build_sam import build_sam2, build_sam2_video_predictor
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+from sam2.utils.onnx_backend import export_onnx_models, OnnxRuntimeBackend
+
+
+def _max_abs_diff(x, y):
+    return (x.float() - y.float()).abs().max().item()
+
+
+def _mask_iou(x, y):
+    x, y = x > 0, y > 0
+    union = (x | y).sum().item()
+    return (x & y).sum().item() / union if union > 0 else 1.0
+
+
+@torch.inference_mode()
+def check_components(model, backend, seed=0):
+    """
+    Compare each graph run in ONNX Runtime against the PyTorch modules on the same
+    inputs, and return the max absolute difference of each output.
+    """
+    torch.manual_seed(seed)
+    B, C, mem_dim = 2, model.hidden_dim, model.mem_dim
+    H = W = model.sam_image_embedding_size
+    image_size = model.image_size
+    diffs = {}
+
+    image = torch.randn(B, 3, image_size, image_size)
+    expected = model.forward_image(image)
+    actual = backend.forward_image(image)
+    for key in ["backbone_fpn", "vision_pos_enc"]:
+        for i, (x, y) in enumerate(zip(expected[key], actual[key])):
+            diffs[f"image_encoder/{key}_{i}"] = _max_abs_diff(x, y)
+
+    image_embeddings = expected["backbone_fpn"][-1]
+    high_res_features = expected["backbone_fpn"][:2]
+    point_coords = torch.rand(B, 3, 2) * image_size
+    point_labels = torch.tensor([[1, 0, 1], [2, 3, 1]], dtype=torch.int32)
+    mask_inputs = torch.randn(B, 1, H * 4, W * 4)
+    prompts = {
+        "": (point_coords, point_labels, None),
+        "/mask": (point_coords, point_labels, mask_inputs),
+        "/mask_only": (None, None, mask_inputs),
+    }
+    for suffix, (point_coords, point_labels, mask_inputs) in prompts.items():
+        sparse_embeddings, dense_embeddings = model.sam_prompt_encoder(
+            points=None if point_coords is None else (point_coords, point_labels),
+            boxes=None,
+            masks=mask_inputs,
+        )
+        expected = model.sam_mask_decoder.predict_masks(
+            image_embeddings=image_embeddings,
+            image_pe=model.sam_prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            repeat_image=False,
+            high_res_features=high_res_features,
+        )
+        actual = backend.predict_masks(
+            image_embeddings=image_embeddings,
+            high_res_features=high_res_features,
+            point_coords=point_coords,
+            point_labels=point_labels,
+            mask_inputs=mask_inputs,
+            repeat_image=False,
+        )
+        names = ["masks", "iou_pred", "mask_tokens_out", "object_score_logits"]
+        for name, x, y in zip(names, expected, actual):
+            diffs[f"prompt_mask_decoder{suffix}/{name}"] = _max_abs_diff(x, y)
+
+    num_spatial, num_ptrs = 3 * H * W, 8
+    curr = torch.randn(H * W, B, C)
+    curr_pos = torch.randn(H * W, B, C)
+    memory = torch.randn(num_spatial + num_ptrs, B, mem_dim)
+    memory_pos = torch.randn(num_spatial + num_ptrs, B, mem_dim)
+    memory_mask = torch.ones(B, num_spatial + num_ptrs, dtype=torch.bool)
+    memory_mask[1, num_spatial - H * W : num_spatial] = False  # a padded frame
+    for mask in [None, memory_mask]:
+        kwargs = dict(
+            curr=curr,
+            curr_pos=curr_pos,
+            memory=memory,
+            memory_pos=memory_pos,
+            num_obj_ptr_tokens=num_ptrs,
+            memory_mask=mask,
+        )
+        prefix = "memory_attention" + ("/mask" if mask is not None else "")
+        diffs[prefix] = _max_abs_diff(
+            model.memory_attention(**kwargs), backend.memory_attention(**kwargs)
+        )
+
+    pix_feat = torch.randn(B, C, H, W)
+    masks = torch.randn(B, 1, image_size, image_size)
+    expected = model.memory_encoder(pix_feat, masks)
+    actual = backend.memory_encoder(pix_feat, masks)
+    diffs["memory_encoder/maskmem_features"] = _max_abs_diff(
+        expected["vision_features"], actual["vision_features"]
+    )
+    diffs["memory_encoder/maskmem_pos_enc"] = _max_abs_diff(
+        expected["vision_pos_enc"][-1], actual["vision_pos_enc"][-1]
+    )
+    return diffs
+
+
+@torch.inference_mode()
+def check_image_predictor(model, backend, image):
+    """
+    Compare the masks of the image predictor with and without the ONNX Runtime backend
+    on a point prompt, on box prompts and on a mask prompt (the low-resolution logits of
+    the point prompt), and return their IoU.
+    """
+    h, w = image.shape[:2]
+    prompts = {
+        "point": dict(point_coords=np.array([[w // 2, h // 2]]), point_labels=[1]),
+        "boxes": dict(
+            box=np.array([[0, 0, w // 2, h // 2], [w // 4, h // 4, w, h]]),
+            multimask_output=False,
+        ),
+    }
+    outputs = {}
+    for backend_or_none in [None, backend]:
+        model.backend = backend_or_none
+        predictor = SAM2ImagePredictor(model)
+        predictor.set_image(image)
+        for name, kwargs in prompts.items():
+            masks, _, _ = predictor.predict(return_logits=True, **kwargs)
+            outputs.setdefault(name, []).append(torch.as_tensor(masks))
+        if backend_or_none is None:
+            # (the same mask prompt for both runs)
+            _, _, low_res_masks = predictor.predict(
+                **prompts["point"], multimask_output=False, return_logits=True
+            )
+        masks, _, _ = predictor.predict(
+            mask_input=low_res_masks, multimask_output=False, return_logits=True
+        )
+        outputs.setdefault("mask", []).append(torch.as_tensor(masks))
+    model.backend = None
+    return {
+        f"image_predictor/{name}": _mask_iou(*masks) for name, masks in outputs.items()
+    }
+
+
+def make_video(video_dir, num_frames=8, height=240, width=320, seed=0):
+    """
+    Write a small clip of JPEG frames to `video_dir`, with two rectangles moving on a
+    noisy background, and return their DAVIS-format mask on the first frame.
+    """
+    rng = np.random.RandomState(seed)
+    background = rng.randint(0, 256, (height, width, 3), np.uint8) // 4
+    for t in range(num_frames):
+        frame = background.copy()
+        input_mask = np.zeros((height, width), np.uint8)
+        for obj_id, (color, y, x) in enumerate(
+            [((220, 40, 40), 40, 30 + 8 * t), ((40, 200, 60), 140, 200 - 6 * t)],
+            start=1,
+        ):
+            frame[y : y + 60, x : x + 80] = color
+            input_mask[y : y + 60, x : x + 80] = obj_id
+        Image.fromarray(frame).save(os.path.join(video_dir, f"{t:05d}.jpg"))
+        if t == 0:
+            first_input_mask = input_mask
+    return first_input_mask
+
+
+@torch.inference_mode()
+def check_video_predictor(predictor, backend, video_dir, input_mask):
+    """
+    Compare the masks of the video predictor with and without the ONNX Runtime backend
+    tracking the objects in a DAVIS-format mask on the first frame, and return their
+    lowest IoU over the frames.
+    """
+    outputs = []
+    for backend_or_none in [None, backend]:
+        predictor.backend = backend_or_none
+        inference_state = predictor.init_state(video_path=video_dir)
+        for object_id in np.unique(input_mask[input_mask > 0]):
+            predictor.add_new_mask(
+                inference_state,
+                frame_idx=0,
+                obj_id=int(object_id),
+                mask=input_mask == object_id,
+            )
+        outputs.append(
+            {
+                frame_idx: masks.clone()
+                for frame_idx, _, masks in predictor.propagate_in_video(inference_state)
+            }
+        )
+    predictor.backend = None
+    return {
+        "video_predictor": min(
+            _mask_iou(outputs[0][t], outputs[1][t]) for t in outputs[0]
+        )
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sam2_cfg",
+        type=str,
+        default="configs/sam2.1/sam2.1_hiera_t.yaml",
+        help="SAM 2 model configuration file",
+    )
+    parser.add_argument(
+        "--sam2_checkpoint",
+        type=str,
+        default="./checkpoints/sam2.1_hiera_tiny.pt",
+        help="path to the SAM 2 model checkpoint",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="directory to save the ONNX files to (or to load them from with --skip_export)",
+    )
+    parser.add_argument(
+        "--opset_version", type=int, default=17, help="ONNX opset version"
+    )
+    parser.add_argument(
+        "--skip_export",
+        action="store_true",
+        help="only check the parity of the ONNX files already in --output_dir",
+    )
+    parser.add_argument(
+        "--skip_parity_check",
+        action="store_true",
+        help="only export the ONNX files",
+    )
+    parser.add_argument(
+        "--image",
+        type=str,
+        default=None,
+        help="image to check the parity of the image predictor on (default: a random image)",
+    )
+    parser.add_argument(
+        "--video_dir",
+        type=str,
+        default=None,
+        help="directory of JPEG frames to check the parity of the video predictor on "
+        "(default: a small generated clip)",
+    )
+    parser.add_argument(
+        "--input_mask",
+        type=str,
+        default=None,
+        help="DAVIS-format PNG mask of the objects to track on the first frame of "
+        "--video_dir",
+    )
+    parser.add_argument(
+        "--atol",
+        type=float,
+        default=1e-3,
+        help="max absolute difference of the graph outputs to pass the parity check",
+    )
+    parser.add_argument(
+        "--min_iou",
+        type=float,
+        default=0.99,
+        help="min IoU of the predictor masks to pass the parity check",
+    )
+    args = parser.parse_args()
+
+    # the parity is checked against the float32 eager model, as exported
+    model = build_sam2(args.sam2_cfg, args.sam2_checkpoint, device="cpu")
+    if not args.skip_export:
+        paths = export_onnx_models(
+            model, args.output_dir, opset_version=args.opset_version
+        )
+        for path in paths.values():
+            print(f"exported {path} ({os.path.getsize(path) / 2**20:.1f} MiB)")
+    if args.skip_parity_check:
+        return
+
+    backend = OnnxRuntimeBackend(args.output_dir)
+    failed = False
+    diffs = check_components(model, backend)
+    if args.image is not None:
+        image = np.array(Image.open(args.image).convert("RGB"))
+    else:
+        image = np.random.RandomState(0).randint(0, 256, (480, 640, 3), np.uint8)
+    ious = check_image_predictor(model, backend, image)
+    predictor = build_sam2_video_predictor(
+        args.sam2_cfg, args.sam2_checkpoint, device="cpu"
+    )
+    if args.video_dir is not None:
+        assert args.input_mask is not None, "--video_dir requires --input_mask"
+        input_mask = np.array(Image.open(args.input_mask))
+        ious.update(
+            check_video_predictor(predictor, backend, args.video_dir, input_mask)
+        )
+    else:
+        with tempfile.TemporaryDirectory() as video_dir:
+            input_mask = make_video(video_dir)
+            ious.update(
+                check_video_predictor(predictor, backend, video_dir, input_mask)
+            )
+    for name, diff in diffs.items():
+        ok = diff <= args.atol
+        failed |= not ok
+        print(f"{name:<48} max abs diff {diff:.2e} {'OK' if ok else 'FAILED'}")
+    for name, iou in ious.items():
+        ok = iou >= args.min_iou
+        failed |= not ok
+        print(f"{name:<48} mask IoU {iou:.4f} {'OK' if ok else 'FAILED'}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
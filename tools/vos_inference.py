@@ -6,12 +6,15 @@
 
 import argparse
 import os
+import time
 from collections import defaultdict
 
 import numpy as np
 import torch
 from PIL import Image
+from pycocotools.mask import decode as decode_masks
 from sam2.build_sam import build_sam2_video_predictor
+from sam2.utils.profiler import StageProfiler
 
 
 # the PNG palette for DAVIS 2017 dataset
@@ -124,8 +127,15 @@ def vos_inference(
     score_thresh=0.0,
     use_all_masks=False,
     per_obj_png_file=False,
+    suspend_absent_frames=0,
+    suspended_check_interval=5,
+    max_frame_num_to_track=None,
 ):
-    """Run VOS inference on a single video with the given predictor."""
+    """
+    Run VOS inference on a single video with the given predictor. Returns the number of
+    tracked frames, the time spent adding the inputs and tracking (without loading the
+    video frames or saving the output masks) and the inference state.
+    """
     # load the video frames and initialize the inference state on this video
     video_dir = os.path.join(base_video_dir, video_name)
     frame_names = [
@@ -140,6 +150,7 @@ def vos_inference(
     height = inference_state["video_height"]
     width = inference_state["video_width"]
     input_palette = None
+    start_time = time.perf_counter()
 
     # fetch mask inputs from input_mask_dir (either only mask for the first frame, or all available masks)
     if not use_all_masks:
@@ -221,17 +232,27 @@ def vos_inference(
     os.makedirs(os.path.join(output_mask_dir, video_name), exist_ok=True)
     output_palette = input_palette or DAVIS_PALETTE
     video_segments = {}  # video_segments contains the per-frame segmentation results
-    for out_frame_idx, out_obj_ids, out_mask_logits in predictor.propagate_in_video(
-        inference_state
+    for out_frame_idx, out_obj_ids, out_masks in predictor.propagate_in_video(
+        inference_state,
+        max_frame_num_to_track=max_frame_num_to_track,
+        suspend_absent_frames=suspend_absent_frames,
+        suspended_check_interval=suspended_check_interval,
+        lazy_output=True,
     ):
-        per_obj_output_mask = {
-            out_obj_id: (out_mask_logits[i] > score_thresh).cpu().numpy()
-            for i, out_obj_id in enumerate(out_obj_ids)
-        }
-        video_segments[out_frame_idx] = per_obj_output_mask
+        # only upsample the mask scores around each object to the video resolution,
+        # and keep the compressed RLE of the masks (encoded on the device) until saving
+        out_rles = out_masks.to_coco_rle(score_thresh)
+        video_segments[out_frame_idx] = dict(zip(out_obj_ids, out_rles))
+    elapsed_time = time.perf_counter() - start_time
+    memory_bank_mb = predictor.get_memory_bank_nbytes(inference_state) / 1024**2
+    print(f"memory bank size of {video_name}: {memory_bank_mb:.1f} MB")
 
     # write the output masks as palette PNG files to output_mask_dir
-    for out_frame_idx, per_obj_output_mask in video_segments.items():
+    for out_frame_idx, per_obj_output_rle in video_segments.items():
+        per_obj_output_mask = {
+            out_obj_id: decode_masks(rle)[None].astype(bool)
+            for out_obj_id, rle in per_obj_output_rle.items()
+        }
         save_masks_to_dir(
             output_mask_dir=output_mask_dir,
             video_name=video_name,
@@ -242,6 +263,7 @@ def vos_inference(
             per_obj_png_file=per_obj_png_file,
             output_palette=output_palette,
         )
+    return len(video_segments), elapsed_time, inference_state
 
 
 @torch.inference_mode()
@@ -255,6 +277,9 @@ def vos_separate_inference_per_object(
     score_thresh=0.0,
     use_all_masks=False,
     per_obj_png_file=False,
+    suspend_absent_frames=0,
+    suspended_check_interval=5,
+    max_frame_num_to_track=None,
 ):
     """
     Run VOS inference on a single video with the given predictor.
@@ -263,6 +288,10 @@ def vos_separate_inference_per_object(
     in a video, which could be applied to datasets like LVOS or YouTube-VOS that
     don't have all objects to track appearing in the first frame (i.e. some objects
     might appear only later in the video).
+
+    Returns the number of frames, the time spent adding the inputs and tracking the
+    objects (without loading the video frames and the input masks or saving the output
+    masks) and the inference state, as in `vos_inference`.
     """
     # load the video frames and initialize the inference state on this video
     video_dir = os.path.join(base_video_dir, video_name)
@@ -305,6 +334,7 @@ def vos_separate_inference_per_object(
     # run inference separately for each object in the video
     object_ids = sorted(inputs_per_object)
     output_scores_per_object = defaultdict(dict)
+    start_time = time.perf_counter()
     for object_id in object_ids:
         # add those input masks to SAM 2 inference state before propagation
         input_frame_inds = sorted(inputs_per_object[object_id])
@@ -321,10 +351,14 @@ def vos_separate_inference_per_object(
         for out_frame_idx, _, out_mask_logits in predictor.propagate_in_video(
             inference_state,
             start_frame_idx=min(input_frame_inds),
+            max_frame_num_to_track=max_frame_num_to_track,
             reverse=False,
+            suspend_absent_frames=suspend_absent_frames,
+            suspended_check_interval=suspended_check_interval,
         ):
             obj_scores = out_mask_logits.cpu().numpy()
             output_scores_per_object[object_id][out_frame_idx] = obj_scores
+    elapsed_time = time.perf_counter() - start_time
 
     # post-processing: consolidate the per-object scores into per-frame masks
     os.makedirs(os.path.join(output_mask_dir, video_name), exist_ok=True)
@@ -362,6 +396,7 @@ def vos_separate_inference_per_object(
             per_obj_png_file=per_obj_png_file,
             output_palette=output_palette,
         )
+    return len(frame_names), elapsed_time, inference_state
 
 
 def main():
@@ -439,19 +474,81 @@ def main():
         action="store_true",
         help="whether to use vos optimized video predictor with all modules compiled",
     )
+    parser.add_argument(
+        "--aot_cache_dir",
+        type=str,
+        default=None,
+        help="with --use_vos_optimized_video_predictor, load the modules compiled ahead "
+        "of time from this directory (compiling them there on the first run, see "
+        "`tools/compile_aot.py`) instead of compiling them on every run",
+    )
+    parser.add_argument(
+        "--quantize_maskmem_features",
+        action="store_true",
+        help="whether to store the memory features as int8 with per-channel scales (about "
+        "half the memory bank size of the default bfloat16 storage); the accuracy cost can "
+        "be measured with `sav_dataset/sav_evaluator.py --baseline_pred_root`",
+    )
+    parser.add_argument(
+        "--cache_memory_kv",
+        action="store_true",
+        help="whether to cache the memory of each frame projected into the keys and "
+        "values of the memory attention, so that each frame only projects its new memory",
+    )
+    parser.add_argument(
+        "--image_size",
+        type=int,
+        default=None,
+        help="run the model at this input resolution (a multiple of 32, e.g. 512 or 768) "
+        "instead of the one in the config, for a faster image encoder at some accuracy cost",
+    )
+    parser.add_argument(
+        "--suspend_absent_frames",
+        type=int,
+        default=0,
+        help="suspend the tracking of an object after it has been absent on this many "
+        "consecutive frames (default: 0, i.e. never), only checking if it has reappeared "
+        "every `--suspended_check_interval` frames",
+    )
+    parser.add_argument(
+        "--suspended_check_interval",
+        type=int,
+        default=5,
+        help="how often (in frames) to check if a suspended object has reappeared",
+    )
+    parser.add_argument(
+        "--profile_trace",
+        type=str,
+        default=None,
+        help="if set, record the wall time of each stage of the tracking (image encoder, "
+        "memory attention, SAM heads, memory encoder, ...) and save it to this path as a "
+        "Chrome trace (viewable in chrome://tracing or https://ui.perfetto.dev)",
+    )
     args = parser.parse_args()
 
     # if we use per-object PNG files, they could possibly overlap in inputs and outputs
     hydra_overrides_extra = [
         "++model.non_overlap_masks=" + ("false" if args.per_obj_png_file else "true")
     ]
+    if args.quantize_maskmem_features:
+        hydra_overrides_extra.append("++model.quantize_maskmem_features=true")
+    if args.cache_memory_kv:
+        hydra_overrides_extra.append("++model.cache_memory_kv=true")
+    if args.image_size is not None:
+        # (set in the config, so that the modules compiled ahead of time match it)
+        hydra_overrides_extra.append(f"++model.image_size={args.image_size}")
     predictor = build_sam2_video_predictor(
         config_file=args.sam2_cfg,
         ckpt_path=args.sam2_checkpoint,
         apply_postprocessing=args.apply_postprocessing,
         hydra_overrides_extra=hydra_overrides_extra,
         vos_optimized=args.use_vos_optimized_video_predictor,
+        aot_cache_dir=args.aot_cache_dir,
+        # (the inference runs under bfloat16 autocast)
+        aot_autocast_dtype=torch.bfloat16,
     )
+    if args.profile_trace is not None:
+        predictor.profiler = StageProfiler()
 
     if args.use_all_masks:
         print("using all available masks in input_mask_dir as input to the SAM 2 model")
@@ -484,6 +581,8 @@ def main():
                 score_thresh=args.score_thresh,
                 use_all_masks=args.use_all_masks,
                 per_obj_png_file=args.per_obj_png_file,
+                suspend_absent_frames=args.suspend_absent_frames,
+                suspended_check_interval=args.suspended_check_interval,
             )
         else:
             vos_separate_inference_per_object(
@@ -495,12 +594,18 @@ def main():
                 score_thresh=args.score_thresh,
                 use_all_masks=args.use_all_masks,
                 per_obj_png_file=args.per_obj_png_file,
+                suspend_absent_frames=args.suspend_absent_frames,
+                suspended_check_interval=args.suspended_check_interval,
             )
 
     print(
         f"completed VOS prediction on {len(video_names)} videos -- "
         f"output masks saved to {args.output_mask_dir}"
     )
+    if predictor.profiler is not None:
+        predictor.profiler.export_chrome_trace(args.profile_trace)
+        print(f"\n{predictor.profiler.format_summary()}")
+        print(f"profiling trace saved to {args.profile_trace}")
 
 
 if __name__ == "__main__":